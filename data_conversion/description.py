@@ -7,11 +7,15 @@ Requires two parameters: path to snapshot, and path to yaml file.
 """
 
 import yaml
-from swiftsimio import load
 from numpy import log10
 
+import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.snapshot_metadata import load_metadata, read_strided
+
 
 def latex_float(f):
     float_str = "{0:.4g}".format(f)
@@ -22,16 +26,28 @@ def latex_float(f):
         return float_str
 
 
-data = load(sys.argv[1])
+snapshot_filename = sys.argv[1]
+metadata = load_metadata(snapshot_filename)
+
+
+def minimal_mass(particle_type: int):
+    """
+    Minimal mass of every 100th particle, read straight from the snapshot.
+    """
+
+    masses = read_strided(snapshot_filename, f"PartType{particle_type}/Masses")
+
+    return (masses.min() * metadata.units.mass).to("Solar_Mass").value
+
 
 with open("boxsize_integer.txt", "w") as handle:
-    handle.write("%d" % int(data.metadata.boxsize[0].value + 0.1))
+    handle.write("%d" % int(metadata.boxsize[0].value + 0.1))
 
 with open(sys.argv[2], "r") as handle:
     parameter_file = yaml.load(handle, Loader=yaml.Loader)
 
 try:
-    run_name = data.metadata.run_name.decode("utf-8").replace("!!python/unicode", "")
+    run_name = metadata.run_name.replace("!!python/unicode", "")
 except:
     run_name = ""
 
@@ -222,19 +238,19 @@ except KeyError:
     pass
 
 DM_to_baryon_ratio = int(
-    round(data.metadata.n_dark_matter / (data.metadata.n_gas + data.metadata.n_stars))
+    round(metadata.n_dark_matter / (metadata.n_gas + metadata.n_stars))
 )
 
 particlenumbers = f"""
-<li><b>Cube root of dark matter particle number</b>: {int(data.metadata.n_dark_matter**(1/3)+0.01)}</li>
-<li><b>Cube root of baryon particle number</b>: {int((data.metadata.n_gas + data.metadata.n_stars)**(1/3)+0.01)}</li>
+<li><b>Cube root of dark matter particle number</b>: {int(metadata.n_dark_matter**(1/3)+0.01)}</li>
+<li><b>Cube root of baryon particle number</b>: {int((metadata.n_gas + metadata.n_stars)**(1/3)+0.01)}</li>
 <li><b>Ratio dark matter to baryon particles</b>: {int(DM_to_baryon_ratio)} </li>
-<li><b>Number of particles at $z={data.metadata.z:2.2f}$</b>:
+<li><b>Number of particles at $z={metadata.z:2.2f}$</b>:
     <ul>
-    <li>Dark matter: {data.metadata.n_dark_matter}</li>
-    <li>Gas: {data.metadata.n_gas}</li>
-    <li>Star: {data.metadata.n_stars}</li>
-    <li>Black hole: {data.metadata.n_black_holes}</li>
+    <li>Dark matter: {metadata.n_dark_matter}</li>
+    <li>Gas: {metadata.n_gas}</li>
+    <li>Star: {metadata.n_stars}</li>
+    <li>Black hole: {metadata.n_black_holes}</li>
     </ul>
 </li>
 """
@@ -242,23 +258,23 @@ particlenumbers = f"""
 # Now generate HTML
 output = f"""<ul>
 <li><b>Run Name</b>: {run_name}</li>
-<li><b>Boxsize</b>: {str(data.metadata.boxsize)}</li>
+<li><b>Boxsize</b>: {str(metadata.boxsize)}</li>
 {particlenumbers}
-<li><b>Minimal particle masses at $z={data.metadata.z:2.2f}$</b>:
+<li><b>Minimal particle masses at $z={metadata.z:2.2f}$</b>:
   <ul>
-    <li>Dark matter: ${latex_float(data.dark_matter.masses[::100].min().to('Solar_Mass').value)}$ M$_\\odot$</li>
-    <li>Gas: ${latex_float(data.gas.masses[::100].min().to('Solar_Mass').value)}$ M$_\\odot$</li>
+    <li>Dark matter: ${latex_float(minimal_mass(1))}$ M$_\\odot$</li>
+    <li>Gas: ${latex_float(minimal_mass(0))}$ M$_\\odot$</li>
   </ul>
 </li>
 <li><b>Particle gravitational softenings</b>:
   <ul>
-    <li>Dark matter: {str((float(parameter_file["Gravity"]["max_physical_DM_softening"]) * data.units.length).to('kpc'))}</li>
-    <li>Baryons: {str((float(parameter_file["Gravity"]["max_physical_baryon_softening"]) * data.units.length).to('kpc'))}</li>
+    <li>Dark matter: {str((float(parameter_file["Gravity"]["max_physical_DM_softening"]) * metadata.units.length).to('kpc'))}</li>
+    <li>Baryons: {str((float(parameter_file["Gravity"]["max_physical_baryon_softening"]) * metadata.units.length).to('kpc'))}</li>
   </ul>
 </li>
-<li><b>Code info</b>: {data.metadata.code_info}</li>
-<li><b>Compiler info</b>: {data.metadata.compiler_info}</li>
-<li><b>Hydrodynamics</b>: {data.metadata.hydro_info}</li>
+<li><b>Code info</b>: {metadata.code_info}</li>
+<li><b>Compiler info</b>: {metadata.compiler_info}</li>
+<li><b>Hydrodynamics</b>: {metadata.hydro_info}</li>
 <li><b>Subgrid model parameters</b>:
   <ul>
     {supernova_feedback}
@@ -0,0 +1,8 @@
+"""
+Helper modules shared between the plotting, performance, data conversion
+and imaging scripts.
+
+The scripts in this repository are ran directly (e.g.
+``python3 performance/wallclock_simulation_time.py ...``), so they add
+the repository root to ``sys.path`` before importing from here.
+"""
@@ -0,0 +1,210 @@
+"""
+Shape-preserving downsampling of very long lines before they are handed
+to matplotlib.
+
+The timestep logs of our longest runs contain tens of millions of rows,
+but a figure is only a few hundred pixels wide. Drawing every point is
+slow and produces huge vector output, so here we reduce each line to a
+handful of points per pixel column while keeping the rendered shape.
+
+Two methods are available:
+
++ ``minmax`` (default): for every pixel bucket we keep the first, last,
+  minimum and maximum points (the M4 aggregation). With at least one
+  bucket per pixel this draws the same line as the full data set.
++ ``lttb``: largest-triangle-three-buckets, which picks one visually
+  representative point per bucket. Smaller output, but not exact.
+"""
+
+import numpy as np
+
+# Number of buckets per pixel column of the axes.
+default_oversample = 2
+# Only downsample if we have this many more points than buckets.
+default_threshold = 4
+
+
+def _bucket_coordinate(x, scale: str):
+    """
+    Transforms ``x`` to the coordinate that is linear in pixels.
+    """
+
+    if scale == "log":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.log10(x)
+    else:
+        return x
+
+
+def minmax_indices(x, y, number_of_buckets: int, scale: str = "linear"):
+    """
+    Returns the sorted indices of the first, last, minimum and maximum
+    points in each of ``number_of_buckets`` equal-width buckets in
+    ``x``. ``x`` must be monotonic.
+    """
+
+    t = _bucket_coordinate(x, scale)
+    t_min = min(t[0], t[-1])
+    t_max = max(t[0], t[-1])
+
+    if t_max <= t_min:
+        return np.arange(len(x))
+
+    buckets = ((t - t_min) * (number_of_buckets / (t_max - t_min))).astype(np.int64)
+    np.clip(buckets, 0, number_of_buckets - 1, out=buckets)
+
+    # Buckets are contiguous as x is monotonic.
+    starts = np.flatnonzero(np.diff(buckets)) + 1
+    starts = np.concatenate([[0], starts])
+    ends = np.concatenate([starts[1:], [len(x)]])
+    counts = ends - starts
+
+    def first_in_bucket(matches):
+        indices = np.flatnonzero(matches)
+        bucket_of_index = np.repeat(np.arange(len(starts)), counts)[indices]
+        keep = np.concatenate([[True], bucket_of_index[1:] != bucket_of_index[:-1]])
+        return indices[keep]
+
+    bucket_min = np.repeat(np.minimum.reduceat(y, starts), counts)
+    bucket_max = np.repeat(np.maximum.reduceat(y, starts), counts)
+
+    indices = np.concatenate(
+        [
+            starts,
+            ends - 1,
+            first_in_bucket(y == bucket_min),
+            first_in_bucket(y == bucket_max),
+        ]
+    )
+
+    return np.unique(indices)
+
+
+def lttb_indices(x, y, number_of_buckets: int, scale: str = "linear"):
+    """
+    Returns the sorted indices selected by the largest-triangle-three-buckets
+    algorithm, keeping ``number_of_buckets`` points plus the two end points.
+    """
+
+    n = len(x)
+
+    if number_of_buckets >= n - 2:
+        return np.arange(n)
+
+    t = _bucket_coordinate(x, scale)
+    edges = np.linspace(1, n - 1, number_of_buckets + 1).astype(np.int64)
+
+    selected = np.empty(number_of_buckets + 2, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    previous = 0
+
+    for bucket in range(number_of_buckets):
+        start, end = edges[bucket], edges[bucket + 1]
+
+        # The third point of the triangle is the average of the next bucket.
+        if bucket + 1 < number_of_buckets:
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        else:
+            next_start, next_end = n - 1, n
+
+        average_t = t[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+
+        area = np.abs(
+            (t[previous] - average_t) * (y[start:end] - y[previous])
+            - (t[previous] - t[start:end]) * (average_y - y[previous])
+        )
+
+        previous = start + int(np.argmax(area))
+        selected[bucket + 1] = previous
+
+    return selected
+
+
+def downsample_line(
+    x,
+    y,
+    number_of_buckets: int,
+    method: str = "minmax",
+    scale: str = "linear",
+    threshold: float = default_threshold,
+):
+    """
+    Downsamples the line ``(x, y)`` to roughly ``number_of_buckets``
+    buckets along x.
+
+    Non-finite points are removed. The arrays are returned untouched
+    if they are already short enough or if ``x`` is not monotonic (in
+    which case bucketing along x would change the drawn line). Units
+    on ``unyt`` arrays are preserved as we only ever index them.
+    """
+
+    x_values = np.asarray(x)
+    y_values = np.asarray(y)
+
+    if len(x_values) < threshold * number_of_buckets:
+        return x, y
+
+    finite = np.isfinite(x_values) & np.isfinite(y_values)
+    if scale == "log":
+        finite &= x_values > 0
+
+    if not finite.all():
+        x, y = x[finite], y[finite]
+        x_values, y_values = x_values[finite], y_values[finite]
+
+    if len(x_values) < threshold * number_of_buckets:
+        return x, y
+
+    dx = np.diff(x_values)
+    if not ((dx >= 0).all() or (dx <= 0).all()):
+        return x, y
+
+    if method == "minmax":
+        indices = minmax_indices(x_values, y_values, number_of_buckets, scale)
+    elif method == "lttb":
+        indices = lttb_indices(x_values, y_values, number_of_buckets, scale)
+    else:
+        raise ValueError(f"Unknown downsampling method {method}")
+
+    return x[indices], y[indices]
+
+
+def downsample_for_axes(
+    ax,
+    x,
+    y,
+    method: str = "minmax",
+    oversample: float = default_oversample,
+    threshold: float = default_threshold,
+):
+    """
+    Downsamples ``(x, y)`` to the pixel width of ``ax``, taking into
+    account whether the x-axis is logarithmic. Call this after the axes
+    scale has been set (e.g. after ``ax.loglog()``).
+    """
+
+    pixel_width = ax.get_window_extent().width
+    number_of_buckets = max(int(oversample * pixel_width), 1)
+
+    return downsample_line(
+        x,
+        y,
+        number_of_buckets=number_of_buckets,
+        method=method,
+        scale=ax.get_xscale(),
+        threshold=threshold,
+    )
+
+
+def plot_line(ax, x, y, *args, method: str = "minmax", **kwargs):
+    """
+    Drop-in replacement for ``ax.plot(x, y, ...)`` that downsamples
+    lines with many more points than the axes has pixels.
+    """
+
+    x, y = downsample_for_axes(ax, x, y, method=method)
+
+    return ax.plot(x, y, *args, **kwargs)
@@ -0,0 +1,357 @@
+"""
+Per-halo reductions (sums, means, maxima, ...) over snapshot particles,
+computed for all halos at once.
+
+Each `HaloQuantity` describes one reduction over one particle type. The
+particles of each type are read in chunks, matched to their halos with a
+`helpers.halo_particles.HaloMembership`, and reduced with ``np.bincount``
+(or a sort and ``reduceat`` for minima and maxima). Partial results from
+the chunks are combined, so the memory use is set by the chunk size.
+
+The results are written to an ``extra_*.hdf5`` file in the output path
+(i.e. with the plots of the catalogue), which ``registration.py`` picks up
+so that they can be used as ``derived_quantities.<name>`` in the
+``auto_plotter/*.yml`` files.
+"""
+
+import attr
+import h5py
+import os
+import unyt
+
+import numpy as np
+
+from typing import Optional
+
+from .halo_particles import HaloMembership
+
+reductions = ["sum", "mean", "fraction", "count", "max", "min"]
+
+# Exponents of the base units in the dataset attributes of SWIFT snapshots.
+unit_exponents = {
+    "U_M exponent": "g",
+    "U_L exponent": "cm",
+    "U_t exponent": "s",
+    "U_I exponent": "A",
+    "U_T exponent": "K",
+}
+physical_conversion = (
+    "Conversion factor to physical CGS (including cosmological corrections)"
+)
+
+
+@attr.s
+class HaloQuantity(object):
+    """
+    A per-halo reduction over the particles of one type.
+
+    name: str
+        Name of the quantity, as used in the catalogue.
+    particle_type: int
+        SWIFT particle type (0 gas, 1 dark matter, 4 stars, 5 black holes).
+    dataset: str, optional
+        Dataset in the ``PartType{particle_type}`` group to reduce. Not
+        needed for the "count" and "fraction" reductions.
+    reduction: str
+        One of "sum", "mean", "fraction", "count", "max", "min". A
+        "fraction" is the (weighted) fraction of the particles that pass
+        the selection.
+    weights: str, optional
+        Dataset to weight by. For sums, values are multiplied by the
+        weights (e.g. metal mass fractions weighted by masses give the
+        metal mass); means and fractions are weighted averages.
+    selection: tuple, optional
+        (dataset, lower, upper) with unyt quantities (or None) as bounds;
+        only particles with lower < value <= upper are included.
+    units: str
+        Output units.
+    label: str
+        Axis label used by the auto-plotter.
+    """
+
+    name = attr.ib(type=str)
+    particle_type = attr.ib(type=int)
+    dataset = attr.ib(default=None, type=Optional[str])
+    reduction = attr.ib(
+        default="sum", type=str, validator=attr.validators.in_(reductions)
+    )
+    weights = attr.ib(default=None, type=Optional[str])
+    selection = attr.ib(default=None)
+    units = attr.ib(default="dimensionless", type=str)
+    label = attr.ib(default="", type=str)
+
+    def datasets(self):
+        names = {"ParticleIDs"}
+
+        for name in [self.dataset, self.weights]:
+            if name is not None:
+                names.add(name)
+
+        if self.selection is not None:
+            names.add(self.selection[0])
+
+        return names
+
+
+def dataset_units(dataset: h5py.Dataset) -> unyt.unyt_quantity:
+    """
+    Physical value of one unit of a SWIFT snapshot dataset.
+    """
+
+    attributes = dataset.attrs
+    units = unyt.Unit("dimensionless")
+
+    for key, base in unit_exponents.items():
+        if key in attributes:
+            exponent = float(np.asarray(attributes[key]).flat[0])
+
+            if exponent != 0.0:
+                units = units * unyt.Unit(base) ** exponent
+
+    factor = float(np.asarray(attributes.get(physical_conversion, 1.0)).flat[0])
+
+    return unyt.unyt_quantity(factor, units)
+
+
+class _Accumulator(object):
+    """
+    Combines the partial results of one quantity over the chunks.
+    """
+
+    def __init__(self, quantity: HaloQuantity, number_of_halos: int):
+        self.quantity = quantity
+        self.number_of_halos = number_of_halos
+
+        if quantity.reduction == "max":
+            self.values = np.full(number_of_halos, -np.inf)
+        elif quantity.reduction == "min":
+            self.values = np.full(number_of_halos, np.inf)
+        else:
+            self.values = np.zeros(number_of_halos)
+
+        self.normalisation = np.zeros(number_of_halos)
+
+        return
+
+    def _bincount(self, halo_indices, weights=None):
+        return np.bincount(
+            halo_indices, weights=weights, minlength=self.number_of_halos
+        )
+
+    def add(self, halo_indices, values, weights, selected):
+        reduction = self.quantity.reduction
+
+        if reduction == "sum":
+            self.values += self._bincount(
+                halo_indices[selected], (values * weights)[selected]
+            )
+        elif reduction == "count":
+            self.values += self._bincount(halo_indices[selected])
+        elif reduction == "mean":
+            self.values += self._bincount(
+                halo_indices[selected], (values * weights)[selected]
+            )
+            self.normalisation += self._bincount(
+                halo_indices[selected], weights[selected]
+            )
+        elif reduction == "fraction":
+            self.values += self._bincount(halo_indices[selected], weights[selected])
+            self.normalisation += self._bincount(halo_indices, weights)
+        else:
+            halo_indices = halo_indices[selected]
+            values = values[selected]
+
+            if len(values) == 0:
+                return
+
+            order = np.argsort(halo_indices, kind="stable")
+            halo_indices = halo_indices[order]
+            starts = np.flatnonzero(np.diff(halo_indices, prepend=-1))
+            unique_halos = halo_indices[starts]
+
+            if reduction == "max":
+                reduced = np.maximum.reduceat(values[order], starts)
+                self.values[unique_halos] = np.maximum(
+                    self.values[unique_halos], reduced
+                )
+            else:
+                reduced = np.minimum.reduceat(values[order], starts)
+                self.values[unique_halos] = np.minimum(
+                    self.values[unique_halos], reduced
+                )
+
+        return
+
+    def result(self) -> unyt.unyt_array:
+        values = self.values.copy()
+
+        if self.quantity.reduction in ["mean", "fraction"]:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values /= self.normalisation
+        elif self.quantity.reduction in ["max", "min"]:
+            values[~np.isfinite(values)] = np.nan
+
+        output = unyt.unyt_array(values, self.quantity.units)
+        output.name = self.quantity.label
+
+        return output
+
+
+def _conversion_factors(quantity: HaloQuantity, group: h5py.Group):
+    """
+    Factors to convert the raw dataset values to the output units, and
+    the selection bounds to the raw units of the selection dataset.
+    """
+
+    value_factor = 1.0
+
+    if quantity.reduction in ["sum", "mean", "max", "min"]:
+        value_units = dataset_units(group[quantity.dataset])
+
+        if quantity.reduction == "sum" and quantity.weights is not None:
+            value_units = value_units * dataset_units(group[quantity.weights])
+
+        value_factor = float(value_units.to(quantity.units).value)
+
+    bounds = [-np.inf, np.inf]
+
+    if quantity.selection is not None:
+        selection_units = dataset_units(group[quantity.selection[0]])
+
+        for index, bound in enumerate(quantity.selection[1:]):
+            if bound is not None:
+                bounds[index] = float(
+                    (bound / selection_units).to("dimensionless").value
+                )
+
+    return value_factor, bounds
+
+
+def compute_halo_quantities(
+    snapshot_filename: str,
+    membership: HaloMembership,
+    quantities,
+    chunk_size: int = 1 << 22,
+) -> dict:
+    """
+    Computes all of ``quantities`` for every halo in ``membership``.
+    Returns a dictionary of unyt arrays (with names set to the labels),
+    one entry per halo in the catalogue. Quantities that need datasets
+    that are not in the snapshot are reported and left out.
+    """
+
+    accumulators = {
+        quantity.name: _Accumulator(quantity, membership.number_of_halos)
+        for quantity in quantities
+    }
+
+    particle_types = sorted({quantity.particle_type for quantity in quantities})
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        for particle_type in particle_types:
+            group_name = f"PartType{particle_type}"
+            type_quantities = []
+
+            for quantity in quantities:
+                if quantity.particle_type != particle_type:
+                    continue
+
+                missing = [
+                    f"{group_name}/{name}"
+                    for name in sorted(quantity.datasets())
+                    if group_name not in handle or name not in handle[group_name]
+                ]
+
+                if len(missing) > 0:
+                    print(
+                        f"Skipping {quantity.name}: {', '.join(missing)} not in "
+                        f"{snapshot_filename}"
+                    )
+                    del accumulators[quantity.name]
+                else:
+                    type_quantities.append(quantity)
+
+            if len(type_quantities) == 0:
+                continue
+
+            group = handle[group_name]
+            members = membership.select_type(particle_type)
+            factors = {
+                q.name: _conversion_factors(q, group) for q in type_quantities
+            }
+            dataset_names = set.union(*[q.datasets() for q in type_quantities])
+
+            number_of_particles = group["ParticleIDs"].shape[0]
+
+            for start in range(0, number_of_particles, chunk_size):
+                stop = start + chunk_size
+
+                halo_indices = members.match(group["ParticleIDs"][start:stop])
+                in_halo = halo_indices >= 0
+
+                if not in_halo.any():
+                    continue
+
+                halo_indices = halo_indices[in_halo]
+                data = {
+                    name: group[name][start:stop][in_halo]
+                    for name in dataset_names
+                    if name != "ParticleIDs"
+                }
+
+                for quantity in type_quantities:
+                    value_factor, (lower, upper) = factors[quantity.name]
+
+                    if quantity.dataset is not None:
+                        values = data[quantity.dataset].astype(np.float64)
+                        values = values * value_factor
+                    else:
+                        values = np.ones(len(halo_indices))
+
+                    if quantity.weights is not None:
+                        weights = data[quantity.weights].astype(np.float64)
+                    else:
+                        weights = np.ones(len(halo_indices))
+
+                    if quantity.selection is not None:
+                        selection_values = data[quantity.selection[0]]
+                        selected = np.logical_and(
+                            selection_values > lower, selection_values <= upper
+                        )
+                    else:
+                        selected = np.ones(len(halo_indices), dtype=bool)
+
+                    accumulators[quantity.name].add(
+                        halo_indices, values, weights, selected
+                    )
+
+    return {name: values.result() for name, values in accumulators.items()}
+
+
+def extra_quantities_filename(
+    output_path: str, properties_filename: str, stage: str
+) -> str:
+    """
+    File in ``output_path`` that holds the extra quantities from ``stage``
+    for the catalogue at ``properties_filename``; registration.py registers
+    all of these.
+    """
+
+    name = os.path.basename(properties_filename)
+
+    return f"{output_path}/{name.replace('properties', f'extra_{stage}.hdf5')}"
+
+
+def write_extra_quantities(filename: str, quantities: dict):
+    """
+    Writes per-halo unyt arrays (one entry per halo in the catalogue) so
+    that registration.py can add them to the catalogue.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        for name, values in quantities.items():
+            dataset = handle.create_dataset(name, data=values.value)
+            dataset.attrs["units"] = str(values.units)
+            dataset.attrs["name"] = getattr(values, "name", None) or name
+
+    return
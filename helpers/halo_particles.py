@@ -0,0 +1,414 @@
+"""
+Bulk mapping of snapshot particles to VELOCIraptor halos.
+
+Instead of extracting the particles of each halo in turn (as
+``groups.extract_halo`` does), the particle files written alongside the
+catalogue are read in one go and every particle is assigned to the halo
+it belongs to. Snapshot particles are then matched to halos with a single
+sort and ``np.searchsorted``, so the cost does not depend on the number of
+halos.
+
+The first time the membership is read, the offsets, IDs and types of the
+members of all halos are also written into flat ``.npy`` files in the
+output path (a `HaloMembershipIndex`), which are memory-mapped by later
+scripts instead of opening the VELOCIraptor files again. The members of
+any single halo are then a slice of these arrays.
+
+Halos are referred to by their index in the catalogue (i.e. halo ID - 1),
+the same as ``halo_id`` in ``images/imaging.py``.
+"""
+
+import h5py
+import os
+
+import numpy as np
+
+from .sidecar_cache import atomic_output, cache_signature, is_valid
+
+# Bump this if the contents of the index change.
+index_version = 1
+
+
+def velociraptor_filenames(properties_filename: str) -> dict:
+    """
+    Names of the files that VELOCIraptor writes next to
+    ``properties_filename``. Older versions of VELOCIraptor call the
+    particle type files ``catalog_partypes``; we use whichever exists.
+    """
+
+    filenames = {
+        "groups": properties_filename.replace("properties", "catalog_groups"),
+        "particles": properties_filename.replace("properties", "catalog_particles"),
+        "parttypes": properties_filename.replace("properties", "catalog_parttypes"),
+        "unbound_particles": properties_filename.replace(
+            "properties", "catalog_particles.unbound"
+        ),
+        "unbound_parttypes": properties_filename.replace(
+            "properties", "catalog_parttypes.unbound"
+        ),
+    }
+
+    if not os.path.exists(filenames["parttypes"]):
+        filenames = {
+            k: v.replace("parttypes", "partypes") for k, v in filenames.items()
+        }
+
+    return filenames
+
+
+def _read_members(groups, offset_name: str, particles_filename, parttypes_filename):
+    """
+    Reads the offsets of the halos (with the total number of members
+    appended), and the particle IDs and types in one of the particle files.
+    """
+
+    offsets = groups[offset_name][:].astype(np.int64)
+
+    with h5py.File(particles_filename, "r") as handle:
+        particle_ids = handle["Particle_IDs"][:]
+
+    with h5py.File(parttypes_filename, "r") as handle:
+        particle_types = handle["Particle_types"][:].astype(np.int8)
+
+    return np.append(offsets, len(particle_ids)), particle_ids, particle_types
+
+
+def _halo_indices(offsets) -> np.ndarray:
+    """
+    The halo index of each member, from the offsets of the halos (with the
+    total number of members appended).
+    """
+
+    return np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+
+
+class HaloMembership(object):
+    """
+    The particle IDs of every halo in a catalogue, with the halo index
+    and particle type of each of them, sorted by particle ID.
+    """
+
+    def __init__(self, particle_ids, particle_types, halo_indices, number_of_halos):
+        order = np.argsort(particle_ids, kind="stable")
+
+        self.particle_ids = particle_ids[order]
+        self.particle_types = particle_types[order]
+        self.halo_indices = halo_indices[order]
+        self.number_of_halos = number_of_halos
+
+        return
+
+    def select_type(self, particle_type: int) -> "HaloMembership":
+        """
+        Only keeps the members of type ``particle_type`` (e.g. 4 for stars).
+        """
+
+        mask = self.particle_types == particle_type
+
+        membership = HaloMembership.__new__(HaloMembership)
+        membership.particle_ids = self.particle_ids[mask]
+        membership.particle_types = self.particle_types[mask]
+        membership.halo_indices = self.halo_indices[mask]
+        membership.number_of_halos = self.number_of_halos
+
+        return membership
+
+    def match(self, particle_ids) -> np.ndarray:
+        """
+        Returns the halo index of each of ``particle_ids``, and -1 for the
+        particles that are not in any halo.
+        """
+
+        if len(self.particle_ids) == 0:
+            return np.full(len(particle_ids), -1, dtype=np.int64)
+
+        positions = np.searchsorted(self.particle_ids, particle_ids)
+        positions[positions == len(self.particle_ids)] = 0
+
+        found = self.particle_ids[positions] == particle_ids
+
+        return np.where(found, self.halo_indices[positions], -1)
+
+
+def index_directory(properties_filename: str, output_path: str) -> str:
+    """
+    Directory in ``output_path`` of the membership index of the catalogue
+    at ``properties_filename``.
+    """
+
+    name = os.path.basename(properties_filename)
+
+    return f"{output_path}/{name.replace('properties', 'catalog_membership_index')}"
+
+
+def _index_signature(properties_filename: str) -> str:
+    filenames = velociraptor_filenames(properties_filename)
+
+    return cache_signature(index_version, [filenames[k] for k in sorted(filenames)])
+
+
+def read_all_members(properties_filename: str) -> dict:
+    """
+    Reads the offsets, IDs and types (see `_read_members`) of the bound
+    ("") and "unbound_" members of all halos in the catalogue at
+    ``properties_filename``.
+    """
+
+    filenames = velociraptor_filenames(properties_filename)
+
+    with h5py.File(filenames["groups"], "r") as groups:
+        return {
+            prefix: _read_members(
+                groups,
+                offset_name,
+                filenames[f"{prefix}particles"],
+                filenames[f"{prefix}parttypes"],
+            )
+            for prefix, offset_name in [("", "Offset"), ("unbound_", "Offset_unbound")]
+        }
+
+
+def write_membership_index(properties_filename: str, members: dict, directory: str):
+    """
+    Writes the ``members`` (as read by `read_all_members`) of all halos in
+    the catalogue at ``properties_filename`` into the index ``directory``.
+    """
+
+    with atomic_output(directory) as temporary_directory:
+        os.makedirs(temporary_directory)
+
+        for prefix, arrays in members.items():
+            for name, values in zip(
+                ["offsets", "particle_ids", "particle_types"], arrays
+            ):
+                np.save(f"{temporary_directory}/{prefix}{name}.npy", values)
+
+        with open(f"{temporary_directory}/signature.json", "w") as handle:
+            handle.write(_index_signature(properties_filename))
+
+    return
+
+
+class HaloMembershipIndex(object):
+    """
+    The members of every halo in a catalogue, from the index in
+    ``directory``. The arrays are memory-mapped when first used, and only
+    the directory is pickled, so an index can be sent to the processes of
+    a pool.
+    """
+
+    array_names = [
+        "offsets",
+        "particle_ids",
+        "particle_types",
+        "unbound_offsets",
+        "unbound_particle_ids",
+        "unbound_particle_types",
+    ]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._arrays = None
+
+        return
+
+    def __getstate__(self):
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"])
+
+        return
+
+    @property
+    def arrays(self) -> dict:
+        if self._arrays is None:
+            self._arrays = {
+                name: np.load(f"{self.directory}/{name}.npy", mmap_mode="r")
+                for name in self.array_names
+            }
+
+        return self._arrays
+
+    def __len__(self):
+        return len(self.arrays["offsets"]) - 1
+
+    def particle_numbers(self, include_unbound: bool = True) -> np.ndarray:
+        """
+        Number of members of each halo.
+        """
+
+        particle_numbers = np.diff(self.arrays["offsets"])
+
+        if include_unbound:
+            particle_numbers = particle_numbers + np.diff(
+                self.arrays["unbound_offsets"]
+            )
+
+        return particle_numbers
+
+    def members(self, halo_index: int, include_unbound: bool = True):
+        """
+        The particle IDs and types of the members of halo ``halo_index``
+        (bound first, then unbound), as slices of the memory-mapped arrays.
+        """
+
+        particle_ids = []
+        particle_types = []
+
+        for prefix in ["", "unbound_"] if include_unbound else [""]:
+            start, stop = self.arrays[f"{prefix}offsets"][halo_index : halo_index + 2]
+            particle_ids.append(self.arrays[f"{prefix}particle_ids"][start:stop])
+            particle_types.append(self.arrays[f"{prefix}particle_types"][start:stop])
+
+        if not include_unbound:
+            return particle_ids[0], particle_types[0]
+
+        return np.concatenate(particle_ids), np.concatenate(particle_types)
+
+    def membership(self, include_unbound: bool = True) -> HaloMembership:
+        """
+        The `HaloMembership` of all halos.
+        """
+
+        members = []
+
+        for prefix in ["", "unbound_"] if include_unbound else [""]:
+            offsets = self.arrays[f"{prefix}offsets"]
+            members.append(
+                (
+                    np.asarray(self.arrays[f"{prefix}particle_ids"]),
+                    np.asarray(self.arrays[f"{prefix}particle_types"]),
+                    _halo_indices(offsets),
+                )
+            )
+
+        particle_ids, particle_types, halo_indices = [
+            np.concatenate(x) for x in zip(*members)
+        ]
+
+        return HaloMembership(particle_ids, particle_types, halo_indices, len(self))
+
+
+def load_membership_index(
+    properties_filename: str, output_path: str
+) -> HaloMembershipIndex:
+    """
+    The membership index in ``output_path`` of the catalogue at
+    ``properties_filename``, or None if it does not exist or is out of date.
+    """
+
+    directory = index_directory(properties_filename, output_path)
+
+    try:
+        with open(f"{directory}/signature.json", "r") as handle:
+            valid = is_valid(handle.read(), _index_signature(properties_filename))
+    except OSError:
+        valid = False
+
+    return HaloMembershipIndex(directory) if valid else None
+
+
+def _write_index(properties_filename: str, members: dict, output_path: str) -> bool:
+    try:
+        write_membership_index(
+            properties_filename,
+            members,
+            index_directory(properties_filename, output_path),
+        )
+    except OSError:
+        # E.g. the output path is read-only.
+        return False
+
+    return True
+
+
+def membership_index(properties_filename: str, output_path: str):
+    """
+    The membership index in ``output_path`` of the catalogue at
+    ``properties_filename``, which is built if it does not exist or is out
+    of date. None if it can not be written.
+    """
+
+    index = load_membership_index(properties_filename, output_path)
+
+    if index is None and _write_index(
+        properties_filename, read_all_members(properties_filename), output_path
+    ):
+        index = HaloMembershipIndex(index_directory(properties_filename, output_path))
+
+    return index
+
+
+def read_halo_membership(
+    properties_filename: str, output_path: str = None, include_unbound: bool = True
+) -> HaloMembership:
+    """
+    Reads the membership of all halos in the catalogue at
+    ``properties_filename``, from its membership index in ``output_path`` if
+    that is up to date. Otherwise, the catalog_groups, catalog_particles and
+    catalog_parttypes files are read, and the index is written (if an
+    ``output_path`` is given) from what was read.
+    """
+
+    if output_path is not None:
+        index = load_membership_index(properties_filename, output_path)
+
+        if index is not None:
+            return index.membership(include_unbound=include_unbound)
+
+    members = read_all_members(properties_filename)
+
+    if output_path is not None:
+        _write_index(properties_filename, members, output_path)
+
+    if not include_unbound:
+        members = {"": members[""]}
+
+    particle_ids, particle_types, halo_indices = [
+        np.concatenate(x)
+        for x in zip(
+            *[
+                (particle_ids, particle_types, _halo_indices(offsets))
+                for offsets, particle_ids, particle_types in members.values()
+            ]
+        )
+    ]
+
+    return HaloMembership(
+        particle_ids, particle_types, halo_indices, len(members[""][0]) - 1
+    )
+
+
+def group_by_halo(halo_indices, values, number_of_halos: int, bins=None, weights=None):
+    """
+    Sums ``weights`` (or counts particles) per halo, and per bin of
+    ``values`` if ``bins`` is given, in a single ``np.bincount``. Particles
+    with a negative halo index, or outside of ``bins``, are ignored.
+
+    Returns an array of shape (number_of_halos,) or
+    (number_of_halos, len(bins) - 1).
+    """
+
+    if bins is None:
+        number_of_bins = 1
+        bin_indices = np.zeros(len(halo_indices), dtype=np.int64)
+    else:
+        number_of_bins = len(bins) - 1
+        bin_indices = np.searchsorted(bins, values, side="right") - 1
+
+    mask = np.logical_and(halo_indices >= 0, bin_indices >= 0)
+    mask = np.logical_and(mask, bin_indices < number_of_bins)
+
+    keys = halo_indices[mask] * number_of_bins + bin_indices[mask]
+
+    totals = np.bincount(
+        keys,
+        weights=None if weights is None else weights[mask],
+        minlength=number_of_halos * number_of_bins,
+    )
+
+    if bins is None:
+        return totals
+
+    return totals.reshape(number_of_halos, number_of_bins)
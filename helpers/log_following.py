@@ -0,0 +1,191 @@
+"""
+Incremental reading of log files that are still being written to.
+
+A `LogFollower` remembers how far into its file it has read, and only
+returns the complete lines that were appended since the last call. This
+lets the analysis of a running simulation scale with the amount of new
+output rather than with the length of the whole log.
+
+A `FollowedTable` builds on this to keep the numeric rows of a text
+table (e.g. SFR.txt or timesteps_*.txt) up to date.
+"""
+
+import numpy as np
+import os
+
+from typing import List, Optional
+
+
+def parse_rows(lines: List[str], number_of_columns: Optional[int] = None):
+    """
+    Parses the numeric rows in ``lines``, skipping comments and rows that
+    are malformed (e.g. restart headers or partially written lines).
+
+    Returns the array of rows and the number of columns.
+    """
+
+    lines = [line for line in lines if line.strip() and line.lstrip()[0] != "#"]
+
+    if len(lines) == 0:
+        return np.zeros((0, number_of_columns or 0)), number_of_columns
+
+    if number_of_columns is None:
+        field_counts = [len(line.split()) for line in lines[:1024]]
+        number_of_columns = max(set(field_counts), key=field_counts.count)
+
+    try:
+        rows = np.loadtxt(lines, ndmin=2)
+        if rows.shape[1] == number_of_columns:
+            return rows, number_of_columns
+    except ValueError:
+        pass
+
+    # Slow path; only keep the well formed lines.
+    lines = [line for line in lines if len(line.split()) == number_of_columns]
+    rows = np.genfromtxt(lines, invalid_raise=False, loose=True, ndmin=2)
+    rows = rows[np.isfinite(rows).all(axis=1)]
+
+    return rows.reshape(-1, number_of_columns), number_of_columns
+
+
+class LogFollower(object):
+    """
+    Follows a single text file, returning complete new lines on each
+    call to `read_new_lines`.
+    """
+
+    def __init__(self, filename: str, offset: int = 0):
+        self.filename = filename
+        self.offset = offset
+        self.inode = None
+
+        return
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filename)
+
+    def was_replaced(self) -> bool:
+        """
+        Whether the file has been truncated or replaced (e.g. by a restarted
+        run) since we last read it. Callers then need to start over.
+        """
+
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+
+        if self.inode is not None and stat.st_ino != self.inode:
+            return True
+
+        return stat.st_size < self.offset
+
+    def read_new_bytes(self) -> bytes:
+        """
+        Returns the bytes appended since the last read, up to and including
+        the final newline. A partially written last line is left for the
+        next call.
+        """
+
+        try:
+            handle = open(self.filename, "rb")
+        except OSError:
+            return b""
+
+        with handle:
+            self.inode = os.fstat(handle.fileno()).st_ino
+            handle.seek(self.offset)
+            raw = handle.read()
+
+        end = raw.rfind(b"\n") + 1
+        self.offset += end
+
+        return raw[:end]
+
+    def read_new_lines(self) -> List[str]:
+        return self.read_new_bytes().decode("utf-8", errors="replace").splitlines()
+
+    def reset(self):
+        self.offset = 0
+        self.inode = None
+
+        return
+
+
+class FollowedTable(object):
+    """
+    The numeric rows of a text table that is being appended to. Call
+    `update` to parse any new rows; the full table is available as `data`.
+    """
+
+    def __init__(self, filename: str, number_of_columns: Optional[int] = None):
+        self.follower = LogFollower(filename)
+        self.number_of_columns = number_of_columns
+        # Comment lines before the first row of data
+        self.header_lines = []
+
+        self._buffer = np.zeros((0, number_of_columns or 0))
+        self._size = 0
+
+        return
+
+    @property
+    def filename(self) -> str:
+        return self.follower.filename
+
+    def _append(self, rows: np.ndarray):
+        """
+        Appends rows to the buffer, growing it geometrically so that the
+        cost of an update scales with the number of new rows.
+        """
+
+        required = self._size + len(rows)
+
+        if self._buffer.shape[1] != rows.shape[1]:
+            self._buffer = np.zeros((0, rows.shape[1]))
+
+        if required > len(self._buffer):
+            capacity = max(2 * len(self._buffer), required, 1024)
+            buffer = np.zeros((capacity, rows.shape[1]))
+            buffer[: self._size] = self._buffer[: self._size]
+            self._buffer = buffer
+
+        self._buffer[self._size : required] = rows
+        self._size = required
+
+        return
+
+    def update(self) -> int:
+        """
+        Parses the rows appended since the last update, and returns how
+        many there were. Starts over if the file was replaced.
+        """
+
+        if self.follower.was_replaced():
+            self.follower.reset()
+            self.header_lines = []
+            self._size = 0
+
+        lines = self.follower.read_new_lines()
+
+        if self._size == 0:
+            for line in lines:
+                if line.strip() and line[0] != "#":
+                    break
+
+                self.header_lines.append(line)
+
+        rows, self.number_of_columns = parse_rows(lines, self.number_of_columns)
+
+        if len(rows) > 0:
+            self._append(rows)
+
+        return len(rows)
+
+    @property
+    def data(self) -> np.ndarray:
+        """
+        All rows read so far. This is a view, so it is only valid until
+        the next update.
+        """
+        return self._buffer[: self._size]
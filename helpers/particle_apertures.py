@@ -0,0 +1,179 @@
+"""
+Sums of particle properties within spherical and projected apertures
+around many centres at once.
+
+The particles are put in a periodic KD-tree (``scipy.spatial.cKDTree``),
+which is queried for batches of centres using several threads. All the
+apertures around a centre come from a single query at the largest radius:
+the distance of each neighbour is binned in radius and the cumulative sum
+over the bins gives the totals within each aperture.
+"""
+
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+
+class ParticleTree(object):
+    """
+    Periodic KD-tree over the particle ``coordinates`` (N x 3) in a box of
+    side ``boxsize`` (3,), both in the same units.
+    """
+
+    def __init__(self, coordinates, boxsize, leafsize: int = 32):
+        self.boxsize = np.asarray(boxsize, dtype=np.float64)
+        self.coordinates = np.mod(
+            np.asarray(coordinates, dtype=np.float64), self.boxsize
+        )
+        self.tree = cKDTree(
+            self.coordinates, leafsize=leafsize, boxsize=self.boxsize
+        )
+
+        return
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def neighbours(self, centres, radius: float, workers: int = -1):
+        """
+        All particles within ``radius`` of each of ``centres``, as flat
+        arrays of centre index and particle index.
+        """
+
+        neighbour_lists = self.tree.query_ball_point(
+            np.mod(centres, self.boxsize),
+            radius,
+            workers=workers,
+            return_sorted=False,
+        )
+
+        counts = np.fromiter(
+            (len(x) for x in neighbour_lists), dtype=np.int64, count=len(centres)
+        )
+
+        if counts.sum() == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        centre_indices = np.repeat(np.arange(len(centres), dtype=np.int64), counts)
+        particle_indices = np.concatenate(
+            [x for x in neighbour_lists if len(x) > 0]
+        ).astype(np.int64)
+
+        return centre_indices, particle_indices
+
+    def separations(self, centres, centre_indices, particle_indices):
+        """
+        Nearest periodic image separation vectors from the centres to the
+        particles.
+        """
+
+        separations = self.coordinates[particle_indices] - centres[centre_indices]
+        separations -= self.boxsize * np.round(separations / self.boxsize)
+
+        return separations
+
+
+def _cumulative_sums(centre_indices, radii, bin_edges, weights, number_of_centres):
+    """
+    Totals of each of ``weights`` within each of ``bin_edges`` for every
+    centre, as arrays of shape (number_of_centres, len(bin_edges)).
+    """
+
+    number_of_bins = len(bin_edges) + 1
+    keys = centre_indices * number_of_bins + np.searchsorted(bin_edges, radii)
+
+    totals = {}
+
+    for name, values in weights.items():
+        binned = np.bincount(
+            keys, weights=values, minlength=number_of_centres * number_of_bins
+        ).reshape(number_of_centres, number_of_bins)
+        # The last bin holds the particles outside of all the apertures.
+        totals[name] = np.cumsum(binned[:, :-1], axis=1)
+
+    return totals
+
+
+def aperture_sums(
+    tree: ParticleTree,
+    centres,
+    radii,
+    weights: dict,
+    projected_depth: float = None,
+    projection_axis: int = 2,
+    batch_size: int = 4096,
+    workers: int = -1,
+):
+    """
+    Sums each of ``weights`` (arrays with one value per particle in
+    ``tree``) within spherical apertures of ``radii`` around ``centres``.
+
+    If ``projected_depth`` is given, the sums within circular apertures
+    along ``projection_axis`` are computed as well, including the particles
+    up to ``projected_depth`` in front of and behind each centre.
+
+    Returns a dictionary with the spherical ("3d") and, if requested,
+    projected ("projected") sums, each a dictionary of arrays of shape
+    (number of centres, number of radii) with the same keys as ``weights``.
+    """
+
+    centres = np.asarray(centres, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)
+    # Particles exactly at an aperture radius count as inside.
+    bin_edges = np.nextafter(radii, np.inf)
+
+    search_radius = radii.max()
+    if projected_depth is not None:
+        search_radius = np.hypot(search_radius, projected_depth)
+
+    projected_axes = [axis for axis in range(3) if axis != projection_axis]
+
+    results = {"3d": {name: [] for name in weights}}
+    if projected_depth is not None:
+        results["projected"] = {name: [] for name in weights}
+
+    for start in range(0, len(centres), batch_size):
+        batch = centres[start : start + batch_size]
+
+        centre_indices, particle_indices = tree.neighbours(
+            batch, search_radius, workers=workers
+        )
+        separations = tree.separations(batch, centre_indices, particle_indices)
+        batch_weights = {
+            name: values[particle_indices] for name, values in weights.items()
+        }
+
+        sums = {
+            "3d": _cumulative_sums(
+                centre_indices,
+                np.sqrt((separations ** 2).sum(axis=1)),
+                bin_edges,
+                batch_weights,
+                len(batch),
+            )
+        }
+
+        if projected_depth is not None:
+            in_slab = np.abs(separations[:, projection_axis]) <= projected_depth
+
+            sums["projected"] = _cumulative_sums(
+                centre_indices[in_slab],
+                np.hypot(*separations[in_slab][:, projected_axes].T),
+                bin_edges,
+                {name: values[in_slab] for name, values in batch_weights.items()},
+                len(batch),
+            )
+
+        for kind, kind_sums in sums.items():
+            for name, values in kind_sums.items():
+                results[kind][name].append(values)
+
+    return {
+        kind: {
+            name: np.concatenate(values)
+            if len(values) > 0
+            else np.zeros((0, len(radii)))
+            for name, values in kind_results.items()
+        }
+        for kind, kind_results in results.items()
+    }
@@ -0,0 +1,545 @@
+"""
+Bulk loading of the particles around many halos at once, using the top
+level cell metadata of SWIFT snapshots.
+
+Loading each halo with ``to_swiftsimio_dataset`` reads all of the top
+level cells that overlap it, and neighbouring halos share many of those
+cells, so they are read again and again. Here, the halos are ordered
+along a Morton curve through the cells so that consecutive halos are
+close to each other, and the union of the cells needed by a batch of
+halos is read with a single (hyperslab) read per dataset. The cells are
+kept in a cache of bounded size, so cells shared with the next batch are
+not read again, and the particles of each halo are put together from the
+cached cells.
+
+The particles of each halo are served as an object that looks like a
+swiftsimio dataset (``region.gas.coordinates``, ``region.metadata``,
+etc.), with the particle properties read when they are first used.
+"""
+
+import h5py
+import swiftsimio
+import unyt
+
+import numpy as np
+
+from collections import OrderedDict
+
+from helpers.snapshot_metadata import particle_types
+
+
+def _morton_keys(grid_positions) -> np.ndarray:
+    """
+    Morton (Z-order) keys of integer ``grid_positions`` (N x 3).
+    """
+
+    grid_positions = np.asarray(grid_positions, dtype=np.uint64)
+    keys = np.zeros(len(grid_positions), dtype=np.uint64)
+
+    for bit in range(21):
+        for axis in range(3):
+            keys |= ((grid_positions[:, axis] >> np.uint64(bit)) & np.uint64(1)) << (
+                np.uint64(3 * bit + axis)
+            )
+
+    return keys
+
+
+def _merge_ranges(starts, counts):
+    """
+    Sorts the ranges of rows (``starts``, ``counts``) and merges the
+    adjacent ones.
+    """
+
+    order = np.argsort(starts, kind="stable")
+    starts = np.asarray(starts, dtype=np.int64)[order]
+    counts = np.asarray(counts, dtype=np.int64)[order]
+
+    keep = counts > 0
+    starts = starts[keep]
+    counts = counts[keep]
+
+    if len(starts) == 0:
+        return starts, counts
+
+    # A range starts a new block unless it follows on from the previous one.
+    new_block = np.ones(len(starts), dtype=bool)
+    new_block[1:] = starts[1:] != starts[:-1] + counts[:-1]
+    block = np.cumsum(new_block) - 1
+
+    return starts[new_block], np.bincount(block, weights=counts).astype(np.int64)
+
+
+def read_ranges(dataset: h5py.Dataset, starts, counts) -> np.ndarray:
+    """
+    Reads the ranges of rows (``starts``, ``counts``, sorted and not
+    overlapping) of ``dataset`` in a single read, with the union of the
+    ranges as the file selection.
+    """
+
+    row_shape = dataset.shape[1:]
+    output = np.empty((int(np.sum(counts)),) + row_shape, dtype=dataset.dtype)
+
+    if len(output) == 0:
+        return output
+
+    file_space = dataset.id.get_space()
+    file_space.select_none()
+
+    for start, count in zip(starts, counts):
+        file_space.select_hyperslab(
+            (int(start),) + (0,) * len(row_shape),
+            (int(count),) + row_shape,
+            op=h5py.h5s.SELECT_OR,
+        )
+
+    memory_space = h5py.h5s.create_simple(output.shape)
+    dataset.id.read(memory_space, file_space, output)
+
+    return output
+
+
+def _owner(values: np.ndarray) -> np.ndarray:
+    """
+    The array that owns the memory of ``values``.
+    """
+
+    while isinstance(values.base, np.ndarray):
+        values = values.base
+
+    return values
+
+
+def _contiguous_view(parts):
+    """
+    A read-only view of the concatenation of ``parts``, if they are
+    consecutive rows of one array (as the cells that were read together),
+    or None.
+    """
+
+    owner = _owner(parts[0])
+
+    if owner is parts[0] or not owner.flags.c_contiguous or owner.ndim == 0:
+        return None
+
+    row_bytes = owner.strides[0]
+    owner_address = owner.__array_interface__["data"][0]
+    start = parts[0].__array_interface__["data"][0]
+    address = start
+
+    for part in parts:
+        if _owner(part) is not owner or not part.flags.c_contiguous:
+            return None
+
+        if len(part) > 0 and part.__array_interface__["data"][0] != address:
+            return None
+
+        address += len(part) * row_bytes
+
+    first_row = (start - owner_address) // row_bytes
+    view = owner[first_row : first_row + sum(len(part) for part in parts)]
+    view.flags.writeable = False
+
+    return view
+
+
+class SnapshotCells(object):
+    """
+    The top level cells of a (single file) SWIFT snapshot: their position
+    on the cell grid, and the range of particles of each type in each of
+    them.
+    """
+
+    def __init__(self, snapshot_filename: str):
+        self.counts = {}
+        self.offsets = {}
+
+        with h5py.File(snapshot_filename, "r") as handle:
+            cells = handle["Cells"]
+
+            self.boxsize = np.ones(3) * handle["Header"].attrs["BoxSize"]
+            self.cell_size = np.ones(3) * cells["Meta-data"].attrs["size"]
+            centres = cells["Centres"][:]
+
+            # Older versions of SWIFT call these the offsets.
+            offsets_name = "OffsetsInFile" if "OffsetsInFile" in cells else "Offsets"
+
+            for name, particle_type in particle_types.items():
+                group_name = f"PartType{particle_type}"
+
+                if group_name in cells["Counts"]:
+                    self.counts[name] = cells[f"Counts/{group_name}"][:].astype(
+                        np.int64
+                    )
+                    self.offsets[name] = cells[f"{offsets_name}/{group_name}"][
+                        :
+                    ].astype(np.int64)
+
+        self.dimension = np.rint(self.boxsize / self.cell_size).astype(np.int64)
+        self.grid_positions = np.floor(centres / self.cell_size).astype(np.int64)
+        self.grid_positions %= self.dimension
+
+        self.cell_grid = np.full(self.dimension, -1, dtype=np.int64)
+        self.cell_grid[tuple(self.grid_positions.T)] = np.arange(len(centres))
+
+        return
+
+    def __len__(self):
+        return len(self.grid_positions)
+
+    def cells_in_region(self, centre, half_width) -> np.ndarray:
+        """
+        The (sorted) cells that overlap the cube of ``half_width`` around
+        ``centre``, in the periodic box.
+        """
+
+        centre = np.asarray(centre, dtype=np.float64) * np.ones(3)
+        half_width = np.asarray(half_width, dtype=np.float64) * np.ones(3)
+
+        axis_cells = []
+
+        lowers = np.floor((centre - half_width) / self.cell_size).astype(np.int64)
+        uppers = np.floor((centre + half_width) / self.cell_size).astype(np.int64)
+
+        for axis, (lower, upper) in enumerate(zip(lowers, uppers)):
+            if upper - lower + 1 >= self.dimension[axis]:
+                axis_cells.append(np.arange(self.dimension[axis]))
+            else:
+                axis_cells.append(np.arange(lower, upper + 1) % self.dimension[axis])
+
+        cells = self.cell_grid[np.ix_(*axis_cells)].ravel()
+
+        return np.unique(cells[cells >= 0])
+
+    def locality_order(self, centres) -> np.ndarray:
+        """
+        Order of ``centres`` (N x 3) along a Morton curve through the cells,
+        so that consecutive centres tend to share cells.
+        """
+
+        centres = np.asarray(centres, dtype=np.float64).reshape((-1, 3))
+        grid_positions = np.floor(centres / self.cell_size).astype(np.int64)
+        grid_positions %= self.dimension
+
+        return np.argsort(_morton_keys(grid_positions), kind="stable")
+
+
+class CellCache(object):
+    """
+    Least recently used cache of the particle properties of cells, that
+    holds at most ``maximal_bytes`` bytes.
+    """
+
+    def __init__(self, maximal_bytes: int):
+        self.maximal_bytes = maximal_bytes
+        self.bytes = 0
+        self.cells = OrderedDict()
+
+        return
+
+    def __contains__(self, key):
+        return key in self.cells
+
+    def get(self, key):
+        values = self.cells.get(key)
+
+        if values is not None:
+            self.cells.move_to_end(key)
+
+        return values
+
+    def put(self, key, values: np.ndarray):
+        if key in self.cells:
+            self.bytes -= self.cells.pop(key).nbytes
+
+        self.cells[key] = values
+        self.bytes += values.nbytes
+
+        while self.bytes > self.maximal_bytes and len(self.cells) > 1:
+            _, evicted = self.cells.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+        return
+
+
+class _ParticleRegion(object):
+    """
+    The particles of one type in the cells of a region, with the same
+    properties as a swiftsimio particle dataset. Each property is put
+    together from the cell cache when it is first used, and can be
+    replaced (e.g. with new smoothing lengths).
+    """
+
+    def __init__(self, loader, particle_type: str, cells: np.ndarray):
+        self._loader = loader
+        self._particle_type = particle_type
+        self._cells = cells
+
+        return
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        values = self._loader.read_property(self._particle_type, name, self._cells)
+        setattr(self, name, values)
+
+        return values
+
+
+class HaloRegion(object):
+    """
+    The particles in the cells around one halo, in place of the swiftsimio
+    dataset returned by ``to_swiftsimio_dataset``.
+    """
+
+    def __init__(self, loader, cells: np.ndarray):
+        self.filename = loader.filename
+        self.metadata = loader.snapshot.metadata
+        self.units = loader.snapshot.units
+        self.cells = cells
+
+        for particle_type in loader.cells.counts:
+            setattr(self, particle_type, _ParticleRegion(loader, particle_type, cells))
+
+        return
+
+
+class RegionLoader(object):
+    """
+    Loads the particles around many halos in ``snapshot_filename``, with
+    a cell cache of at most ``cache_bytes`` bytes.
+
+    ``properties`` is a dictionary of the particle properties (e.g.
+    ``{"gas": ["coordinates", "masses"]}``) that are read in bulk for each
+    batch of halos, if they fit in the cache; other properties (and all of
+    them for batches that do not fit) are read when they are used.
+    """
+
+    def __init__(
+        self,
+        snapshot_filename: str,
+        properties: dict = None,
+        cache_bytes: int = 1 << 28,
+    ):
+        self.filename = snapshot_filename
+        self.snapshot = swiftsimio.load(snapshot_filename)
+        self.cells = SnapshotCells(snapshot_filename)
+        self.cache = CellCache(cache_bytes)
+        self.properties = properties if properties is not None else {}
+
+        # What was read, and the total size of what was asked for.
+        self.bytes_read = 0
+        self.requested = set()
+        self.requested_bytes = 0
+
+        # Size of one particle of each property, in bytes.
+        self._row_bytes = {}
+
+        return
+
+    def _property(self, particle_type: str, name: str):
+        """
+        Path in the snapshot and units of a particle property.
+        """
+
+        metadata = getattr(self.snapshot.metadata, f"{particle_type}_properties")
+
+        try:
+            index = metadata.field_names.index(name)
+        except ValueError:
+            raise AttributeError(f"No property {name} for {particle_type}")
+
+        return metadata.field_paths[index], metadata.field_units[index]
+
+    def _internal_length(self, values) -> np.ndarray:
+        if hasattr(values, "units"):
+            values = (values / self.snapshot.units.length).to("dimensionless")
+
+        return np.asarray(values, dtype=np.float64)
+
+    def row_bytes(self, particle_type: str, name: str) -> int:
+        """
+        Size of the property ``name`` of one particle, in bytes.
+        """
+
+        key = (particle_type, name)
+
+        if key not in self._row_bytes:
+            with h5py.File(self.filename, "r") as handle:
+                dataset = handle[self._property(particle_type, name)[0]]
+                self._row_bytes[key] = dataset.dtype.itemsize * int(
+                    np.prod(dataset.shape[1:])
+                )
+
+        return self._row_bytes[key]
+
+    def properties_bytes(self, cells) -> int:
+        """
+        Size of the properties in ``self.properties`` for ``cells``.
+        """
+
+        total = 0
+
+        for particle_type, names in self.properties.items():
+            if particle_type not in self.cells.counts:
+                continue
+
+            number_of_particles = int(self.cells.counts[particle_type][cells].sum())
+
+            for name in names:
+                total += number_of_particles * self.row_bytes(particle_type, name)
+
+        return total
+
+    def prefetch(self, particle_type: str, name: str, cells) -> dict:
+        """
+        Reads ``name`` for all the ``cells`` that are not in the cache, with
+        one read of the dataset. Returns the values of the cells that were
+        read, which may not all fit in the cache.
+        """
+
+        path, _ = self._property(particle_type, name)
+        counts = self.cells.counts[particle_type]
+        offsets = self.cells.offsets[particle_type]
+
+        missing = np.array(
+            [cell for cell in cells if (particle_type, name, cell) not in self.cache],
+            dtype=np.int64,
+        )
+
+        if len(missing) == 0:
+            return {}
+
+        missing = missing[np.argsort(offsets[missing], kind="stable")]
+        starts, block_counts = _merge_ranges(offsets[missing], counts[missing])
+
+        with h5py.File(self.filename, "r") as handle:
+            values = read_ranges(handle[path], starts, block_counts)
+
+        self.bytes_read += values.nbytes
+
+        # The cells are in the order of their offsets, as they were read.
+        boundaries = np.cumsum(counts[missing])[:-1]
+        read = dict(zip(missing, np.split(values, boundaries)))
+
+        for cell, cell_values in read.items():
+            self.cache.put((particle_type, name, cell), cell_values)
+
+        return read
+
+    def read_property(self, particle_type: str, name: str, cells) -> unyt.unyt_array:
+        """
+        The property ``name`` of the particles of ``particle_type`` in
+        ``cells``, in the same units as swiftsimio would give it.
+
+        If the cells were read together and are consecutive in the snapshot
+        (as for a region of a single cell), this is a read-only view of the
+        cached values; otherwise it is a copy.
+        """
+
+        _, units = self._property(particle_type, name)
+
+        # Cells that were just read are used directly, even if they have
+        # been evicted from the cache by the rest of the region.
+        read = self.prefetch(particle_type, name, cells)
+
+        parts = []
+
+        for cell in cells:
+            key = (particle_type, name, cell)
+            values = read.get(cell)
+
+            if values is None:
+                values = self.cache.get(key)
+
+            if values is None:
+                # Evicted after it was checked for, while reading the others.
+                values = self.prefetch(particle_type, name, [cell])[cell]
+
+            if key not in self.requested:
+                self.requested.add(key)
+                self.requested_bytes += values.nbytes
+
+            parts.append(values)
+
+        if len(parts) == 0:
+            with h5py.File(self.filename, "r") as handle:
+                dataset = handle[self._property(particle_type, name)[0]]
+                parts.append(np.empty((0,) + dataset.shape[1:], dtype=dataset.dtype))
+
+        values = _contiguous_view(parts)
+
+        if values is None:
+            values = np.concatenate(parts)
+
+        return unyt.unyt_array(values, units)
+
+    def load(self, centres, half_widths):
+        """
+        Reads the properties in ``self.properties`` for the union of the
+        cells around all of ``centres`` (in comoving internal units, as the
+        snapshot if they do not have units), with one read per dataset if
+        they fit in the cache, and returns a `HaloRegion` for each of them.
+        """
+
+        centres = self._internal_length(centres).reshape((-1, 3))
+        half_widths = self._internal_length(half_widths) * np.ones(len(centres))
+
+        halo_cells = [
+            self.cells.cells_in_region(centre, half_width)
+            for centre, half_width in zip(centres, half_widths)
+        ]
+
+        union = (
+            np.unique(np.concatenate(halo_cells))
+            if len(halo_cells) > 0
+            else np.zeros(0, dtype=np.int64)
+        )
+
+        # A batch that does not fit in the cache would evict its own cells
+        # while they are read, so then each region reads what it needs.
+        if self.properties_bytes(union) <= self.cache.maximal_bytes:
+            for particle_type, names in self.properties.items():
+                if particle_type not in self.cells.counts:
+                    continue
+
+                for name in names:
+                    self.prefetch(particle_type, name, union)
+
+        return [HaloRegion(self, cells) for cells in halo_cells]
+
+    def union_bytes(self, centres, half_widths) -> int:
+        """
+        Size of the properties in ``self.properties`` for the union of the
+        cells around all of ``centres``; the least that can be read to load
+        all of them.
+        """
+
+        centres = self._internal_length(centres).reshape((-1, 3))
+        half_widths = self._internal_length(half_widths) * np.ones(len(centres))
+
+        union = np.unique(
+            np.concatenate(
+                [np.zeros(0, dtype=np.int64)]
+                + [
+                    self.cells.cells_in_region(centre, half_width)
+                    for centre, half_width in zip(centres, half_widths)
+                ]
+            )
+        )
+
+        return self.properties_bytes(union)
+
+    def batches(self, centres, batch_size: int):
+        """
+        Splits the indices of ``centres`` into batches of ``batch_size``
+        halos that are close to each other.
+        """
+
+        order = self.cells.locality_order(self._internal_length(centres))
+
+        return [
+            order[start : start + batch_size]
+            for start in range(0, len(order), batch_size)
+        ]
@@ -0,0 +1,93 @@
+"""
+Keys, validation and atomic writes for the caches that the pipeline keeps
+next to its inputs (e.g. the smoothing lengths of a snapshot, or the
+parsed arrays of a timesteps log).
+
+A cache is stored with its signature: the version of its layout, the
+name, size and modification time of each of the files that it was made
+from, and any other inputs, as a JSON string. The cache is valid as long
+as the signature of its inputs is the same. Caches are written under a
+temporary name and moved into place, so that no process ever reads a
+partially written cache.
+"""
+
+import json
+import os
+import shutil
+
+from contextlib import contextmanager
+
+
+def file_identity(filename: str) -> list:
+    """
+    Name, size and modification time (in ns) of ``filename``.
+    """
+
+    stat = os.stat(filename)
+
+    return [os.path.basename(filename), stat.st_size, stat.st_mtime_ns]
+
+
+def cache_signature(version: int, sources=(), **inputs) -> str:
+    """
+    The signature of a cache with layout ``version``, made from the files
+    ``sources`` and the (JSON-serialisable) ``inputs``.
+    """
+
+    signature = {
+        "version": version,
+        "sources": [file_identity(filename) for filename in sources],
+        **inputs,
+    }
+
+    return json.dumps(signature, sort_keys=True)
+
+
+def is_valid(stored_signature, signature: str) -> bool:
+    """
+    Whether a cache stored with ``stored_signature`` (None if there is no
+    cache) was made from the inputs with ``signature``.
+    """
+
+    return stored_signature is not None and str(stored_signature) == signature
+
+
+def _remove(filename: str):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename, ignore_errors=True)
+    elif os.path.exists(filename):
+        os.remove(filename)
+
+    return
+
+
+@contextmanager
+def atomic_output(filename: str, ignore_errors: bool = False):
+    """
+    Yields the temporary name that the cache ``filename`` (a file or a
+    directory) is written to, which is moved into place once it has been
+    written, and removed if writing fails.
+
+    If ``ignore_errors`` is True, an OSError (e.g. for a read-only
+    directory) leaves the cache unwritten instead of being raised.
+    """
+
+    temporary_filename = f"{filename}.{os.getpid()}.tmp"
+
+    try:
+        yield temporary_filename
+
+        if os.path.isdir(temporary_filename) and os.path.isdir(filename):
+            shutil.rmtree(filename)
+
+        os.replace(temporary_filename, filename)
+    except OSError:
+        _remove(temporary_filename)
+
+        if not ignore_errors:
+            raise
+    except:
+        _remove(temporary_filename)
+        raise
+
+    return
@@ -0,0 +1,252 @@
+"""
+Smoothing lengths of star and dark matter particles, computed once per
+snapshot and stored in an HDF5 sidecar next to it.
+
+SWIFT only writes smoothing lengths for the gas. The images need them for
+the other particle types too, and generating them for every halo that is
+imaged means building a neighbour tree over (overlapping) sets of
+particles again and again. Instead, the smoothing lengths of all the
+particles of a type are computed in one go with a periodic KD-tree (the
+distance to the 57th nearest neighbour, as in swiftsimio's
+``generate_smoothing_lengths``), and are stored sorted by particle ID so
+that any subset of particles can be looked up.
+
+Build the sidecar with ``images/smoothing_length_sidecar.py``.
+"""
+
+import h5py
+import unyt
+
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+from .sidecar_cache import atomic_output, cache_signature, is_valid
+
+sidecar_suffix = ".smoothing_lengths.hdf5"
+# Bump this if the contents of the sidecar change.
+sidecar_version = 1
+
+# Wendland-C2 kernel, as used by SWIFT and swiftsimio.
+kernel_gamma = 1.897367
+neighbours = 57
+
+# Particle types (as named by swiftsimio) in the sidecar.
+particle_types = {"dark_matter": 1, "stars": 4}
+
+# Sidecars already read by this process, by snapshot filename.
+_loaded_sidecars = {}
+
+
+def sidecar_filename(snapshot_filename: str) -> str:
+    return f"{snapshot_filename}{sidecar_suffix}"
+
+
+def compute_smoothing_lengths(
+    coordinates,
+    boxsize,
+    number_of_neighbours: int = neighbours,
+    block_size: int = 1 << 18,
+) -> np.ndarray:
+    """
+    Smoothing lengths that encompass ``number_of_neighbours`` neighbours,
+    for particles at ``coordinates`` in a periodic box of side ``boxsize``
+    (all in the same units).
+    """
+
+    boxsize = np.asarray(boxsize, dtype=np.float64)
+    coordinates = np.mod(np.asarray(coordinates, dtype=np.float64), boxsize)
+
+    tree = cKDTree(coordinates, boxsize=boxsize)
+    smoothing_lengths = np.empty(len(coordinates), dtype=np.float32)
+
+    # Fewer particles than neighbours in the snapshot; use all of them.
+    k = min(number_of_neighbours, len(coordinates))
+
+    for start in range(0, len(coordinates), block_size):
+        stop = start + block_size
+        distances, _ = tree.query(coordinates[start:stop], k=[k], workers=-1)
+        smoothing_lengths[start:stop] = distances[:, 0] / kernel_gamma
+
+    return smoothing_lengths
+
+
+def _source_signature(snapshot_filename: str) -> str:
+    return cache_signature(sidecar_version, [snapshot_filename], neighbours=neighbours)
+
+
+def write_sidecar(snapshot_filename: str, filename: str = None):
+    """
+    Computes the smoothing lengths of all the star and dark matter
+    particles in the snapshot, and writes them to the sidecar.
+    """
+
+    if filename is None:
+        filename = sidecar_filename(snapshot_filename)
+
+    with atomic_output(filename) as temporary_filename, h5py.File(
+        snapshot_filename, "r"
+    ) as snapshot, h5py.File(temporary_filename, "w") as sidecar:
+        boxsize = np.atleast_1d(snapshot["Header"].attrs["BoxSize"]) * np.ones(3)
+        length_unit = float(
+            np.atleast_1d(snapshot["Units"].attrs["Unit length in cgs (U_L)"])[0]
+        )
+
+        sidecar.attrs["signature"] = _source_signature(snapshot_filename)
+
+        # Comoving, in internal units, as the coordinates.
+        sidecar.attrs["length_unit_cgs"] = length_unit
+
+        for particle_type in particle_types.values():
+            group_name = f"PartType{particle_type}"
+
+            if group_name not in snapshot:
+                continue
+
+            particle_ids = snapshot[f"{group_name}/ParticleIDs"][:]
+            smoothing_lengths = compute_smoothing_lengths(
+                snapshot[f"{group_name}/Coordinates"][:], boxsize
+            )
+
+            order = np.argsort(particle_ids)
+
+            group = sidecar.create_group(group_name)
+            group.create_dataset("ParticleIDs", data=particle_ids[order])
+            group.create_dataset(
+                "SmoothingLengths",
+                data=smoothing_lengths[order],
+                compression="gzip",
+                shuffle=True,
+            )
+
+    return
+
+
+class SmoothingLengthSidecar(object):
+    """
+    The smoothing lengths in the sidecar of a snapshot, sorted by
+    particle ID. The particles of each type are only read when they are
+    first looked up; their IDs are memory-mapped if they are stored
+    contiguously, so that the processes of a pool share them.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.particle_ids = {}
+        self.smoothing_lengths = {}
+
+        with h5py.File(filename, "r") as handle:
+            self.length_unit = unyt.unyt_quantity(
+                handle.attrs["length_unit_cgs"], "cm"
+            )
+            self.stored_types = {
+                int(group_name.replace("PartType", "")) for group_name in handle
+            }
+
+        return
+
+    def read(self, particle_type: int):
+        """
+        Reads (or memory-maps) the IDs and smoothing lengths of the
+        particles of ``particle_type``.
+        """
+
+        with h5py.File(self.filename, "r") as handle:
+            group = handle[f"PartType{particle_type}"]
+            dataset = group["ParticleIDs"]
+            offset = dataset.id.get_offset()
+
+            if offset is None or dataset.size == 0:
+                particle_ids = dataset[:]
+            else:
+                particle_ids = np.memmap(
+                    self.filename,
+                    mode="r",
+                    dtype=dataset.dtype,
+                    offset=offset,
+                    shape=dataset.shape,
+                )
+
+            self.particle_ids[particle_type] = particle_ids
+            self.smoothing_lengths[particle_type] = group["SmoothingLengths"][:]
+
+        return
+
+    def lookup(self, particle_type: int, particle_ids):
+        """
+        Smoothing lengths of ``particle_ids`` (as a unyt array in the
+        internal, comoving, length unit), or None if any of them are
+        missing from the sidecar.
+        """
+
+        if particle_type not in self.stored_types:
+            return None
+
+        if particle_type not in self.particle_ids:
+            self.read(particle_type)
+
+        sorted_ids = self.particle_ids[particle_type]
+        particle_ids = np.asarray(particle_ids)
+
+        if len(sorted_ids) == 0:
+            return None if len(particle_ids) > 0 else unyt.unyt_array([], "cm")
+
+        positions = np.searchsorted(sorted_ids, particle_ids)
+        positions[positions == len(sorted_ids)] = 0
+
+        if not np.all(sorted_ids[positions] == particle_ids):
+            return None
+
+        return self.smoothing_lengths[particle_type][positions] * self.length_unit
+
+
+def load_sidecar(snapshot_filename: str):
+    """
+    Returns the sidecar of ``snapshot_filename``, or None if there is no
+    sidecar or it is out of date.
+    """
+
+    if snapshot_filename not in _loaded_sidecars:
+        sidecar = None
+        filename = sidecar_filename(snapshot_filename)
+
+        try:
+            with h5py.File(filename, "r") as handle:
+                valid = is_valid(
+                    handle.attrs.get("signature"), _source_signature(snapshot_filename)
+                )
+
+            if valid:
+                sidecar = SmoothingLengthSidecar(filename)
+        except OSError:
+            pass
+
+        _loaded_sidecars[snapshot_filename] = sidecar
+
+    return _loaded_sidecars[snapshot_filename]
+
+
+def smoothing_lengths_from_sidecar(data, particle_type: str):
+    """
+    Smoothing lengths of the particles of ``particle_type`` (e.g. "stars")
+    in the swiftsimio dataset ``data``, in the units of their coordinates,
+    or None if the sidecar can not provide them.
+    """
+
+    if particle_type not in particle_types:
+        return None
+
+    sidecar = load_sidecar(str(data.filename))
+
+    if sidecar is None:
+        return None
+
+    particle_data = getattr(data, particle_type)
+    smoothing_lengths = sidecar.lookup(
+        particle_types[particle_type], particle_data.particle_ids
+    )
+
+    if smoothing_lengths is None:
+        return None
+
+    return smoothing_lengths.to(particle_data.coordinates.units)
@@ -0,0 +1,293 @@
+"""
+Reads the metadata of a SWIFT snapshot (header, units and code
+information) without loading the snapshot with swiftsimio.
+
+Only the attributes of a handful of HDF5 groups are read, and the result
+is cached next to the snapshot as a small JSON file, so scripts that only
+need e.g. the time unit or the box size can start almost instantly.
+"""
+
+import h5py
+import json
+import unyt
+
+import numpy as np
+
+from typing import Optional
+
+from .sidecar_cache import atomic_output, cache_signature, is_valid
+
+sidecar_suffix = ".metadata.json"
+# Bump this if the contents of the sidecar change.
+sidecar_version = 2
+
+unit_names = {
+    "mass": "Unit mass in cgs (U_M)",
+    "length": "Unit length in cgs (U_L)",
+    "time": "Unit time in cgs (U_t)",
+    "current": "Unit current in cgs (U_I)",
+    "temperature": "Unit temperature in cgs (U_T)",
+}
+
+unit_cgs = {
+    "mass": "g",
+    "length": "cm",
+    "time": "s",
+    "current": "A",
+    "temperature": "K",
+}
+
+# Index of each particle type in NumPart_Total.
+particle_types = {
+    "gas": 0,
+    "dark_matter": 1,
+    "boundary": 2,
+    "sinks": 3,
+    "stars": 4,
+    "black_holes": 5,
+}
+
+
+class SnapshotUnits(object):
+    """
+    The internal units of a snapshot, as unyt quantities in the same
+    way as swiftsimio's ``snapshot.units``.
+    """
+
+    def __init__(self, units_cgs: dict):
+        for name, cgs in unit_cgs.items():
+            setattr(self, name, unyt.unyt_quantity(units_cgs.get(name, 1.0), cgs))
+
+        return
+
+    @property
+    def star_formation_rate(self):
+        """
+        The unit of star formation rates (mass per time).
+        """
+        return self.mass / self.time
+
+
+class SnapshotMetadata(object):
+    """
+    Header information of a snapshot, with the names that swiftsimio
+    uses for ``snapshot.metadata`` where there is an equivalent.
+    """
+
+    def __init__(self, filename: str, contents: dict):
+        self.filename = filename
+        self.contents = contents
+
+        self.units = SnapshotUnits(contents["units"])
+
+        self.boxsize = unyt.unyt_array(contents["boxsize"], "dimensionless") * (
+            self.units.length
+        )
+        self.boxsize.convert_to_units("Mpc")
+
+        self.time = contents["time"] * self.units.time
+        self.a = contents["scale_factor"]
+        self.z = contents["redshift"]
+        self.run_name = contents["run_name"]
+
+        for name, index in particle_types.items():
+            setattr(self, f"n_{name}", contents["particle_numbers"][index])
+
+        self.code = contents["code"]
+        self.hydro_scheme = contents["hydro_scheme"]
+        self.cosmology = contents["cosmology"]
+
+        return
+
+    @property
+    def box_volume(self):
+        return self.boxsize[0] * self.boxsize[1] * self.boxsize[2]
+
+    def cosmic_time(self, scale_factors, number_of_samples: int = 4096):
+        """
+        Age of the universe (in internal units) at ``scale_factors``,
+        integrating the Friedmann equation with the snapshot's cosmology.
+        """
+
+        cosmology = self.cosmology
+        H0 = cosmology.get("H0 [internal units]", 0.0)
+
+        if H0 <= 0.0:
+            raise ValueError(f"No cosmology in {self.filename}")
+
+        a = np.linspace(0.0, max(1.0, np.max(scale_factors)), number_of_samples)
+        E = np.sqrt(
+            cosmology.get("Omega_m", 0.0) * a[1:] ** -3
+            + cosmology.get("Omega_r", 0.0) * a[1:] ** -4
+            + cosmology.get("Omega_k", 0.0) * a[1:] ** -2
+            + cosmology.get("Omega_lambda", 0.0)
+        )
+
+        # dt = da / (a H), which goes to zero as a -> 0.
+        integrand = np.concatenate([[0.0], 1.0 / (a[1:] * H0 * E)])
+        t = np.concatenate(
+            [[0.0], np.cumsum(0.5 * (integrand[1:] + integrand[:-1]) * np.diff(a))]
+        )
+
+        return np.interp(scale_factors, a, t)
+
+    @property
+    def code_info(self) -> str:
+        code = self.code
+
+        return (
+            f"{code.get('Code', 'SWIFT')} ({code.get('Git Branch', '')})\n"
+            f"{code.get('Git Revision', '')}\n"
+            f"{code.get('Git Date', '')}"
+        )
+
+    @property
+    def compiler_info(self) -> str:
+        code = self.code
+
+        return (
+            f"{code.get('Compiler Name', '')} {code.get('Compiler Version', '')}\n"
+            f"MPI library: {code.get('MPI library', 'Non-MPI version of SWIFT')}\n"
+            f"FFTW v{code.get('FFTW library version', '')}, "
+            f"GSL v{code.get('GSL library version', '')}, "
+            f"HDF5 v{code.get('HDF5 library version', '')}"
+        )
+
+    @property
+    def hydro_info(self) -> str:
+        scheme = self.hydro_scheme
+
+        return (
+            f"{scheme.get('Scheme', '')}\n"
+            f"Kernel: {scheme.get('Kernel function', '')}\n"
+            f"Neighbours: {scheme.get('Kernel target N_ngb', '')}\n"
+            f"Eta: {scheme.get('Kernel eta', '')}"
+        )
+
+
+def _attribute_value(value):
+    """
+    Converts an HDF5 attribute to something that can be stored as JSON.
+    """
+
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+
+    value = np.asarray(value)
+
+    if value.dtype.kind == "S":
+        value = np.char.decode(value, "utf-8", errors="replace")
+
+    if value.size == 1:
+        return value.flat[0].item()
+
+    return value.tolist()
+
+
+def _group_attributes(handle: h5py.File, name: str) -> dict:
+    if name not in handle:
+        return {}
+
+    return {
+        key: _attribute_value(value) for key, value in handle[name].attrs.items()
+    }
+
+
+def read_header(filename: str) -> dict:
+    """
+    Reads the header, units and code groups of the snapshot ``filename``.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        header = _group_attributes(handle, "Header")
+        units = _group_attributes(handle, "Units")
+        code = _group_attributes(handle, "Code")
+        hydro_scheme = _group_attributes(handle, "HydroScheme")
+        cosmology = _group_attributes(handle, "Cosmology")
+
+    number = np.atleast_1d(header.get("NumPart_Total", np.zeros(6))).astype(np.int64)
+    high_word = np.atleast_1d(
+        header.get("NumPart_Total_HighWord", np.zeros(len(number)))
+    ).astype(np.int64)
+    particle_numbers = number + (high_word << 32)
+    particle_numbers = np.pad(
+        particle_numbers, (0, max(0, len(particle_types) - len(particle_numbers)))
+    )
+
+    scale_factor = header.get("Scale-factor", 1.0)
+
+    return {
+        "boxsize": list(np.atleast_1d(header.get("BoxSize", 1.0)) * np.ones(3)),
+        "time": header.get("Time", 0.0),
+        "scale_factor": scale_factor,
+        "redshift": header.get("Redshift", 1.0 / scale_factor - 1.0),
+        "run_name": str(header.get("RunName", "")),
+        "particle_numbers": [int(x) for x in particle_numbers],
+        "units": {name: units.get(key, 1.0) for name, key in unit_names.items()},
+        "code": {key: str(value) for key, value in code.items()},
+        "hydro_scheme": {key: str(value) for key, value in hydro_scheme.items()},
+        "cosmology": {
+            key: value
+            for key, value in cosmology.items()
+            if isinstance(value, (int, float))
+        },
+    }
+
+
+def _sidecar_filename(filename: str) -> str:
+    return f"{filename}{sidecar_suffix}"
+
+
+def _read_sidecar(filename: str, signature: str) -> Optional[dict]:
+    try:
+        with open(_sidecar_filename(filename), "r") as handle:
+            sidecar = json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+    if not is_valid(sidecar.get("signature"), signature):
+        return None
+
+    return sidecar.get("contents")
+
+
+def _write_sidecar(filename: str, signature: str, contents: dict):
+    sidecar = {"signature": signature, "contents": contents}
+
+    # Read-only run directory; we simply read the header every time.
+    with atomic_output(_sidecar_filename(filename), ignore_errors=True) as temporary:
+        with open(temporary, "w") as handle:
+            json.dump(sidecar, handle, indent=2)
+
+    return
+
+
+def load_metadata(filename: str, use_cache: bool = True) -> SnapshotMetadata:
+    """
+    Loads the metadata of the snapshot ``filename``, from its JSON sidecar
+    if that is still valid.
+    """
+
+    signature = cache_signature(sidecar_version, [filename])
+    contents = _read_sidecar(filename, signature) if use_cache else None
+
+    if contents is None:
+        contents = read_header(filename)
+
+        if use_cache:
+            _write_sidecar(filename, signature, contents)
+
+    return SnapshotMetadata(filename, contents)
+
+
+def read_strided(filename: str, dataset: str, stride: int = 100) -> np.ndarray:
+    """
+    Reads every ``stride``-th entry of ``dataset`` (e.g. PartType1/Masses)
+    straight from the snapshot, in internal units.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        if dataset not in handle:
+            return np.zeros(0)
+
+        return handle[dataset][::stride]
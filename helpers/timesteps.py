@@ -0,0 +1,271 @@
+"""
+Reads the SWIFT ``timesteps_*.txt`` logs into a `TimestepTimeline`.
+
+These logs have one row per step and can be tens of millions of lines
+long, so the parsed arrays are cached in a small ``.npz`` file in a cache
+directory (usually the output path of the plots, rather than the run
+directory). The cache is re-used as long as the log has not changed, and
+only the appended lines are parsed if the log has grown.
+"""
+
+import numpy as np
+import hashlib
+import json
+import os
+
+from glob import glob
+from typing import Optional
+
+from .log_following import FollowedTable, parse_rows
+from .sidecar_cache import atomic_output, cache_signature, is_valid
+
+# Column indices in the timesteps files, as used by the performance scripts.
+column_indices = {
+    "step": 0,
+    "time": 1,
+    "scale_factor": 2,
+    "redshift": 3,
+    "time_step": 4,
+    "updates": 7,
+    "g_updates": 8,
+    "s_updates": 9,
+    "wallclock": -2,
+}
+
+cache_suffix = ".cache.npz"
+# Bump this if the layout of the cached arrays changes.
+cache_version = 2
+
+
+class TimestepTimeline(object):
+    """
+    Holds the columns of a timesteps file as arrays, with one entry
+    per step. Times are in internal units, wallclock times in ms.
+    """
+
+    def __init__(self, filename: str, data: np.ndarray, header: dict):
+        self.filename = filename
+        self.data = data
+        self.header = header
+
+        for name, index in column_indices.items():
+            if data.ndim == 2 and data.shape[1] > max(index, -index - 1):
+                setattr(self, name, data[:, index])
+            else:
+                setattr(self, name, np.zeros(len(data)))
+
+        return
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def cumulative_wallclock(self):
+        """
+        Total wallclock time (in ms) since the start of the log at each step.
+        """
+        return np.cumsum(self.wallclock)
+
+    @property
+    def particle_updates(self):
+        """
+        Number of particles updated in each step. This is the number of
+        gravity updates where available (as that includes all particle
+        types), and the number of hydro updates otherwise.
+        """
+        return np.maximum(self.updates, self.g_updates)
+
+    def _header_integer(self, *keys) -> Optional[int]:
+        for key in keys:
+            try:
+                return int(self.header[key].split()[0])
+            except (KeyError, ValueError, IndexError):
+                continue
+
+        return None
+
+    @property
+    def number_of_threads(self) -> Optional[int]:
+        return self._header_integer("Number of threads", "Number of threads per rank")
+
+    @property
+    def number_of_ranks(self) -> Optional[int]:
+        return self._header_integer("Number of MPI ranks", "Number of ranks")
+
+
+def find_timesteps_file(run_directory: str) -> str:
+    """
+    Returns the timesteps file in ``run_directory``.
+    """
+
+    timesteps_glob = sorted(glob(f"{run_directory}/timesteps_*.txt"))
+
+    if len(timesteps_glob) == 0:
+        raise FileNotFoundError(f"No timesteps_*.txt file found in {run_directory}")
+
+    return timesteps_glob[0]
+
+
+def parse_header(text: str) -> dict:
+    """
+    Reads the ``# Key: value`` lines from the top of a timesteps file.
+    """
+
+    header = {}
+
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            break
+
+        key, separator, value = line[1:].partition(":")
+
+        if separator:
+            header[key.strip()] = value.strip()
+
+    return header
+
+
+def _read_complete_lines(filename: str, start: int = 0):
+    """
+    Reads ``filename`` from byte ``start`` up to the final newline. Returns
+    the decoded text and the byte offset just after the last complete line.
+    """
+
+    with open(filename, "rb") as handle:
+        handle.seek(start)
+        raw = handle.read()
+
+    end = raw.rfind(b"\n") + 1
+
+    return raw[:end].decode("utf-8", errors="replace"), start + end
+
+
+def _cache_filename(filename: str, cache_directory: str) -> str:
+    # The logs of different runs have the same names, so the cache is also
+    # named after the full path of the log.
+    digest = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+
+    return f"{cache_directory}/{os.path.basename(filename)}.{digest[:12]}{cache_suffix}"
+
+
+def _log_signature(filename: str) -> str:
+    """
+    The signature of a cache of the log ``filename`` as it is now.
+    """
+
+    return cache_signature(cache_version, [filename])
+
+
+def _appended_signature(filename: str) -> str:
+    """
+    The signature shared by the caches of every version of the log
+    ``filename`` that has only been appended to since.
+    """
+
+    return cache_signature(cache_version, inode=os.stat(filename).st_ino)
+
+
+def _read_cache(filename: str, cache_directory: str):
+    try:
+        with np.load(_cache_filename(filename, cache_directory)) as cache:
+            return {key: cache[key] for key in cache.files}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _write_cache(
+    filename: str, cache_directory: str, signature: str, data, header, parsed_bytes
+):
+    cache_filename = _cache_filename(filename, cache_directory)
+
+    # Read-only cache directory; we simply parse every time.
+    with atomic_output(cache_filename, ignore_errors=True) as temporary:
+        with open(temporary, "wb") as handle:
+            np.savez(
+                handle,
+                signature=signature,
+                appended_signature=_appended_signature(filename),
+                parsed_bytes=parsed_bytes,
+                data=data,
+                header=json.dumps(header),
+            )
+
+    return
+
+
+def load_timesteps(
+    filename: str, cache_directory: Optional[str] = None
+) -> TimestepTimeline:
+    """
+    Loads the timesteps file ``filename``, using (and refreshing) the
+    cached arrays in ``cache_directory``, if given, when possible. If the
+    log has only been appended to since the cache was written (i.e. the run
+    is still going), only the new lines are parsed.
+    """
+
+    # Taken before reading, so that lines appended while reading are parsed
+    # the next time.
+    signature = _log_signature(filename)
+    size = os.stat(filename).st_size
+    use_cache = cache_directory is not None
+    cache = _read_cache(filename, cache_directory) if use_cache else None
+
+    if cache is not None and is_valid(
+        cache.get("appended_signature"), _appended_signature(filename)
+    ):
+        data = cache["data"]
+        header = json.loads(str(cache["header"]))
+        parsed_bytes = int(cache["parsed_bytes"])
+
+        if is_valid(cache.get("signature"), signature):
+            return TimestepTimeline(filename, data, header)
+
+        if size >= parsed_bytes:
+            text, parsed_bytes = _read_complete_lines(filename, start=parsed_bytes)
+            rows, _ = parse_rows(
+                text.splitlines(), data.shape[1] if data.ndim == 2 else None
+            )
+
+            if len(rows) > 0:
+                data = np.concatenate([data, rows]) if len(data) > 0 else rows
+
+            _write_cache(
+                filename, cache_directory, signature, data, header, parsed_bytes
+            )
+
+            return TimestepTimeline(filename, data, header)
+
+    text, parsed_bytes = _read_complete_lines(filename)
+    header = parse_header(text)
+    data, _ = parse_rows(text.splitlines())
+
+    if use_cache:
+        _write_cache(filename, cache_directory, signature, data, header, parsed_bytes)
+
+    return TimestepTimeline(filename, data, header)
+
+
+def follow_timesteps(filename: str) -> FollowedTable:
+    """
+    Returns a `FollowedTable` for a timesteps file that is still being
+    written; use `timeline_from_table` to turn it into a `TimestepTimeline`
+    after each update.
+    """
+
+    return FollowedTable(filename)
+
+
+def timeline_from_table(table: FollowedTable) -> TimestepTimeline:
+    return TimestepTimeline(
+        table.filename, table.data, parse_header("\n".join(table.header_lines))
+    )
+
+
+def load_run_timesteps(run_directory: str, cache_directory: Optional[str] = None):
+    """
+    Loads the timesteps file that lives in ``run_directory``.
+    """
+
+    return load_timesteps(
+        find_timesteps_file(run_directory), cache_directory=cache_directory
+    )
@@ -27,8 +27,11 @@ image_run () {
   output_path=$plot_directory/$run_name
   snapshot_path=$run_directory/$snapshot_name
 
+  python3 images/smoothing_length_sidecar.py $snapshot_path
   python3 images/imaging.py $snapshot_path $catalogue_path $output_path
-  python3 images/halo_images.py $snapshot_path $catalogue_path $output_path
+  python3 images/galaxy_profiles.py $snapshot_path $catalogue_path $output_path
+  python3 images/galaxy_stacks.py $snapshot_path $catalogue_path $output_path
+  python3 images/halo_images.py $snapshot_path $catalogue_path $output_path --tiles
 }
 
 export -f image_run
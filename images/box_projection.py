@@ -0,0 +1,283 @@
+"""
+Out-of-core projection of all the gas in a (periodic) box.
+
+Projecting the whole box with swiftsimio needs every particle, and the
+intermediate arrays, in memory at once. Here the particles are read in
+chunks of whole top level cells (which are contiguous in the snapshot),
+by a pool of processes. Each process deposits its chunk into one tile of
+the output grid at a time, and adds the tile to an accumulation grid that
+is memory-mapped from a file and shared by all of the processes. The
+memory used by each process is bounded by the size of the chunks and of
+the tiles, not by the size of the box or of the grid, so grids of
+16384^2 pixels (and more) can be made.
+
+The kernel and normalisation are the same as those of
+`multi_projection.project_pixel_grids` (and swiftsimio), with the
+particles near the edges also deposited on the other side of the box.
+"""
+
+import h5py
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+from multi_projection import kernel_gamma, scatter_channels
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.region_loader import SnapshotCells
+from helpers.snapshot_metadata import particle_types
+
+# State of each process in the pool.
+_worker = {}
+
+
+def particle_chunks(snapshot_filename: str, particle_type: int, chunk_size: int):
+    """
+    Ranges (start, stop) of the particles of ``particle_type`` in the
+    snapshot, of about ``chunk_size`` particles each, made of whole top
+    level cells if the snapshot has cell metadata.
+    """
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        total = int(handle["Header"].attrs["NumPart_Total"][particle_type])
+        has_cells = "Cells" in handle
+
+    if has_cells:
+        cells = SnapshotCells(snapshot_filename)
+        name = {v: k for k, v in particle_types.items()}[particle_type]
+        offsets = np.sort(cells.offsets[name])
+        boundaries = [0]
+
+        # Cells are contiguous in the snapshot, so whole cells are slices.
+        for offset in offsets[1:]:
+            if offset - boundaries[-1] >= chunk_size:
+                boundaries.append(int(offset))
+    else:
+        boundaries = list(range(0, total, chunk_size))
+
+    boundaries = [b for b in boundaries if b < total] + [total]
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def periodic_images(x, y, kernel_width):
+    """
+    Indices and shifted positions of the particles (in [0, 1]), and of
+    their periodic images across the edges that their kernels overlap.
+    """
+
+    indices = [np.arange(len(x))]
+    x_images = [x]
+    y_images = [y]
+
+    for shift_x in [-1.0, 0.0, 1.0]:
+        for shift_y in [-1.0, 0.0, 1.0]:
+            if shift_x == 0.0 and shift_y == 0.0:
+                continue
+
+            overlaps = np.logical_and.reduce(
+                [
+                    x + shift_x + kernel_width >= 0.0,
+                    x + shift_x - kernel_width <= 1.0,
+                    y + shift_y + kernel_width >= 0.0,
+                    y + shift_y - kernel_width <= 1.0,
+                ]
+            )
+
+            if np.any(overlaps):
+                indices.append(np.flatnonzero(overlaps))
+                x_images.append(x[overlaps] + shift_x)
+                y_images.append(y[overlaps] + shift_y)
+
+    return np.concatenate(indices), np.concatenate(x_images), np.concatenate(y_images)
+
+
+def _initialise_worker(
+    snapshot_filename,
+    group_name,
+    channel_paths,
+    grid_filename,
+    resolution,
+    tile_size,
+    periodic,
+    locks,
+):
+    _worker.update(
+        handle=h5py.File(snapshot_filename, "r"),
+        group_name=group_name,
+        channel_paths=channel_paths,
+        grid=np.memmap(
+            grid_filename,
+            dtype=np.float32,
+            mode="r+",
+            shape=(len(channel_paths), resolution, resolution),
+        ),
+        resolution=resolution,
+        tile_size=tile_size,
+        periodic=periodic,
+        locks=locks,
+    )
+
+    return
+
+
+def _deposit_chunk(chunk):
+    start, stop = chunk
+
+    group = _worker["handle"][_worker["group_name"]]
+    resolution = _worker["resolution"]
+    tile_size = _worker["tile_size"]
+    tiles_per_side = resolution // tile_size
+
+    boxsize = np.ones(3) * _worker["handle"]["Header"].attrs["BoxSize"]
+
+    coordinates = group["Coordinates"][start:stop]
+    x = (np.mod(coordinates[:, 0], boxsize[0]) / boxsize[0]).astype(np.float32)
+    y = (np.mod(coordinates[:, 1], boxsize[1]) / boxsize[1]).astype(np.float32)
+    del coordinates
+
+    h = (group["SmoothingLengths"][start:stop] / boxsize[0]).astype(np.float32)
+
+    weights = np.stack(
+        [
+            np.ones(stop - start, dtype=np.float32)
+            if path is None
+            else group[path][start:stop].astype(np.float32)
+            for path in _worker["channel_paths"]
+        ],
+        axis=1,
+    )
+
+    kernel_width = kernel_gamma * h
+
+    if _worker["periodic"]:
+        indices, x, y = periodic_images(x, y, kernel_width)
+        h = h[indices]
+        kernel_width = kernel_width[indices]
+        weights = weights[indices]
+
+    # Range of tiles covered by the kernel of each particle.
+    tile_lower = [
+        np.clip(np.floor((p - kernel_width) * tiles_per_side), 0, tiles_per_side - 1)
+        for p in [x, y]
+    ]
+    tile_upper = [
+        np.clip(np.floor((p + kernel_width) * tiles_per_side), 0, tiles_per_side - 1)
+        for p in [x, y]
+    ]
+
+    # Tile grids are normalised to the tile, rather than to the box.
+    scale = np.float32(tiles_per_side * tiles_per_side)
+
+    for tile_x in range(int(tile_lower[0].min()), int(tile_upper[0].max()) + 1):
+        in_column = np.logical_and(tile_lower[0] <= tile_x, tile_upper[0] >= tile_x)
+
+        for tile_y in range(int(tile_lower[1].min()), int(tile_upper[1].max()) + 1):
+            mask = np.logical_and(
+                in_column,
+                np.logical_and(tile_lower[1] <= tile_y, tile_upper[1] >= tile_y),
+            )
+
+            if not np.any(mask):
+                continue
+
+            tile = scatter_channels(
+                x[mask] * tiles_per_side - tile_x,
+                y[mask] * tiles_per_side - tile_y,
+                weights[mask],
+                h[mask] * tiles_per_side,
+                tile_size,
+            )
+
+            pixels = np.s_[
+                tile_x * tile_size : (tile_x + 1) * tile_size,
+                tile_y * tile_size : (tile_y + 1) * tile_size,
+            ]
+
+            with _worker["locks"][tile_x * tiles_per_side + tile_y]:
+                for channel in range(tile.shape[2]):
+                    _worker["grid"][channel][pixels] += tile[:, :, channel] * scale
+
+    return stop - start
+
+
+def project_box(
+    snapshot_filename: str,
+    grid_filename: str,
+    resolution: int,
+    project=("Masses",),
+    particle_type: int = 0,
+    processes: int = 1,
+    tile_size: int = 2048,
+    chunk_size: int = 1 << 22,
+    periodic: bool = True,
+):
+    """
+    Projects the particles of ``particle_type`` in the whole box along z,
+    onto grids of ``resolution`` x ``resolution`` pixels, with
+    ``processes`` processes.
+
+    ``project`` are the snapshot datasets (e.g. "Masses") to project, in
+    internal units, or None to project the number of particles. The grids
+    are accumulated in the file ``grid_filename``, and are returned as a
+    read-only memory-mapped array of shape (len(project), resolution,
+    resolution), with x as the first pixel index.
+    """
+
+    tile_size = min(tile_size, resolution)
+
+    if resolution % tile_size != 0:
+        raise AttributeError(
+            f"The resolution ({resolution}) must be a multiple of the tile size "
+            f"({tile_size})."
+        )
+
+    tiles_per_side = resolution // tile_size
+
+    grid = np.memmap(
+        grid_filename,
+        dtype=np.float32,
+        mode="w+",
+        shape=(len(project), resolution, resolution),
+    )
+    del grid
+
+    chunks = particle_chunks(snapshot_filename, particle_type, chunk_size)
+    locks = [multiprocessing.Lock() for _ in range(tiles_per_side * tiles_per_side)]
+
+    initargs = (
+        snapshot_filename,
+        f"PartType{particle_type}",
+        list(project),
+        grid_filename,
+        resolution,
+        tile_size,
+        periodic,
+        locks,
+    )
+
+    if processes > 1:
+        with multiprocessing.Pool(
+            processes, initializer=_initialise_worker, initargs=initargs
+        ) as pool:
+            for _ in pool.imap_unordered(_deposit_chunk, chunks, chunksize=1):
+                pass
+    else:
+        _initialise_worker(*initargs)
+
+        for chunk in chunks:
+            _deposit_chunk(chunk)
+
+        _worker["grid"].flush()
+        _worker["handle"].close()
+        _worker.clear()
+
+    return np.memmap(
+        grid_filename,
+        dtype=np.float32,
+        mode="r",
+        shape=(len(project), resolution, resolution),
+    )
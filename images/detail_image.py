@@ -4,12 +4,12 @@ matter, stars, and gas column density. This doesn't do any rotation,
 just makes projected images of them in the x, y plane.
 
 Give it the snapshot path as the first arugment, and the
-velociraptor catalogue path as the second. As the final argument
-it takes the output directory.
+velociraptor catalogue path as the second. As the third argument
+it takes the output directory. An optional fourth argument (ngp, cic or
+tsc) assigns the star and dark matter particles to pixels, followed by a
+Gaussian smoothing, rather than generating smoothing lengths for them.
 """
 
-from velociraptor.swift.swift import to_swiftsimio_dataset
-from velociraptor.particles import load_groups
 from velociraptor import load
 
 from swiftsimio.visualisation.projection import project_pixel_grid
@@ -18,42 +18,45 @@ from swiftsimio.visualisation.smoothing_length_generation import (
     generate_smoothing_lengths,
 )
 
+import os
 import sys
 import unyt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fast_render import paste_text, rasterise, write_image
+from multi_projection import deposit_pixel_grids, smooth_pixel_grids
+from helpers.region_loader import RegionLoader
+from helpers.smoothing_lengths import smoothing_lengths_from_sidecar
+
 snapshot_path = sys.argv[1]
 velociraptor_base_name = sys.argv[2]
 output_path = sys.argv[3]
+mass_assignment = sys.argv[4] if len(sys.argv) > 4 else "sph"
+# Width, in pixels, of the Gaussian that assigned images are smoothed with.
+assignment_smoothing = 1.0
 
 halo_ids = range(0, 100)
 
 velociraptor_properties = velociraptor_base_name
-velociraptor_groups = velociraptor_base_name.replace("properties", "catalog_groups")
-
-filenames = {
-    "parttypes_filename": velociraptor_base_name.replace(
-        "properties", "catalog_partypes"
-    ),
-    "particles_filename": velociraptor_base_name.replace(
-        "properties", "catalog_particles"
-    ),
-    "unbound_parttypes_filename": velociraptor_base_name.replace(
-        "properties", "catalog_partypes.unbound"
-    ),
-    "unbound_particles_filename": velociraptor_base_name.replace(
-        "properties", "catalog_particles.unbound"
-    ),
-}
 
 catalogue = load(velociraptor_properties)
-groups = load_groups(velociraptor_groups, catalogue)
+
+# The particles around nearby halos are read together, through a cache of
+# the snapshot's top level cells.
+loader = RegionLoader(
+    snapshot_path,
+    {
+        "gas": ["coordinates", "masses", "smoothing_lengths"],
+        "stars": ["coordinates", "masses", "particle_ids"],
+        "dark_matter": ["coordinates", "masses", "particle_ids"],
+    },
+)
 
 # Let's make an image of those particles!
-import matplotlib.pyplot as plt
 import numpy as np
 
 from swiftsimio.visualisation.sphviewer import SPHViewerWrapper
-from matplotlib.colors import LogNorm
 
 particle_type_cmap = {
     "gas": "inferno",
@@ -71,73 +74,120 @@ def latex_float(f):
         return float_str
 
 
-for halo_id in halo_ids:
-    particles, unbound_particles = groups.extract_halo(halo_id, filenames=filenames)
+halo_ids = np.array(halo_ids)
+a = loader.snapshot.metadata.a
+
+halo_centres = (
+    unyt.unyt_array(
+        [
+            catalogue.positions.xc[halo_ids],
+            catalogue.positions.yc[halo_ids],
+            catalogue.positions.zc[halo_ids],
+        ]
+    ).T
+    / a
+)
+halo_sizes = catalogue.radii.r_size[halo_ids] / a
+
+
+def halos_with_particles():
+    """
+    The halos, in batches of nearby ones, along with the particles (read
+    using the cell metadata) around them.
+    """
 
+    for batch in loader.batches(halo_centres, 25):
+        regions = loader.load(halo_centres[batch], halo_sizes[batch])
+
+        for index, data in zip(batch, regions):
+            yield halo_ids[index], data
+
+
+for halo_id, data in halos_with_particles():
     halo_mass = catalogue.masses.mass_200mean[halo_id].to("Solar_Mass")
     stellar_mass = catalogue.apertures.mass_star_30_kpc[halo_id].to("Solar_Mass")
 
-    # This reads particles using the cell metadata that are around our halo
-    data = to_swiftsimio_dataset(particles, snapshot_path, generate_extra_mask=False)
-
     for particle_type, cmap in particle_type_cmap.items():
         particle_data = getattr(data, particle_type)
 
-        x = particles.x / data.metadata.a
-        y = particles.y / data.metadata.a
-        z = particles.z / data.metadata.a
-        r_size = particles.r_size * 0.5 / data.metadata.a
-
-        if particle_type in ["stars", "dark_matter"]:
-            particle_data.smoothing_lengths = generate_smoothing_lengths(
-                coordinates=particle_data.coordinates,
+        x = catalogue.positions.xc[halo_id] / a
+        y = catalogue.positions.yc[halo_id] / a
+        z = catalogue.positions.zc[halo_id] / a
+        r_size = catalogue.radii.r_size[halo_id] * 0.5 / a
+
+        region = [x - r_size, x + r_size, y - r_size, y + r_size]
+
+        if particle_type in ["stars", "dark_matter"] and mass_assignment != "sph":
+            units = particle_data.coordinates.units
+            coordinates = particle_data.coordinates.value
+
+            (pixel_grid,) = smooth_pixel_grids(
+                deposit_pixel_grids(
+                    coordinates[:, 0],
+                    coordinates[:, 1],
+                    None,
+                    [particle_data.masses.value],
+                    [edge.to(units).value for edge in region],
+                    resolution=1024,
+                    scheme=mass_assignment,
+                ),
+                assignment_smoothing,
+            )
+        elif particle_type in ["stars", "dark_matter"]:
+            smoothing_lengths = smoothing_lengths_from_sidecar(data, particle_type)
+
+            if smoothing_lengths is None:
+                smoothing_lengths = generate_smoothing_lengths(
+                    coordinates=particle_data.coordinates,
+                    boxsize=data.metadata.boxsize,
+                    kernel_gamma=kernel_gamma,
+                    neighbours=57,
+                    speedup_fac=1,
+                    dimension=3,
+                )
+
+            particle_data.smoothing_lengths = smoothing_lengths
+
+        if particle_type == "gas" or mass_assignment == "sph":
+            pixel_grid = project_pixel_grid(
+                particle_data,
                 boxsize=data.metadata.boxsize,
-                kernel_gamma=kernel_gamma,
-                neighbours=57,
-                speedup_fac=1,
-                dimension=3,
+                resolution=1024,
+                region=region,
             )
 
-        pixel_grid = project_pixel_grid(
-            particle_data,
-            boxsize=data.metadata.boxsize,
-            resolution=1024,
-            region=[x - r_size, x + r_size, y - r_size, y + r_size],
-        )
-
         if particle_type == "stars":
             # Need to clip.
             nonzero = pixel_grid >= 1e-2
             min_nonzero = np.min(pixel_grid[nonzero])
             pixel_grid[~nonzero] = min_nonzero
 
-        fig, ax = plt.subplots(figsize=(8, 8), dpi=1024 // 8)
-        fig.subplots_adjust(0, 0, 1, 1)
-        ax.axis("off")
+        # The grid is shown as imshow(pixel_grid, origin="lower"), one pixel
+        # per pixel of the grid, drawn directly without a figure.
+        image = rasterise(pixel_grid.T, cmap)
+        resolution = image.size[0]
+        text_size = resolution * 10 // 576
 
-        ax.imshow(pixel_grid, norm=LogNorm(), cmap=cmap, origin="lower")
-        ax.text(
-            0.975,
-            0.975,
+        paste_text(
+            image,
             f"$z={data.metadata.z:3.3f}$",
-            color="white",
+            (0.975 * resolution, 0.025 * resolution),
+            "white",
+            text_size,
             ha="right",
             va="top",
-            transform=ax.transAxes,
         )
-        ax.text(
-            0.975,
-            0.025,
+        paste_text(
+            image,
             (
                 f"$M_H={latex_float(halo_mass.value)}$ ${halo_mass.units.latex_repr}$\n"
                 f"$M_*={latex_float(stellar_mass.value)}$ ${stellar_mass.units.latex_repr}$"
             ),
-            color="white",
+            (0.975 * resolution, 0.975 * resolution),
+            "white",
+            text_size,
             ha="right",
             va="bottom",
-            transform=ax.transAxes,
         )
 
-        fig.savefig(f"{output_path}/{particle_type}_halo_image_{halo_id}.png")
-
-        plt.close(fig)
+        write_image(image, f"{output_path}/{particle_type}_halo_image_{halo_id}.png")
@@ -0,0 +1,462 @@
+"""
+Direct rasterisation of pixel grids into images with Pillow.
+
+Building a matplotlib figure (with a colour bar) for every image, and
+having matplotlib draw and encode it, costs more than projecting the
+particles. Here the norm and colour map are applied to the grid with a
+lookup table, one pixel per grid cell, and the decorations (text, circles
+and colour bars) are pasted from overlays that are drawn once and cached.
+Text uses the same font as matplotlib, and the simple LaTeX used in the
+labels is converted to plain text.
+"""
+
+import functools
+import os
+import re
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from matplotlib.colors import LogNorm, to_rgb
+from matplotlib.font_manager import FontProperties, findfont
+from matplotlib.ticker import LogLocator, MaxNLocator
+from PIL import Image, ImageDraw, ImageFont
+
+from helpers.sidecar_cache import atomic_output
+
+superscripts = str.maketrans("0123456789+-", "⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻")
+# LaTeX commands used in the labels, and their plain text replacements.
+latex_commands = {"\\times": "×", "\\odot": "☉", "\\rm": "", "\\mathrm": ""}
+
+# Colour maps that were given as objects rather than names, by name.
+_colour_maps = {}
+
+
+def _colour(colour) -> tuple:
+    return tuple(int(round(255 * channel)) for channel in to_rgb(colour))
+
+
+@functools.lru_cache(maxsize=None)
+def _lookup_table(cmap_name: str, background: tuple) -> np.ndarray:
+    """
+    RGB colours of the ``cmap_name`` colour map, followed by its under,
+    over and bad colours, blended with ``background`` where transparent.
+    """
+
+    colour_map = _colour_maps.get(cmap_name) or plt.get_cmap(cmap_name)
+
+    colours = np.concatenate(
+        [
+            colour_map(np.arange(colour_map.N)),
+            colour_map(np.ma.masked_invalid(np.array([-1.0, 2.0, np.nan]))),
+        ]
+    )
+
+    alpha = colours[:, 3:]
+    blended = colours[:, :3] * alpha + np.array(background) / 255 * (1.0 - alpha)
+
+    return (255 * blended + 0.5).astype(np.uint8)
+
+
+def _colour_map_name(cmap) -> str:
+    if isinstance(cmap, str):
+        return cmap
+
+    # Colour maps are not hashable, so the tables are cached by name.
+    _colour_maps[cmap.name] = cmap
+
+    return cmap.name
+
+
+def lookup_table(cmap, background="black") -> np.ndarray:
+    """
+    Lookup table of ``cmap`` (a name or a matplotlib colour map), as an
+    array of shape (N + 3, 3); the last three entries are the under, over
+    and bad colours.
+    """
+
+    return _lookup_table(_colour_map_name(cmap), _colour(background))
+
+
+def _log_normalise(values: np.ndarray, norm: LogNorm) -> np.ndarray:
+    """
+    ``values`` scaled by ``norm`` (which is autoscaled to the positive,
+    finite, values if it has no limits), with NaN for the values that
+    matplotlib masks.
+    """
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        logarithm = np.log10(values)
+
+    valid = np.isfinite(logarithm)
+
+    if norm.vmin is None or norm.vmax is None:
+        if np.any(valid):
+            positive = values[valid]
+            norm.vmin = positive.min() if norm.vmin is None else norm.vmin
+            norm.vmax = positive.max() if norm.vmax is None else norm.vmax
+
+    if norm.vmin is None or norm.vmin == norm.vmax or not np.any(valid):
+        return np.zeros_like(values)
+
+    lower, upper = np.log10(norm.vmin), np.log10(norm.vmax)
+    logarithm[~valid] = np.nan
+
+    return (logarithm - lower) / (upper - lower)
+
+
+def colour_indices(values, norm, number_of_colours: int) -> np.ndarray:
+    """
+    Index into a lookup table of ``number_of_colours`` colours for each of
+    ``values``, in the same way as matplotlib's colour maps; under, over
+    and bad (masked or not finite) values get the indices after the
+    colours.
+    """
+
+    if type(norm) is LogNorm and not norm.clip:
+        # The same as matplotlib's LogNorm, without the masked arrays.
+        normed = _log_normalise(np.asarray(values, dtype=np.float64), norm)
+    else:
+        normed = norm(np.ma.masked_invalid(values))
+
+    with np.errstate(invalid="ignore", over="ignore"):
+        scaled = np.ma.getdata(normed).astype(np.float64) * number_of_colours
+        scaled[np.ma.getmaskarray(normed)] = np.nan
+
+        indices = np.minimum(scaled, number_of_colours - 1)
+        indices[scaled < 0] = number_of_colours
+        indices[scaled > number_of_colours] = number_of_colours + 1
+        indices[np.isnan(scaled)] = number_of_colours + 2
+
+    return indices.astype(np.intp)
+
+
+def rasterise(grid, cmap, norm=None, background="black") -> Image.Image:
+    """
+    RGB image of ``grid``, which is indexed as [x, y], in the orientation
+    of ``imshow(grid.T, origin="lower")``. ``norm`` defaults to a `LogNorm`
+    scaled to the grid, and is autoscaled in place if it has no limits.
+    """
+
+    if norm is None:
+        norm = LogNorm()
+
+    table = lookup_table(cmap, background)
+    if not np.ma.isMaskedArray(grid):
+        grid = np.asarray(grid)
+
+    indices = colour_indices(grid, norm, len(table) - 3)
+
+    # Looking up whole (RGBX) pixels is much faster than three channels.
+    packed = np.concatenate(
+        [table, np.full((len(table), 1), 255, dtype=np.uint8)], axis=1
+    ).view(np.uint32)[:, 0]
+    pixels = np.ascontiguousarray(np.take(packed, indices.T[::-1]))
+
+    return Image.frombuffer(
+        "RGBX", pixels.shape[::-1], pixels, "raw", "RGBX", 0, 1
+    ).convert("RGB")
+
+
+def _strip(grid, denominator, columns) -> np.ndarray:
+    values = np.asarray(grid[columns], dtype=np.float32)
+
+    if denominator is not None:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = values / np.asarray(denominator[columns], dtype=np.float32)
+
+    return values
+
+
+def _strips(length: int, strip_size: int) -> list:
+    return [np.s_[start : start + strip_size] for start in range(0, length, strip_size)]
+
+
+def autoscale_in_strips(norm, grid, denominator=None, strip_size: int = 1024):
+    """
+    Sets the limits of ``norm`` that are not set to those of ``grid`` (or
+    of ``grid / denominator``), reading ``strip_size`` columns at a time.
+    As with matplotlib, a `LogNorm` is scaled to the positive values.
+    """
+
+    if norm.vmin is not None and norm.vmax is not None:
+        return
+
+    lower, upper = np.inf, -np.inf
+
+    for columns in _strips(len(grid), strip_size):
+        values = _strip(grid, denominator, columns)
+        valid = np.isfinite(values)
+
+        if isinstance(norm, LogNorm):
+            valid &= values > 0
+
+        if np.any(valid):
+            lower = min(lower, values[valid].min())
+            upper = max(upper, values[valid].max())
+
+    if lower <= upper:
+        norm.vmin = lower if norm.vmin is None else norm.vmin
+        norm.vmax = upper if norm.vmax is None else norm.vmax
+
+    return
+
+
+def rasterise_in_strips(
+    grid,
+    cmap,
+    norm=None,
+    background="black",
+    denominator=None,
+    strip_size: int = 1024,
+) -> Image.Image:
+    """
+    As `rasterise`, for grids too large to colour map in one go (e.g.
+    memory-mapped grids), which are read ``strip_size`` columns at a time.
+    If ``denominator`` (of the same shape) is given, the image is of
+    ``grid / denominator``.
+    """
+
+    if norm is None:
+        norm = LogNorm()
+
+    strips = _strips(len(grid), strip_size)
+    autoscale_in_strips(norm, grid, denominator, strip_size)
+
+    image = Image.new("RGB", grid.shape[:2])
+
+    for columns in strips:
+        image.paste(
+            rasterise(_strip(grid, denominator, columns), cmap, norm, background),
+            (columns.start, 0),
+        )
+
+    return image
+
+
+@functools.lru_cache(maxsize=None)
+def font(size: int) -> ImageFont.FreeTypeFont:
+    """
+    The default matplotlib font, at ``size`` pixels.
+    """
+
+    return ImageFont.truetype(findfont(FontProperties()), size)
+
+
+def _superscript(match) -> str:
+    text = match.group(1) if match.group(1) is not None else match.group(2)
+
+    if all(character in "0123456789+-" for character in text):
+        return text.translate(superscripts)
+
+    return f"^{text}"
+
+
+def _plain_math(match) -> str:
+    text = match.group(1)
+
+    for command, replacement in latex_commands.items():
+        text = text.replace(command, replacement)
+
+    text = re.sub(r"\^(?:\{([^{}]*)\}|(.))", _superscript, text)
+    text = re.sub(r"[_{}\\]", "", text)
+
+    return re.sub(" +", " ", text)
+
+
+def plain_text(text: str) -> str:
+    """
+    Converts the simple LaTeX used in the labels (e.g. ``$\\times 10^{12}$``
+    or ``$R_{200, \\rm{crit}}$``) to plain text.
+    """
+
+    return re.sub(r"\$([^$]*)\$", _plain_math, text).strip(" ")
+
+
+@functools.lru_cache(maxsize=4096)
+def text_overlay(text: str, size: int, align: str = "left") -> Image.Image:
+    """
+    Mask (mode "L") of ``text`` in the matplotlib font at ``size`` pixels.
+    """
+
+    text = plain_text(text)
+    text_font = font(size)
+
+    left, top, right, bottom = ImageDraw.Draw(
+        Image.new("L", (1, 1))
+    ).multiline_textbbox((0, 0), text, font=text_font, align=align)
+
+    width = max(int(np.ceil(right - left)), 1)
+    height = max(int(np.ceil(bottom - top)), 1)
+
+    overlay = Image.new("L", (width, height), 0)
+    ImageDraw.Draw(overlay).multiline_text(
+        (-left, -top), text, fill=255, font=text_font, align=align
+    )
+
+    return overlay
+
+
+def paste_text(
+    image: Image.Image,
+    text: str,
+    position,
+    colour,
+    size: int,
+    ha: str = "left",
+    va: str = "bottom",
+):
+    """
+    Draws ``text`` at the pixel ``position`` of ``image``, aligned as
+    matplotlib's ``ha`` and ``va``.
+    """
+
+    overlay = text_overlay(text, size, ha)
+    width, height = overlay.size
+
+    x = position[0] - {"left": 0, "center": width / 2, "right": width}[ha]
+    y = position[1] - {"top": 0, "center": height / 2, "bottom": height}[va]
+
+    image.paste(_colour(colour), (int(round(x)), int(round(y))), overlay)
+
+    return
+
+
+@functools.lru_cache(maxsize=256)
+def dashed_circle_overlay(radius: float, width: int) -> Image.Image:
+    """
+    Mask (mode "L") of a dashed circle of ``radius`` pixels and line
+    ``width``, centred in the mask, with matplotlib's dash pattern.
+    """
+
+    size = int(np.ceil(2 * radius + 2 * width)) + 1
+    overlay = Image.new("L", (size, size), 0)
+    draw = ImageDraw.Draw(overlay)
+
+    centre = size / 2
+    box = [centre - radius, centre - radius, centre + radius, centre + radius]
+
+    # Dashes of 3.7 and gaps of 1.6 line widths, as angles.
+    dash, gap = np.degrees(np.array([3.7, 1.6]) * width / max(radius, 1.0))
+
+    for start in np.arange(0.0, 360.0 - gap, dash + gap):
+        draw.arc(box, start, start + dash, fill=255, width=width)
+
+    return overlay
+
+
+def paste_dashed_circle(
+    image: Image.Image, centre, radius: float, colour, width: int
+):
+    """
+    Draws a dashed circle of ``radius`` pixels around the pixel ``centre``.
+    """
+
+    overlay = dashed_circle_overlay(round(radius, 1), width)
+    corner = [int(round(c - overlay.size[0] / 2)) for c in centre]
+
+    image.paste(_colour(colour), tuple(corner), overlay)
+
+    return
+
+
+@functools.lru_cache(maxsize=64)
+def _colour_bar_strip(cmap_name: str, width: int, height: int) -> Image.Image:
+    table = lookup_table(cmap_name)[:-3]
+    indices = (np.arange(height)[::-1] * len(table)) // height
+
+    strip = np.repeat(table[indices][:, None, :], width, axis=1)
+
+    # Black frame, as the matplotlib axes.
+    strip[[0, -1], :] = 0
+    strip[:, [0, -1]] = 0
+
+    return Image.fromarray(strip)
+
+
+def colour_bar_ticks(norm):
+    """
+    Tick values and labels of a colour bar for the (scaled) ``norm``.
+    """
+
+    vmin, vmax = norm.vmin, norm.vmax
+
+    if isinstance(norm, LogNorm):
+        ticks = LogLocator().tick_values(vmin, vmax)
+
+        if np.sum((ticks >= vmin) & (ticks <= vmax)) < 2:
+            ticks = LogLocator(subs=(1.0, 2.0, 5.0)).tick_values(vmin, vmax)
+    else:
+        ticks = MaxNLocator(nbins=6).tick_values(vmin, vmax)
+
+    tolerance = 1e-9 * abs(vmax - vmin)
+    ticks = ticks[(ticks >= vmin - tolerance) & (ticks <= vmax + tolerance)]
+    labels = []
+
+    for tick in ticks:
+        exponent = np.log10(tick) if tick > 0 else np.nan
+
+        if isinstance(norm, LogNorm) and np.isclose(exponent, np.round(exponent)):
+            labels.append(f"$10^{{{int(np.round(exponent))}}}$")
+        else:
+            labels.append(f"{tick:.3g}")
+
+    return ticks, labels
+
+
+def paste_colour_bar(
+    image: Image.Image, box, cmap, norm, size: int, colour="black"
+):
+    """
+    Draws a vertical colour bar of ``cmap`` for ``norm`` in ``box`` (left,
+    top, width, height), with tick labels to the right of it.
+    """
+
+    left, top, width, height = box
+    image.paste(
+        _colour_bar_strip(_colour_map_name(cmap), width, height), (left, top)
+    )
+
+    draw = ImageDraw.Draw(image)
+    tick_length = max(width // 4, 2)
+
+    for tick, label in zip(*colour_bar_ticks(norm)):
+        y = top + (height - 1) * (1.0 - float(norm(tick)))
+
+        draw.line(
+            [(left + width, y), (left + width + tick_length, y)],
+            fill=_colour(colour),
+            width=max(size // 16, 1),
+        )
+        paste_text(
+            image,
+            label,
+            (left + width + 1.5 * tick_length, y),
+            colour,
+            size,
+            ha="left",
+            va="center",
+        )
+
+    return
+
+
+def write_image(image, filename: str, compress_level: int = 1):
+    """
+    Writes ``image`` (a Pillow image or RGB array) to ``filename``, in the
+    format given by its extension (e.g. PNG or WebP). The image is written
+    under a temporary name first, so that it only appears once complete.
+    """
+
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+
+    extension = os.path.splitext(filename)[1].lower()
+    image_format = Image.registered_extensions().get(extension, "PNG")
+
+    options = {"compress_level": compress_level} if image_format == "PNG" else {}
+
+    with atomic_output(filename) as temporary_filename:
+        image.save(temporary_filename, format=image_format, **options)
+
+    return
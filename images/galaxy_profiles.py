@@ -0,0 +1,604 @@
+"""
+Radial profiles of the galaxies that are imaged by `imaging.py` (central
+galaxies with a stellar mass above 1e9 Msun), in 3D and projected face
+and edge on, computed in batches of nearby halos.
+
+The particles around each batch are read once through the same cell
+cache as the images (see helpers/region_loader.py) and put in a periodic
+KD-tree, which is queried for all of the halos in the batch at once. The
+separations from each centre are wrapped to the nearest periodic image,
+rotated into the face and edge on frames of the images, and binned in
+radius for every halo of the batch with one ``np.bincount`` per
+quantity. Densities are the sums in each shell (or annulus), divided by
+its volume (or area); other quantities are mass weighted means. The
+radii are physical, and the projected profiles include the particles up
+to the largest radius in front of and behind each galaxy.
+
+Produces, in the output path:
+
++ galaxy_profiles.hdf5: for each geometry ("3d", "faceon" and "edgeon"),
+  the (number of galaxies x number of radial bins) matrix of each
+  profile, with the catalogue index and stellar mass of each galaxy and
+  the radial bin edges, and in "stacked" the 16th, 50th and 84th
+  percentiles of the profiles in each bin of stellar mass.
++ galaxy_profiles_<profile>.png: the median profiles in bins of stellar
+  mass, for each geometry.
+
+Takes the snapshot, the halo catalogue and the output path, as
+`imaging.py`.
+"""
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import attr
+import h5py
+import os
+import sys
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from unyt import unyt_array
+
+from imaging import catalogue_galaxy_attributes, projection_rotation, select_halos
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.halo_particles import group_by_halo
+from helpers.particle_apertures import ParticleTree
+from helpers.region_loader import HaloRegion, RegionLoader
+
+try:
+    plt.style.use("mnras.mplstyle")
+except:
+    pass
+
+
+@attr.s
+class ProfileQuantity(object):
+    """
+    A radial profile of the `quantity` of the particles of
+    `particle_type`, in `units`. Without a `weight`, this is a density
+    (the sum of `quantity` per unit volume or area); with one, it is the
+    mean of `quantity` weighted by `weight` (another particle property).
+    """
+
+    particle_type: str = attr.ib()
+    quantity: str = attr.ib()
+    units: str = attr.ib()
+    label: str = attr.ib()
+    weight: str = attr.ib(default=None)
+
+
+profile_quantities = {
+    "gas_density": ProfileQuantity("gas", "masses", "Solar_Mass", "Gas density"),
+    "gas_temperature": ProfileQuantity(
+        "gas", "temperatures", "K", "Gas temperature", weight="masses"
+    ),
+    "gas_metallicity": ProfileQuantity(
+        "gas",
+        "metal_mass_fractions",
+        "dimensionless",
+        "Gas metallicity",
+        weight="masses",
+    ),
+    "star_formation_rate_density": ProfileQuantity(
+        "gas", "star_formation_rates", "Solar_Mass / year", "SFR density"
+    ),
+    "stellar_density": ProfileQuantity(
+        "stars", "masses", "Solar_Mass", "Stellar density"
+    ),
+    "stellar_metallicity": ProfileQuantity(
+        "stars",
+        "metal_mass_fractions",
+        "dimensionless",
+        "Stellar metallicity",
+        weight="masses",
+    ),
+    "dark_matter_density": ProfileQuantity(
+        "dark_matter", "masses", "Solar_Mass", "Dark matter density"
+    ),
+}
+
+# Geometries of the profiles: spherical, then in the planes of the images.
+geometries = ["3d", "faceon", "edgeon"]
+geometry_names = {"3d": "3D", "faceon": "Face on", "edgeon": "Edge on"}
+
+# Physical radial bins, in kpc.
+radial_bin_edges = unyt_array(np.logspace(-0.5, 2.0, 26), "kpc")
+# Stellar mass bins (30 kpc aperture) for the stacked profiles.
+stellar_mass_bins = unyt_array(np.append(np.logspace(9.0, 11.0, 5), 1e13), "Solar_Mass")
+stacked_percentiles = [16, 50, 84]
+
+output_filename = "galaxy_profiles"
+
+
+def profile_properties(quantities: dict) -> dict:
+    """
+    The particle properties needed for `quantities`, to read in bulk.
+    """
+
+    properties = {}
+
+    for quantity in quantities.values():
+        names = properties.setdefault(quantity.particle_type, ["coordinates"])
+
+        for name in [quantity.quantity, quantity.weight]:
+            if name is not None and name not in names:
+                names.append(name)
+
+    return properties
+
+
+class ProfileEngine(object):
+    """
+    Computes the radial profiles of `quantities` around halos of one
+    snapshot and catalogue, reading the particles around batches of
+    nearby halos through a cell cache of `cell_cache_bytes` bytes.
+    """
+
+    def __init__(
+        self,
+        snapshot_path: str,
+        velociraptor_base_name: str,
+        quantities: dict = profile_quantities,
+        cell_cache_bytes: int = 1 << 28,
+    ):
+        from velociraptor import load
+
+        self.catalogue = load(velociraptor_base_name)
+        self.loader = RegionLoader(
+            snapshot_path, profile_properties(quantities), cell_cache_bytes
+        )
+        self.metadata = self.loader.snapshot.metadata
+        self.quantities = quantities
+
+        length = self.loader.snapshot.units.length
+        # Physical kpc per comoving internal length unit.
+        self.to_kpc = float((self.metadata.a * length).to("kpc"))
+        self.boxsize = (self.metadata.boxsize / length).to("dimensionless").value
+
+        self.bin_edges = radial_bin_edges.to("kpc").value
+        # Projected profiles include the particles up to the largest radius
+        # in front of and behind the galaxy.
+        self.projected_depth = self.bin_edges[-1]
+        self.search_radius = np.hypot(self.bin_edges[-1], self.projected_depth)
+
+        volumes = 4.0 * np.pi / 3.0 * np.diff(self.bin_edges ** 3)
+        areas = np.pi * np.diff(self.bin_edges ** 2)
+        self.bin_sizes = {
+            geometry: volumes if geometry == "3d" else areas for geometry in geometries
+        }
+
+        return
+
+    def centres(self, halo_ids):
+        """
+        Centres of `halo_ids` in comoving internal units, as the images.
+        """
+
+        a = self.metadata.a
+        positions = self.catalogue.positions
+
+        centres = unyt_array(
+            [
+                positions.xcmbp[halo_ids],
+                positions.ycmbp[halo_ids],
+                positions.zcmbp[halo_ids],
+            ]
+        ).T
+
+        centres = (centres / a / self.loader.snapshot.units.length).to("dimensionless")
+
+        return centres.value
+
+    def batches(self, halo_ids, batch_size: int):
+        """
+        Splits `halo_ids` into batches of nearby halos.
+        """
+
+        halo_ids = np.asarray(halo_ids)
+        centres = self.centres(halo_ids)
+
+        return [halo_ids[batch] for batch in self.loader.batches(centres, batch_size)]
+
+    def rotations(self, halo_ids):
+        """
+        Rotation matrices into the frame of each projected geometry for each
+        of `halo_ids`, the same as for the images.
+        """
+
+        rotations = {geometry: [] for geometry in geometries[1:]}
+
+        for halo_id in halo_ids:
+            galaxy_attributes = catalogue_galaxy_attributes(
+                self.catalogue, halo_id, self.metadata
+            )
+
+            for geometry, matrices in rotations.items():
+                matrices.append(projection_rotation(geometry, galaxy_attributes)[0])
+
+        return {
+            geometry: np.array(matrices) for geometry, matrices in rotations.items()
+        }
+
+    def binned_sums(self, data, particle_type: str, centres, rotations):
+        """
+        Sums in each radial bin and geometry around each of `centres` for the
+        profiles of `particle_type`, as a dictionary of geometry -> profile
+        name -> (sums of the quantity, times the weight if there is one, and
+        sums of the weight or None), each of shape (len(centres), bins).
+        """
+
+        particles = getattr(data, particle_type)
+        quantities = {
+            name: quantity
+            for name, quantity in self.quantities.items()
+            if quantity.particle_type == particle_type
+        }
+
+        coordinates = (
+            particles.coordinates / self.loader.snapshot.units.length
+        ).to("dimensionless")
+
+        if len(quantities) == 0 or len(coordinates) == 0:
+            return {}
+
+        tree = ParticleTree(coordinates.value, self.boxsize)
+        centre_indices, particle_indices = tree.neighbours(
+            centres, self.search_radius / self.to_kpc
+        )
+        # Nearest periodic images, in physical kpc.
+        separations = (
+            tree.separations(centres, centre_indices, particle_indices) * self.to_kpc
+        )
+
+        # The neighbours of each centre are contiguous, so each halo is
+        # rotated with a single matrix product.
+        boundaries = np.searchsorted(centre_indices, np.arange(len(centres) + 1))
+
+        radii = {"3d": np.sqrt((separations ** 2).sum(axis=1))}
+        in_slab = {"3d": np.s_[:]}
+
+        for geometry, matrices in rotations.items():
+            rotated = np.empty_like(separations)
+
+            for matrix, start, stop in zip(matrices, boundaries[:-1], boundaries[1:]):
+                rotated[start:stop] = separations[start:stop] @ matrix.T
+
+            in_slab[geometry] = np.abs(rotated[:, 2]) <= self.projected_depth
+            radii[geometry] = np.hypot(rotated[:, 0], rotated[:, 1])[in_slab[geometry]]
+
+        values = {}
+
+        def neighbour_values(name, units=None):
+            if (name, units) not in values:
+                property_values = getattr(particles, name)
+                if units is not None:
+                    property_values = property_values.to(units)
+
+                values[(name, units)] = np.asarray(property_values, dtype=np.float64)[
+                    particle_indices
+                ]
+
+            return values[(name, units)]
+
+        sums = {}
+
+        for geometry in geometries:
+            slab = in_slab[geometry]
+            weight_sums = {}
+
+            def binned(weights):
+                return group_by_halo(
+                    centre_indices[slab],
+                    radii[geometry],
+                    len(centres),
+                    bins=self.bin_edges,
+                    weights=weights[slab],
+                )
+
+            sums[geometry] = {}
+
+            for name, quantity in quantities.items():
+                weights = neighbour_values(quantity.quantity, quantity.units)
+
+                if quantity.weight is None:
+                    sums[geometry][name] = (binned(weights), None)
+                    continue
+
+                weight = neighbour_values(quantity.weight)
+                if quantity.weight not in weight_sums:
+                    weight_sums[quantity.weight] = binned(weight)
+
+                sums[geometry][name] = (
+                    binned(weights * weight),
+                    weight_sums[quantity.weight],
+                )
+
+        return sums
+
+    def profile_batch(self, halo_ids):
+        """
+        Profiles of a batch of nearby halos, as a dictionary of geometry ->
+        profile name -> array of shape (len(halo_ids), bins).
+        """
+
+        centres = self.centres(halo_ids)
+        half_widths = np.full(len(halo_ids), self.search_radius / self.to_kpc)
+
+        # All the cells around the batch, read at once.
+        regions = self.loader.load(centres, half_widths)
+        data = HaloRegion(
+            self.loader, np.unique(np.concatenate([region.cells for region in regions]))
+        )
+        rotations = self.rotations(halo_ids)
+
+        sums = {geometry: {} for geometry in geometries}
+        for particle_type in profile_properties(self.quantities):
+            if particle_type not in self.loader.cells.counts:
+                continue
+
+            type_sums = self.binned_sums(data, particle_type, centres, rotations)
+            for geometry, geometry_sums in type_sums.items():
+                sums[geometry].update(geometry_sums)
+
+        empty = np.zeros((len(halo_ids), len(self.bin_edges) - 1))
+        profiles = {geometry: {} for geometry in geometries}
+
+        for geometry in geometries:
+            for name, quantity in self.quantities.items():
+                total, weights = sums[geometry].get(name, (empty, empty))
+
+                if quantity.weight is None:
+                    profiles[geometry][name] = total / self.bin_sizes[geometry]
+                else:
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        profiles[geometry][name] = np.where(
+                            weights > 0.0, total / weights, np.nan
+                        )
+
+        return profiles
+
+    def profile_units(self, name: str, geometry: str) -> str:
+        quantity = self.quantities[name]
+
+        if quantity.weight is not None:
+            return quantity.units
+
+        return f"({quantity.units}) / kpc**{3 if geometry == '3d' else 2}"
+
+    def profiles(self, halo_ids, batch_size: int = 256):
+        """
+        Profiles of all of `halo_ids`, as a dictionary of geometry -> profile
+        name -> unyt array of shape (len(halo_ids), bins).
+        """
+
+        halo_ids = np.asarray(halo_ids)
+        rows = {halo_id: row for row, halo_id in enumerate(halo_ids)}
+        profiles = {
+            geometry: {
+                name: np.zeros((len(halo_ids), len(self.bin_edges) - 1))
+                for name in self.quantities
+            }
+            for geometry in geometries
+        }
+
+        for batch in self.batches(halo_ids, batch_size):
+            batch_rows = [rows[halo_id] for halo_id in batch]
+
+            for geometry, batch_profiles in self.profile_batch(batch).items():
+                for name, values in batch_profiles.items():
+                    profiles[geometry][name][batch_rows] = values
+
+        return {
+            geometry: {
+                name: unyt_array(values, self.profile_units(name, geometry))
+                for name, values in geometry_profiles.items()
+            }
+            for geometry, geometry_profiles in profiles.items()
+        }
+
+
+def stack_profiles(profiles, stellar_masses):
+    """
+    Percentiles (`stacked_percentiles`) of the `profiles` of the galaxies
+    in each bin of stellar mass, as arrays of shape (number of mass bins,
+    number of percentiles, bins), and the number of galaxies in each bin.
+    """
+
+    bin_indices = np.digitize(stellar_masses, stellar_mass_bins) - 1
+    number_of_mass_bins = len(stellar_mass_bins) - 1
+    counts = np.bincount(
+        bin_indices[bin_indices >= 0], minlength=number_of_mass_bins + 1
+    )[:number_of_mass_bins]
+
+    stacked = {}
+
+    for geometry, geometry_profiles in profiles.items():
+        stacked[geometry] = {}
+
+        for name, values in geometry_profiles.items():
+            percentiles = np.full(
+                (number_of_mass_bins, len(stacked_percentiles), values.shape[1]),
+                np.nan,
+            )
+
+            for index in range(number_of_mass_bins):
+                in_bin = values[bin_indices == index].value
+
+                if len(in_bin) == 0:
+                    continue
+
+                with np.errstate(invalid="ignore"):
+                    percentiles[index] = np.nanpercentile(
+                        in_bin, stacked_percentiles, axis=0
+                    )
+
+            stacked[geometry][name] = unyt_array(percentiles, values.units)
+
+    return stacked, counts
+
+
+def write_profiles(filename, galaxy_indices, stellar_masses, profiles, stacked, counts):
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset("halo_indices", data=galaxy_indices)
+
+        def write(group, name, values, label=None):
+            dataset = group.create_dataset(
+                name, data=values.value, compression="gzip", shuffle=True
+            )
+            dataset.attrs["units"] = str(values.units)
+
+            if label is not None:
+                dataset.attrs["label"] = label
+
+            return
+
+        write(handle, "stellar_mass_30_kpc", stellar_masses)
+        write(handle, "radial_bin_edges", radial_bin_edges)
+
+        for geometry, geometry_profiles in profiles.items():
+            group = handle.create_group(geometry)
+
+            for name, values in geometry_profiles.items():
+                write(group, name, values, profile_quantities[name].label)
+
+        stacked_group = handle.create_group("stacked")
+        write(stacked_group, "stellar_mass_bins", stellar_mass_bins)
+        stacked_group.create_dataset("number_of_galaxies", data=counts)
+        stacked_group.attrs["percentiles"] = stacked_percentiles
+
+        for geometry, geometry_stacked in stacked.items():
+            group = stacked_group.create_group(geometry)
+
+            for name, values in geometry_stacked.items():
+                write(group, name, values, profile_quantities[name].label)
+
+    return
+
+
+def make_plots(stacked, counts, output_path):
+    """
+    Plots the median profile, and the 16-84th percentile range, of the
+    galaxies in each stellar mass bin; one figure per profile, with a
+    panel per geometry.
+    """
+
+    bin_centres = np.sqrt(radial_bin_edges[1:] * radial_bin_edges[:-1]).value
+    low, median, high = [stacked_percentiles.index(p) for p in [16, 50, 84]]
+
+    for name, quantity in profile_quantities.items():
+        fig, axes = plt.subplots(
+            1, len(geometries), figsize=(3.3 * len(geometries), 3.0)
+        )
+
+        for ax, geometry in zip(axes, geometries):
+            percentiles = stacked[geometry][name]
+            ax.loglog()
+
+            for index in range(len(stellar_mass_bins) - 1):
+                if counts[index] == 0:
+                    continue
+
+                label = (
+                    f"$10^{{{np.log10(stellar_mass_bins[index].value):.1f}}}$"
+                    f" - $10^{{{np.log10(stellar_mass_bins[index + 1].value):.1f}}}$"
+                    f" M$_\\odot$ ({counts[index]})"
+                )
+
+                ax.plot(
+                    bin_centres,
+                    percentiles[index, median].value,
+                    color=f"C{index}",
+                    label=label,
+                )
+                ax.fill_between(
+                    bin_centres,
+                    percentiles[index, low].value,
+                    percentiles[index, high].value,
+                    color=f"C{index}",
+                    alpha=0.2,
+                )
+
+            radius = "r" if geometry == "3d" else "R"
+            ax.set_xlabel(f"{radius} [kpc]")
+            ax.set_ylabel(
+                f"{quantity.label} [${percentiles.units.latex_repr}$]"
+                if not percentiles.units.is_dimensionless
+                else quantity.label
+            )
+            ax.set_title(geometry_names[geometry])
+
+        axes[0].legend(
+            loc="lower left", fontsize=4, title="$M_*$ (30 kpc)", title_fontsize=4
+        )
+
+        fig.tight_layout()
+        fig.savefig(f"{output_path}/{output_filename}_{name}.png")
+        plt.close(fig)
+
+    return
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Computes radial profiles of the imaged central galaxies."
+    )
+    parser.add_argument("snapshot_path")
+    parser.add_argument("velociraptor_base_name")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=256,
+        help="Number of nearby halos whose profiles are computed together.",
+    )
+    parser.add_argument(
+        "--cell-cache-mb",
+        type=float,
+        default=1024,
+        help="Size of the cache of snapshot cells, in MB.",
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_path):
+        os.mkdir(args.output_path)
+
+    start_time = time.time()
+
+    engine = ProfileEngine(
+        args.snapshot_path,
+        args.velociraptor_base_name,
+        cell_cache_bytes=int(args.cell_cache_mb * 1024 * 1024),
+    )
+
+    galaxy_indices = select_halos(engine.catalogue)
+    stellar_masses = engine.catalogue.apertures.mass_star_30_kpc[galaxy_indices].to(
+        "Solar_Mass"
+    )
+
+    profiles = engine.profiles(galaxy_indices, batch_size=args.batch_size)
+    stacked, counts = stack_profiles(profiles, stellar_masses)
+
+    write_profiles(
+        f"{args.output_path}/{output_filename}.hdf5",
+        galaxy_indices,
+        stellar_masses,
+        profiles,
+        stacked,
+        counts,
+    )
+    make_plots(stacked, counts, args.output_path)
+
+    print(
+        f"Computed the profiles of {len(galaxy_indices)} galaxies in "
+        f"{time.time() - start_time:.1f} s, reading "
+        f"{engine.loader.bytes_read / 1e9:.2f} GB of particle data"
+    )
@@ -0,0 +1,559 @@
+"""
+Stacked face on gas and stellar surface density maps of the galaxies that
+are imaged by `imaging.py`, in bins of stellar mass.
+
+Each galaxy is projected in its own frame, out to `number_of_radii` times
+its `GalaxyAttributes.radius` as in the images, so that the pixels of all
+the galaxies in a bin line up in units of that radius. The projections
+are not drawn: they are added to the sum and count grids of their bin,
+and to a histogram of the log surface density in each pixel, from which
+the median is approximated (to within a fraction of a histogram bin)
+without keeping the maps of all the galaxies. Halos are spread over a
+pool of processes, each accumulating its own grids, which are added
+together at the end.
+
+Produces, in the output path:
+
++ galaxy_stacks.hdf5: the sum, count and histogram grids of each stellar
+  mass bin, with the mean and median maps that are made from them.
++ galaxy_stack_<bin>.png: one figure per stellar mass bin, with the mean
+  and median gas and stellar maps.
+
+Takes the snapshot, the halo catalogue and the output path, as
+`imaging.py`.
+"""
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import attr
+import h5py
+import multiprocessing
+import numba
+import os
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from matplotlib.colors import LogNorm
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+from typing import Optional
+from unyt import unyt_array
+
+from galaxy_profiles import stellar_mass_bins
+from imaging import (
+    HaloRenderer,
+    ViewCache,
+    catalogue_galaxy_attributes,
+    generate_stellar_smoothing_lengths,
+    halo_particle_numbers,
+    project_images,
+    recalculate_stellar_smoothing_lengths,
+    select_halos,
+)
+
+# The images that are stacked, from the default images.
+stacked_images = {"gas": "dens_faceon.png", "stars": "star_faceon.png"}
+stack_properties = {
+    "gas": ["coordinates", "masses", "smoothing_lengths"],
+    "stars": ["coordinates", "masses", "particle_ids"],
+}
+
+surface_density_units = "Solar_Mass / kpc**2"
+# Range and width (in dex) of the histograms of the surface density in
+# each pixel, which the medians are approximated from.
+histogram_limits = {
+    "gas": unyt_array([1e3, 1e10], surface_density_units),
+    "stars": unyt_array([1e4, 1e12], surface_density_units),
+}
+histogram_bin_width = 0.2
+
+output_filename = "galaxy_stacks"
+
+
+class ImageStack(object):
+    """
+    Sum and count grids of the images of one style in each of
+    `number_of_bins` stellar mass bins, with histograms of the log of the
+    pixel values within `limits` (with an extra bin below and above).
+    """
+
+    def __init__(self, number_of_bins: int, resolution: int, limits: unyt_array):
+        self.units = limits.units
+        self.log_edges = np.arange(
+            np.log10(limits[0].value),
+            np.log10(limits[1].value) + 0.5 * histogram_bin_width,
+            histogram_bin_width,
+        )
+
+        shape = (number_of_bins, resolution, resolution)
+        self.sums = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype=np.int64)
+        self.histograms = np.zeros(
+            (number_of_bins, len(self.log_edges) + 1, resolution, resolution),
+            dtype=np.uint32,
+        )
+
+        return
+
+    def add(self, mass_bin: int, image: unyt_array):
+        """
+        Adds `image` to the grids of `mass_bin`.
+        """
+
+        values = image.to(self.units).value
+        finite = np.isfinite(values)
+        values = np.where(finite, values, 0.0)
+
+        self.sums[mass_bin] += values
+        self.counts[mass_bin] += finite
+
+        # Zero (and missing) pixels go in the bin below the histogram.
+        with np.errstate(divide="ignore"):
+            histogram_bins = np.searchsorted(
+                self.log_edges, np.log10(values), side="right"
+            )
+
+        number_of_pixels = values.size
+        self.histograms[mass_bin] += np.bincount(
+            (
+                histogram_bins.ravel() * number_of_pixels
+                + np.arange(number_of_pixels)
+            )[finite.ravel()],
+            minlength=self.histograms[mass_bin].size,
+        ).reshape(self.histograms[mass_bin].shape).astype(np.uint32)
+
+        return
+
+    def merge(self, other: "ImageStack"):
+        """
+        Adds the grids of `other`, a stack of the same style.
+        """
+
+        self.sums += other.sums
+        self.counts += other.counts
+        self.histograms += other.histograms
+
+        return
+
+    def mean(self) -> unyt_array:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return unyt_array(self.sums / self.counts, self.units)
+
+    def median(self) -> unyt_array:
+        """
+        Median of each pixel, interpolated linearly (in log) within the
+        histogram bin that contains it; zero where at least half of the
+        images are below the histogram, and the upper limit where at least
+        half are above it.
+        """
+
+        cumulative = np.cumsum(self.histograms, axis=1, dtype=np.int64)
+        half = 0.5 * self.counts[:, None]
+        index = (cumulative < half).sum(axis=1, keepdims=True)
+
+        inside = np.clip(index, 1, len(self.log_edges) - 1)
+        below = np.take_along_axis(cumulative, inside - 1, axis=1)
+        in_bin = np.take_along_axis(self.histograms, inside, axis=1)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.clip((half - below) / in_bin, 0.0, 1.0)
+
+        log_values = self.log_edges[inside - 1] + fraction * histogram_bin_width
+        log_values[index >= len(self.log_edges)] = self.log_edges[-1]
+
+        values = np.where(index == 0, 0.0, 10.0 ** log_values)[:, 0]
+        values[self.counts == 0] = np.nan
+
+        return unyt_array(values, self.units)
+
+
+class HaloStacker(HaloRenderer):
+    """
+    Projects the stacked images of halos from one snapshot and catalogue
+    at `resolution`, and adds them to the stacks of their stellar mass
+    bins instead of saving them.
+    """
+
+    def __init__(
+        self,
+        snapshot_path: str,
+        velociraptor_base_name: str,
+        resolution: int = 256,
+        cell_cache_bytes: int = 1 << 28,
+        mass_assignment: str = "sph",
+        assignment_smoothing: Optional[float] = None,
+    ):
+        super().__init__(
+            snapshot_path,
+            velociraptor_base_name,
+            ".",
+            cell_cache_bytes=cell_cache_bytes,
+            mass_assignment=mass_assignment,
+            assignment_smoothing=assignment_smoothing,
+            properties=stack_properties,
+        )
+
+        styles = {style.output_filename: style for style in self.image_styles}
+        self.image_styles = [
+            attr.evolve(styles[filename], resolution=resolution)
+            for filename in stacked_images.values()
+        ]
+
+        self.stacks = self.empty_stacks()
+
+        return
+
+    def empty_stacks(self) -> dict:
+        return {
+            image_style.particle_type: ImageStack(
+                len(stellar_mass_bins) - 1,
+                image_style.resolution,
+                histogram_limits[image_style.particle_type],
+            )
+            for image_style in self.image_styles
+        }
+
+    def mass_bins(self, halo_ids) -> np.ndarray:
+        """
+        Stellar mass bin of each of `halo_ids`, or -1 outside of the bins.
+        """
+
+        stellar_masses = self.catalogue.apertures.mass_star_30_kpc[halo_ids].to(
+            "Solar_Mass"
+        )
+        mass_bins = np.digitize(stellar_masses.value, stellar_mass_bins.value) - 1
+
+        return np.where(mass_bins < len(stellar_mass_bins) - 1, mass_bins, -1)
+
+    def render(self, halo_id: int, parallel: bool = False, data=None):
+        """
+        Projects the stacked images of halo `halo_id` and adds them to the
+        stacks.
+        """
+
+        if data is None:
+            data = self.loader.load(*self.regions([halo_id]))[0]
+
+        galaxy_attributes = catalogue_galaxy_attributes(
+            self.catalogue, halo_id, data.metadata
+        )
+
+        mass_bin = self.mass_bins([halo_id])[0]
+
+        if mass_bin < 0:
+            return
+
+        if recalculate_stellar_smoothing_lengths and any(
+            image_style.particle_type == "stars" and image_style.deposit == "sph"
+            for image_style in self.image_styles
+        ):
+            generate_stellar_smoothing_lengths(data)
+
+        images = project_images(
+            data,
+            self.image_styles,
+            galaxy_attributes,
+            parallel,
+            view_cache=ViewCache(data, galaxy_attributes, self.image_styles),
+        )
+
+        for image, image_style in zip(images, self.image_styles):
+            self.stacks[image_style.particle_type].add(mass_bin, image)
+
+        return
+
+
+# The stacker of each process in the pool.
+_worker_stacker = None
+
+
+def _initialise_worker(*stacker_arguments):
+    global _worker_stacker
+
+    # Each process projects on one core; the pool provides the parallelism.
+    numba.set_num_threads(1)
+
+    _worker_stacker = HaloStacker(*stacker_arguments)
+
+    return
+
+
+def _stack_in_worker(batches):
+    failures = []
+
+    for halo_ids in batches:
+        failures.extend(_worker_stacker.render_batch(halo_ids, parallel=False))
+
+    # A process can be given more than one group of batches.
+    stacks = _worker_stacker.stacks
+    _worker_stacker.stacks = _worker_stacker.empty_stacks()
+
+    return failures, stacks
+
+
+def stack_halos(
+    snapshot_path: str,
+    velociraptor_base_name: str,
+    output_path: str,
+    processes: int = 1,
+    resolution: int = 256,
+    batch_size: int = 32,
+    cell_cache_bytes: int = 1 << 32,
+    mass_assignment: str = "sph",
+    assignment_smoothing: Optional[float] = None,
+):
+    """
+    Stacks the images of all the selected halos, spreading them over a pool
+    of `processes` processes (each with its own stacks, which are merged),
+    in batches of `batch_size` nearby halos, read through caches of
+    `cell_cache_bytes` bytes in total. The halo membership index is kept
+    in `output_path`.
+
+    Returns the stacks of each particle type, the styles of the stacked
+    images, the number of galaxies in each stellar mass bin, and the name
+    of the radius that the images are scaled by.
+    """
+
+    stacker_arguments = (
+        snapshot_path,
+        velociraptor_base_name,
+        resolution,
+        cell_cache_bytes // max(processes, 1),
+        mass_assignment,
+        assignment_smoothing,
+    )
+    halo_stacker = HaloStacker(*stacker_arguments)
+    catalogue = halo_stacker.catalogue
+
+    halo_ids = select_halos(catalogue)
+    mass_bins = halo_stacker.mass_bins(halo_ids)
+    particle_numbers = halo_particle_numbers(velociraptor_base_name, output_path)
+
+    start_time = time.time()
+    failures = []
+
+    batches = halo_stacker.batches(halo_ids, batch_size)
+    # Largest first, and dealt out in turn, so that each process gets a
+    # similar amount of work.
+    batches.sort(key=lambda batch: particle_numbers[batch].sum(), reverse=True)
+
+    if processes > 1 and len(batches) > 1:
+        with multiprocessing.Pool(
+            processes, initializer=_initialise_worker, initargs=stacker_arguments
+        ) as pool:
+            for worker_failures, worker_stacks in pool.imap_unordered(
+                _stack_in_worker,
+                [batches[start::processes] for start in range(processes)],
+            ):
+                failures.extend(worker_failures)
+
+                for particle_type, stack in worker_stacks.items():
+                    halo_stacker.stacks[particle_type].merge(stack)
+    else:
+        for batch in batches:
+            failures.extend(halo_stacker.render_batch(batch))
+
+    for halo_id, error in failures:
+        print(f"Unable to stack halo {halo_id}: {error}")
+
+    failed = np.isin(halo_ids, [halo_id for halo_id, _ in failures])
+    stacked = np.logical_and(~failed, mass_bins >= 0)
+    number_of_galaxies = np.bincount(
+        mass_bins[stacked], minlength=len(stellar_mass_bins) - 1
+    )
+
+    print(
+        f"Stacked {number_of_galaxies.sum()} halos with {processes} processes "
+        f"in {time.time() - start_time:.1f} s"
+    )
+
+    radius_name = (
+        catalogue_galaxy_attributes(
+            catalogue, halo_ids[0], halo_stacker.loader.snapshot.metadata
+        ).radius_name
+        if len(halo_ids) > 0
+        else "$R$"
+    )
+
+    return (
+        halo_stacker.stacks,
+        halo_stacker.image_styles,
+        number_of_galaxies,
+        radius_name,
+    )
+
+
+def write_stacks(filename, stacks, number_of_galaxies, number_of_radii):
+    with h5py.File(filename, "w") as handle:
+        handle.attrs["number_of_radii"] = number_of_radii
+
+        dataset = handle.create_dataset(
+            "stellar_mass_bins", data=stellar_mass_bins.value
+        )
+        dataset.attrs["units"] = str(stellar_mass_bins.units)
+        handle.create_dataset("number_of_galaxies", data=number_of_galaxies)
+
+        for particle_type, stack in stacks.items():
+            group = handle.create_group(particle_type)
+            group.attrs["units"] = str(stack.units)
+
+            datasets = {
+                "sums": stack.sums,
+                "counts": stack.counts,
+                "histograms": stack.histograms,
+                "histogram_log_edges": stack.log_edges,
+                "mean": stack.mean().value,
+                "median": stack.median().value,
+            }
+
+            for name, values in datasets.items():
+                group.create_dataset(
+                    name, data=values, compression="gzip", shuffle=True
+                )
+
+    return
+
+
+def save_stack_figures(
+    stacks, number_of_galaxies, image_styles, radius_name, output_path
+):
+    """
+    Saves one figure for each stellar mass bin with galaxies in it, with
+    the mean and median maps of each stacked image.
+    """
+
+    means = {particle_type: stack.mean() for particle_type, stack in stacks.items()}
+    medians = {
+        particle_type: stack.median() for particle_type, stack in stacks.items()
+    }
+
+    for mass_bin, number in enumerate(number_of_galaxies):
+        if number == 0:
+            continue
+
+        low, high = np.log10(stellar_mass_bins[mass_bin : mass_bin + 2].value)
+
+        fig, axes = plt.subplots(
+            len(image_styles), 2, figsize=(7.0, 3.3 * len(image_styles))
+        )
+        axes = np.atleast_2d(axes)
+
+        for row, image_style in zip(axes, image_styles):
+            extent = image_style.number_of_radii * np.array([-1, 1, -1, 1])
+            # The mean and median share the same colour scale.
+            norm = LogNorm(
+                vmin=image_style.fill_below.to(surface_density_units).value,
+                vmax=np.nanmax(means[image_style.particle_type][mass_bin].value),
+            )
+
+            for ax, (kind, maps) in zip(row, [("Mean", means), ("Median", medians)]):
+                image = maps[image_style.particle_type][mass_bin].value
+
+                ax.set_facecolor(image_style.plot_background_color)
+                im = ax.imshow(
+                    image.T,
+                    origin="lower",
+                    norm=norm,
+                    cmap=image_style.cmap,
+                    extent=extent,
+                )
+
+                cax = make_axes_locatable(ax).append_axes("right", size="5%", pad=0.05)
+                fig.colorbar(im, cax=cax, label="$\\Sigma$ [M$_\\odot$ kpc$^{-2}$]")
+
+                ax.set_title(f"{kind} {image_style.particle_type}", fontsize=8)
+                ax.set_xlabel(f"$x$ / {radius_name}")
+                ax.set_ylabel(f"$y$ / {radius_name}")
+
+        fig.suptitle(
+            f"$M_* = 10^{{{low:.1f}}}$ - $10^{{{high:.1f}}}$ M$_\\odot$ "
+            f"({number} galaxies)",
+            fontsize=9,
+        )
+        fig.tight_layout()
+        fig.savefig(f"{output_path}/galaxy_stack_{low:.1f}_{high:.1f}.png")
+        plt.close(fig)
+
+    return
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Stacks face on images of the central galaxies in bins of "
+        "stellar mass."
+    )
+    parser.add_argument("snapshot_path")
+    parser.add_argument("velociraptor_base_name")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "-n",
+        "--processes",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Number of processes.",
+    )
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=256,
+        help="Resolution of the stacked images.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Number of nearby halos whose particles are read together.",
+    )
+    parser.add_argument(
+        "--cell-cache-mb",
+        type=float,
+        default=4096,
+        help="Total size of the caches of snapshot cells, shared between the "
+        "processes, in MB.",
+    )
+    parser.add_argument(
+        "--mass-assignment",
+        choices=["sph", "ngp", "cic", "tsc"],
+        default="sph",
+        help="Assign star particles to pixels, without smoothing lengths. "
+        "Default: sph, with smoothing lengths.",
+    )
+    parser.add_argument(
+        "--assignment-smoothing",
+        type=float,
+        default=1.0,
+        help="Width (in pixels) of the Gaussian that assigned grids are smoothed "
+        "with; 0 for none. Default: 1.",
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_path):
+        os.mkdir(args.output_path)
+
+    stacks, image_styles, number_of_galaxies, radius_name = stack_halos(
+        args.snapshot_path,
+        args.velociraptor_base_name,
+        args.output_path,
+        processes=args.processes,
+        resolution=args.resolution,
+        batch_size=args.batch_size,
+        cell_cache_bytes=int(args.cell_cache_mb * 1024 * 1024),
+        mass_assignment=args.mass_assignment,
+        assignment_smoothing=args.assignment_smoothing or None,
+    )
+
+    write_stacks(
+        f"{args.output_path}/{output_filename}.hdf5",
+        stacks,
+        number_of_galaxies,
+        image_styles[0].number_of_radii,
+    )
+    save_stack_figures(
+        stacks, number_of_galaxies, image_styles, radius_name, args.output_path
+    )
@@ -0,0 +1,190 @@
+"""
+On-disk cache of projected pixel grids, addressed by their content.
+
+Each grid is stored under a digest of everything that determines it: the
+snapshot (file name, size and modification time), the particle type and
+the projected quantity (with its units), the particles themselves (through
+their smoothing lengths), the projection, rotation and region, and the
+resolution. The colour map, limits, fill values and decorations of an
+image do not change the grid, so re-rendering an image with different
+ones never reprojects.
+
+Grids are stored as compressed float32 arrays, along with the inputs that
+they were made from, as ``<directory>/<xx>/<digest>.npz``. Once the grids
+in the directory take more than ``maximal_bytes``, the least recently used
+ones are removed.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from typing import Optional
+
+from helpers.sidecar_cache import atomic_output, file_identity
+
+# Bump this if the projection changes, to invalidate all cached grids.
+cache_version = 1
+
+
+def _canonical(value):
+    """
+    A JSON-serialisable, stable representation of ``value``.
+    """
+
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    elif isinstance(value, float):
+        return repr(float(value))
+    elif isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items())}
+    elif isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    elif hasattr(value, "units"):
+        return {"value": _canonical(np.asarray(value)), "units": str(value.units)}
+    elif isinstance(value, np.ndarray):
+        if value.size > 16:
+            # Large arrays (e.g. smoothing lengths) are summarised by a digest.
+            array = np.ascontiguousarray(value)
+            return {
+                "shape": list(array.shape),
+                "dtype": str(array.dtype),
+                "sha256": hashlib.sha256(array.tobytes()).hexdigest(),
+            }
+
+        return _canonical(value.tolist())
+    elif isinstance(value, np.generic):
+        return _canonical(value.item())
+
+    return str(value)
+
+
+def snapshot_identity(filename: str) -> dict:
+    """
+    Path, size and modification time of the snapshot ``filename``.
+    """
+
+    return {"path": os.path.abspath(filename), "identity": file_identity(filename)}
+
+
+class GridCache(object):
+    """
+    Cache of pixel grids in ``directory``, of at most ``maximal_bytes``
+    bytes.
+    """
+
+    def __init__(self, directory: str, maximal_bytes: int = 1 << 31):
+        self.directory = directory
+        self.maximal_bytes = maximal_bytes
+
+        # Other processes may share the directory, so this is only an
+        # estimate, which is corrected whenever grids are evicted.
+        self.stored_bytes = sum(size for _, size, _ in self.stored_grids())
+
+        return
+
+    def stored_grids(self) -> list:
+        """
+        File name, size and last access (modification) time of each of the
+        stored grids.
+        """
+
+        grids = []
+
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".npz"):
+                    continue
+
+                try:
+                    stat = os.stat(f"{root}/{filename}")
+                except OSError:
+                    # Evicted by another process.
+                    continue
+
+                grids.append((f"{root}/{filename}", stat.st_size, stat.st_mtime))
+
+        return grids
+
+    def evict(self):
+        """
+        Removes the least recently used grids until the rest take at most
+        ``maximal_bytes``.
+        """
+
+        grids = sorted(self.stored_grids(), key=lambda grid: grid[2])
+        self.stored_bytes = sum(size for _, size, _ in grids)
+
+        for filename, size, _ in grids:
+            if self.stored_bytes <= self.maximal_bytes:
+                break
+
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+            self.stored_bytes -= size
+
+        return
+
+    @staticmethod
+    def key(**inputs) -> str:
+        """
+        Stable digest of all of the ``inputs`` of a grid.
+        """
+
+        description = json.dumps(
+            _canonical({"version": cache_version, **inputs}), sort_keys=True
+        )
+
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def filename(self, key: str) -> str:
+        return f"{self.directory}/{key[:2]}/{key}.npz"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        The grid stored under ``key``, or None.
+        """
+
+        filename = self.filename(key)
+
+        try:
+            with np.load(filename) as stored:
+                grid = stored["grid"]
+
+            # Marks the grid as recently used.
+            os.utime(filename)
+        except (OSError, KeyError, ValueError):
+            return None
+
+        return grid
+
+    def put(self, key: str, grid: np.ndarray, **inputs):
+        """
+        Stores ``grid`` under ``key``, along with the ``inputs`` that it was
+        made from.
+        """
+
+        filename = self.filename(key)
+
+        # In a read-only or full cache directory, the grid is simply not cached.
+        with atomic_output(filename, ignore_errors=True) as temporary_filename:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+            with open(temporary_filename, "wb") as handle:
+                np.savez_compressed(
+                    handle,
+                    grid=np.asarray(grid, dtype=np.float32),
+                    metadata=json.dumps(_canonical(inputs), sort_keys=True),
+                )
+
+            self.stored_bytes += os.path.getsize(temporary_filename)
+
+        if self.stored_bytes > self.maximal_bytes:
+            self.evict()
+
+        return
@@ -8,68 +8,134 @@ Creates images of the background of a given run in several views,
 + Metal mass fractions
 
 Takes as the first argument the snapshot filename, and as the second
-the resoltion. As the final argument it takes the output path.
+the catalogue (which is not used). As the final argument it takes the
+output path.
+
+The whole box is projected out-of-core (see box_projection.py), so the
+resolution is limited by the disk space for the grids (24 bytes per
+pixel) rather than by the memory. With --tiles, the maps are also written
+as DeepZoom tile pyramids (see tile_pyramid.py) in output_path/box_maps,
+to be browsed with output_path/box_maps.html, and the PNGs are previews
+of at most 2048 pixels a side.
 """
 
-from swiftsimio import load
-from swiftsimio.visualisation import project_gas_pixel_grid
 from matplotlib.colors import LogNorm
 from cmocean import cm
 
-import numpy as np
-import matplotlib.pyplot as plt
-import sys
-import unyt
+import argparse as ap
+import multiprocessing
+import os
 
-from unyt import Mpc
+from box_projection import project_box
+from fast_render import rasterise_in_strips, write_image
+from tile_pyramid import write_pyramid, write_viewer
 
-units = Mpc
+# Maps in the tile pyramid viewer, by title.
+pyramids = {}
 
-data = load(sys.argv[1])
-output_path = sys.argv[3]
 
-res = 2048
+def make_image(image, cmap, filename, vmin=None, vmax=None, denominator=None):
+    norm = LogNorm(vmin=vmin, vmax=vmax)
 
+    if tiles:
+        write_pyramid(
+            image,
+            f"{output_path}/box_maps/{filename}",
+            cmap,
+            norm,
+            "white",
+            denominator,
+            preview_filename=f"{output_path}/{filename}.png",
+        )
 
-def make_image(image, cmap, filename, vmin=None, vmax=None):
-    fig, ax = plt.subplots(figsize=(4, 4), dpi=res // 4)
-    fig.subplots_adjust(0, 0, 1, 1)
-    ax.axis("off")
+        pyramids[filename.replace("_", " ").capitalize()] = f"box_maps/{filename}.dzi"
 
-    ax.imshow(
-        LogNorm(vmin=vmin, vmax=vmax)(image),
-        cmap=cmap,
-        extent=[
-            0 * units,
-            data.metadata.boxsize[0].to(units),
-            0 * units,
-            data.metadata.boxsize[0].to(units),
-        ],
-        origin="lower",
-    )
+        return
 
-    fig.savefig(f"{output_path}/{filename}.png")
-    plt.close(fig)
+    # One pixel per pixel of the grid, drawn directly without a figure.
+    write_image(
+        rasterise_in_strips(image, cmap, norm, "white", denominator),
+        f"{output_path}/{filename}.png",
+    )
 
     return
 
 
-common_parameters = dict(data=data, resolution=res, parallel=True)
-norm = project_gas_pixel_grid(**common_parameters, project=None).T
-mass = project_gas_pixel_grid(**common_parameters).T
-
-normed = (
-    lambda project: project_gas_pixel_grid(**common_parameters, project=project).T
-    / norm
-)
+if __name__ == "__main__":
+    parser = ap.ArgumentParser(description="Images of the gas in the whole box.")
 
-diff = normed("diffusion_parameters")
-visc = normed("viscosity_parameters")
-temp = normed("temperatures")
-mmf = normed("metal_mass_fractions")
+    parser.add_argument("snapshot", help="Snapshot to image.")
+    parser.add_argument("catalogue", help="Halo catalogue (not used).")
+    parser.add_argument("output_path", help="Directory to write the images to.")
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=2048,
+        help="Number of pixels along each side of the images. Default: 2048.",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=2048,
+        help="Pixels along each side of the tiles that are deposited at once.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1 << 22,
+        help="Number of particles that each process reads at once.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of processes to project with. Default: all of the CPUs.",
+    )
+    parser.add_argument(
+        "--scratch",
+        default=None,
+        help="Directory for the accumulation grids. Default: the output path.",
+    )
+    parser.add_argument(
+        "--tiles",
+        action="store_true",
+        help="Also write the maps as tile pyramids, with a page to browse them.",
+    )
 
-make_image(mass, "inferno", "projected_gas_density")
-make_image(diff, cm.ice, "diffusion_parameters", 0.01, 1.0)
-make_image(visc, cm.curl, "viscosity_parameters", 0.2, 2.0)
-make_image(temp, "twilight", "temperatures", 1e2, 1e8)
-make_image(mmf, "cubehelix", "metal_mass_fractions", 0.0012, 1.2)
+    args = parser.parse_args()
+
+    output_path = args.output_path
+    tiles = args.tiles
+    scratch = args.scratch if args.scratch is not None else output_path
+    grid_filename = f"{scratch}/box_projection.{os.getpid()}.dat"
+
+    try:
+        # All of the images are made in a single pass over the gas particles.
+        norm, mass, diff, visc, temp, mmf = project_box(
+            args.snapshot,
+            grid_filename,
+            resolution=args.resolution,
+            project=[
+                None,
+                "Masses",
+                "DiffusionParameters",
+                "ViscosityParameters",
+                "Temperatures",
+                "MetalMassFractions",
+            ],
+            processes=args.processes,
+            tile_size=args.tile_size,
+            chunk_size=args.chunk_size,
+        )
+
+        make_image(mass, "inferno", "projected_gas_density")
+        make_image(diff, cm.ice, "diffusion_parameters", 0.01, 1.0, norm)
+        make_image(visc, cm.curl, "viscosity_parameters", 0.2, 2.0, norm)
+        make_image(temp, "twilight", "temperatures", 1e2, 1e8, norm)
+        make_image(mmf, "cubehelix", "metal_mass_fractions", 0.0012, 1.2, norm)
+
+        if tiles:
+            write_viewer(f"{output_path}/box_maps.html", pyramids, "Gas in the box")
+    finally:
+        if os.path.exists(grid_filename):
+            os.remove(grid_filename)
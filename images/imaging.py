@@ -15,17 +15,22 @@ which produces the output images.
 """
 
 import attr
-import cachetools
+import h5py
 import matplotlib.pyplot as plt
+import multiprocessing
+import numba
 import numpy as np
+import os
+import sys
+import time
 
 from matplotlib.colors import LogNorm
 from matplotlib.patches import Circle
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from PIL import Image
 
 from unyt import unyt_quantity, unyt_array
 
-from swiftsimio.visualisation.projection import project_pixel_grid
 from swiftsimio.visualisation.slice import kernel_gamma
 from swiftsimio.visualisation.smoothing_length_generation import (
     generate_smoothing_lengths,
@@ -34,10 +39,46 @@ from swiftsimio.visualisation.rotation import rotation_matrix_from_vector
 
 from typing import Optional
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-# Not threadsafe, but we're ok because this is python. We use this
-# to cache the output 'mass image' from each image.
-image_cache = cachetools.LRUCache(maxsize=32)
+from fast_render import (
+    paste_colour_bar,
+    paste_dashed_circle,
+    paste_text,
+    rasterise,
+    write_image,
+)
+from grid_cache import GridCache, snapshot_identity
+from multi_projection import (
+    assignment_schemes,
+    deposit_pixel_grids,
+    rotated_positions,
+    smooth_pixel_grids,
+)
+
+from helpers.halo_particles import membership_index, velociraptor_filenames
+from helpers.region_loader import RegionLoader
+from helpers.sidecar_cache import atomic_output
+from helpers.smoothing_lengths import smoothing_lengths_from_sidecar
+
+
+# Stellar smoothing lengths are re-generated from the stars' neighbours in
+# the script mode (or read from images/smoothing_length_sidecar.py).
+recalculate_stellar_smoothing_lengths = True
+
+# Particle properties used by the default images, read in bulk for each
+# batch of halos.
+image_properties = {
+    "gas": [
+        "coordinates",
+        "masses",
+        "smoothing_lengths",
+        "temperatures",
+        "star_formation_rates",
+    ],
+    "dark_matter": ["coordinates", "masses", "particle_ids"],
+    "stars": ["coordinates", "masses", "particle_ids"],
+}
 
 
 def latex_float(f):
@@ -88,9 +129,22 @@ class ImageAttributes(object):
     text_color: str = attr.ib(default="white")
     plot_background_color: str = attr.ib("black")
 
+    # Draw the image with a matplotlib figure, or rasterise it directly
+    # with Pillow ("pillow"), which is much faster.
+    renderer: str = attr.ib(default="matplotlib")
+
     # How far out do you want to plot in terms of GalaxyAttributes.radius?
     number_of_radii: float = attr.ib(default=1.5)
 
+    # Deposit the particles with their SPH kernels ("sph"), or assign them
+    # to the nearest pixels ("ngp", "cic" or "tsc"), which needs no smoothing
+    # lengths and is much cheaper for stars and dark matter.
+    deposit: str = attr.ib(default="sph")
+    # Width (in pixels) of a Gaussian to smooth assigned grids with, and
+    # the number of particles to smooth over, to make the width adaptive.
+    gaussian_smoothing: Optional[float] = attr.ib(default=None)
+    adaptive_neighbours: Optional[int] = attr.ib(default=None)
+
 
 @attr.s
 class GalaxyAttributes(object):
@@ -116,12 +170,20 @@ def get_rotation(
     Gets the rotation matrix and center if required.
     """
 
-    if image_attributes.projection == "faceon":
+    return projection_rotation(image_attributes.projection, galaxy_attributes)
+
+
+def projection_rotation(projection: str, galaxy_attributes: GalaxyAttributes):
+    """
+    Gets the rotation matrix and center of `projection`, if required.
+    """
+
+    if projection == "faceon":
         return (
             rotation_matrix_from_vector(galaxy_attributes.normal_vector),
             galaxy_attributes.center,
         )
-    elif image_attributes.projection == "edgeon":
+    elif projection == "edgeon":
         return (
             rotation_matrix_from_vector(galaxy_attributes.normal_vector, "y"),
             galaxy_attributes.center,
@@ -130,18 +192,47 @@ def get_rotation(
         return None, None
 
 
-def project(
-    data, image_attributes: ImageAttributes, galaxy_attributes: GalaxyAttributes
-):
+def generate_stellar_smoothing_lengths(data):
     """
-    Creates a projection image of `data` given attributes.
+    Replaces the smoothing lengths of the stars by ones that encompass 57
+    neighbours, from the snapshot's smoothing length sidecar if there is
+    one.
+    """
+
+    smoothing_lengths = smoothing_lengths_from_sidecar(data, "stars")
+
+    if smoothing_lengths is None:
+        smoothing_lengths = generate_smoothing_lengths(
+            coordinates=data.stars.coordinates,
+            boxsize=data.metadata.boxsize,
+            kernel_gamma=kernel_gamma,
+            neighbours=57,
+            speedup_fac=1,
+            dimension=3,
+        )
+
+    data.stars.smoothing_lengths = smoothing_lengths
+
+    return
+
+
+def generate_missing_smoothing_lengths(data, particle_type: str):
+    """
+    Generates smoothing lengths for particles that do not have them
+    (e.g. dark matter), reading them from the snapshot's smoothing length
+    sidecar if there is one.
     """
 
-    particle_data = getattr(data, image_attributes.particle_type)
+    particle_data = getattr(data, particle_type)
 
     try:
         particle_data.smoothing_lengths
     except AttributeError:
+        particle_data.smoothing_lengths = smoothing_lengths_from_sidecar(
+            data, particle_type
+        )
+
+    if particle_data.smoothing_lengths is None:
         # Need to genereate smoothing lengths
         particle_data.smoothing_lengths = generate_smoothing_lengths(
             coordinates=particle_data.coordinates,
@@ -152,74 +243,375 @@ def project(
             dimension=3,
         )
 
-    # Set up extra plot parameters
-    radius_distance = galaxy_attributes.radius * image_attributes.number_of_radii
-    region = [
-        galaxy_attributes.center[0] - radius_distance,
-        galaxy_attributes.center[0] + radius_distance,
-        galaxy_attributes.center[1] - radius_distance,
-        galaxy_attributes.center[1] + radius_distance,
-    ]
-    rotation_matrix, rotation_center = get_rotation(image_attributes, galaxy_attributes)
-
-    common_attributes = dict(
-        data=particle_data,
-        boxsize=data.metadata.boxsize,
-        resolution=image_attributes.resolution,
-        region=region,
-        mask=None,
-        rotation_matrix=rotation_matrix,
-        rotation_center=rotation_center,
-        parallel=False,
-    )
+    return
 
-    # Swiftsimio has a nasty habit of reading these in as grams.
-    particle_data.masses.convert_to_units("1e10 * Solar_Mass")
-    # Have we already made the mass image?
-    image_mass_hash = hash(
-        f"{image_attributes.resolution}"
-        f"{image_attributes.particle_type}"
-        f"{image_attributes.projection}"
-        f"{galaxy_attributes.unique_id}"
-    )
 
-    try:
-        mass_image = image_cache[image_mass_hash]
-    except KeyError:
-        mass_image = project_pixel_grid(project="masses", **common_attributes)
-        image_cache[image_mass_hash] = mass_image
-
-    # Special case for mass density projection
-    if image_attributes.visualise == "projected_density":
-        # Units are more complex here as this is a smoothed density.
-        x_range = region[1] - region[0]
-        y_range = region[3] - region[2]
-        units = 1.0 / (x_range * y_range)
-        # Unfortunately this is required to prevent us from {over,under}flowing
-        # the units...
-        units.convert_to_units(1.0 / (x_range.units * y_range.units))
-        units *= particle_data.masses.units
-
-        image = unyt_array(mass_image, units=units)
-    else:
-        # Set mass-weighted attribute
+@attr.s
+class ParticleView(object):
+    """
+    The particles of one type, rotated for one projection and clipped to
+    those whose kernels overlap the largest image region that is made of
+    them: their `indices` in the particle arrays, their positions in the
+    plane of the image, and their smoothing lengths (None for views that
+    are assigned to pixels), all as values in the units of the coordinates.
+    """
+
+    indices: np.ndarray = attr.ib()
+    x: np.ndarray = attr.ib()
+    y: np.ndarray = attr.ib()
+    smoothing_lengths: Optional[np.ndarray] = attr.ib()
+    units: object = attr.ib()
+    number_of_particles: int = attr.ib()
+
+
+class ViewCache(object):
+    """
+    Views of the particles of one galaxy, by particle type, projection and
+    whether they are deposited with their SPH kernels, that are computed
+    once and shared by all of the images in `image_attributes_list` that
+    use them.
+
+    Also counts the particles that were positioned (rotated) and deposited,
+    and how many would have been if each image had used all of the
+    particles, rotated for itself.
+    """
+
+    def __init__(
+        self, data, galaxy_attributes: GalaxyAttributes, image_attributes_list
+    ):
+        self.data = data
+        self.galaxy_attributes = galaxy_attributes
+        self.views = {}
+
+        # Largest region that is imaged in each view, and how far outside of
+        # it particles that are assigned to pixels can reach into it.
+        self.half_widths = {}
+        self.margins = {}
+        for image_attributes in image_attributes_list:
+            key = self.key(image_attributes)
+            half_width = galaxy_attributes.radius * image_attributes.number_of_radii
+            self.half_widths[key] = max(
+                self.half_widths.get(key, half_width), half_width
+            )
+
+            if image_attributes.deposit != "sph":
+                margin = (
+                    half_width
+                    * assignment_schemes[image_attributes.deposit]
+                    / image_attributes.resolution
+                )
+                self.margins[key] = max(self.margins.get(key, margin), margin)
+
+        self.images = 0
+        self.positioned = 0
+        self.positioned_without_views = 0
+        self.deposited = 0
+        self.deposited_without_views = 0
+
+        return
+
+    @staticmethod
+    def key(image_attributes: ImageAttributes) -> tuple:
+        """
+        The view that the image with `image_attributes` is made from.
+        """
+
+        return (
+            image_attributes.particle_type,
+            image_attributes.projection,
+            image_attributes.deposit == "sph",
+        )
+
+    def view(self, image_attributes: ImageAttributes) -> ParticleView:
+        """
+        The view of the particles that the image with `image_attributes` is
+        made from.
+        """
+
+        key = self.key(image_attributes)
+        particle_type, projection, kernels = key
+
+        if key not in self.views:
+            particle_data = getattr(self.data, particle_type)
+
+            coordinates = particle_data.coordinates
+            units = coordinates.units
+            center = self.galaxy_attributes.center.to(units).value
+            # Views of images that this cache was not made for are not clipped.
+            half_width = (
+                self.half_widths[key].to(units).value
+                if key in self.half_widths
+                else np.inf
+            )
+
+            rotation_matrix, rotation_center = projection_rotation(
+                projection, self.galaxy_attributes
+            )
+
+            x, y = rotated_positions(coordinates, rotation_matrix, rotation_center)
+
+            if kernels:
+                generate_missing_smoothing_lengths(self.data, particle_type)
+                smoothing_lengths = particle_data.smoothing_lengths.to(units).value
+                reach = half_width + kernel_gamma * smoothing_lengths
+            else:
+                smoothing_lengths = None
+                reach = half_width + self.margins.get(key, 0.0 * units).to(units).value
+
+            # Rotations are around the centre, so the region stays in place.
+            indices = np.flatnonzero(
+                np.logical_and(
+                    np.abs(x - center[0]) <= reach, np.abs(y - center[1]) <= reach
+                )
+            )
+
+            self.views[key] = ParticleView(
+                indices=indices,
+                x=x[indices],
+                y=y[indices],
+                smoothing_lengths=None
+                if smoothing_lengths is None
+                else smoothing_lengths[indices],
+                units=units,
+                number_of_particles=len(x),
+            )
+            self.positioned += len(x)
+
+        return self.views[key]
+
+    def count_pass(self, view: ParticleView, number_of_images: int):
+        """
+        Counts a pass over the particles of `view` that makes
+        `number_of_images` images. Without the views, each pass would
+        position and deposit all of the particles once.
+        """
+
+        self.images += number_of_images
+        self.positioned_without_views += view.number_of_particles
+        self.deposited += len(view.indices)
+        self.deposited_without_views += view.number_of_particles
+
+        return
+
+    def report(self) -> str:
+        return (
+            f"{len(self.views)} views for {self.images} images; positioned "
+            f"{self.positioned} particles instead of {self.positioned_without_views}, "
+            f"deposited {self.deposited} instead of {self.deposited_without_views}"
+        )
+
+
+def project_images(
+    data,
+    image_attributes_list,
+    galaxy_attributes: GalaxyAttributes,
+    parallel: bool = False,
+    grid_cache: Optional[GridCache] = None,
+    view_cache: Optional[ViewCache] = None,
+):
+    """
+    Creates the projection images of `data` for each of the
+    `image_attributes_list`. Images of the same particle type, with the
+    same projection and region, are made in a single pass over the
+    particles, using all threads if `parallel` is True. The particles are
+    rotated and clipped once per particle type and projection, in
+    `view_cache` (which is made for these images if not given). Images
+    that assign the particles to pixels (`ImageAttributes.deposit`) never
+    need smoothing lengths.
+
+    If a `grid_cache` is given, the projected grids are read from it when
+    they have been made before, and stored in it otherwise.
+    """
+
+    images = [None] * len(image_attributes_list)
+
+    if view_cache is None:
+        view_cache = ViewCache(data, galaxy_attributes, image_attributes_list)
+
+    # Images that share a projection can share the pass over the particles.
+    passes = {}
 
-        setattr(
-            particle_data,
-            f"_CACHE_MASSWEIGHTED",
-            getattr(particle_data, image_attributes.visualise)
-            * particle_data.masses.value,
+    for index, image_attributes in enumerate(image_attributes_list):
+        key = (
+            image_attributes.particle_type,
+            image_attributes.projection,
+            image_attributes.resolution,
+            image_attributes.number_of_radii,
+            image_attributes.deposit,
+            image_attributes.gaussian_smoothing,
+            image_attributes.adaptive_neighbours,
         )
+        passes.setdefault(key, []).append(index)
+
+    for indices in passes.values():
+        image_attributes = image_attributes_list[indices[0]]
+        particle_data = getattr(data, image_attributes.particle_type)
+        kernels = image_attributes.deposit == "sph"
+
+        if kernels:
+            generate_missing_smoothing_lengths(data, image_attributes.particle_type)
+
+        # Set up extra plot parameters
+        radius_distance = galaxy_attributes.radius * image_attributes.number_of_radii
+        region = [
+            galaxy_attributes.center[0] - radius_distance,
+            galaxy_attributes.center[0] + radius_distance,
+            galaxy_attributes.center[1] - radius_distance,
+            galaxy_attributes.center[1] + radius_distance,
+        ]
+        rotation_matrix, rotation_center = get_rotation(
+            image_attributes, galaxy_attributes
+        )
+
+        # Swiftsimio has a nasty habit of reading these in as grams. Not in
+        # place, as the masses can be a read-only view of the cached cells.
+        particle_data.masses = particle_data.masses.to("1e10 * Solar_Mass")
+
+        # Mass-weighted quantities in this pass, projected along with the masses.
+        visualise = []
+        for index in indices:
+            name = image_attributes_list[index].visualise
+            if name != "projected_density" and name not in visualise:
+                visualise.append(name)
+
+        # Everything that determines the grids, apart from the quantity.
+        grid_inputs = dict(
+            particle_type=image_attributes.particle_type,
+            projection=image_attributes.projection,
+            rotation_matrix=rotation_matrix,
+            rotation_center=rotation_center,
+            region=region,
+            resolution=image_attributes.resolution,
+        )
+
+        if kernels:
+            grid_inputs["smoothing_lengths"] = particle_data.smoothing_lengths
+        else:
+            grid_inputs.update(
+                coordinates=particle_data.coordinates,
+                deposit=image_attributes.deposit,
+                gaussian_smoothing=image_attributes.gaussian_smoothing,
+                adaptive_neighbours=image_attributes.adaptive_neighbours,
+            )
 
-        with np.testing.suppress_warnings() as sup:
-            sup.filter(RuntimeWarning)
-            image = unyt_array(
-                project_pixel_grid(project="_CACHE_MASSWEIGHTED", **common_attributes)
-                / mass_image,
-                units=getattr(particle_data, image_attributes.visualise).units,
+        grid_keys = {}
+
+        if grid_cache is not None:
+            grid_inputs["snapshot"] = snapshot_identity(str(data.filename))
+
+            for name in ["masses"] + visualise:
+                grid_keys[name] = GridCache.key(
+                    quantity=name,
+                    units=str(getattr(particle_data, name).units),
+                    **grid_inputs,
+                )
+
+        pixel_grids = {}
+        for name, key in grid_keys.items():
+            grid = grid_cache.get(key)
+            if grid is not None:
+                pixel_grids[name] = grid
+
+        missing = [name for name in ["masses"] + visualise if name not in pixel_grids]
+
+        if len(missing) > 0:
+            view = view_cache.view(image_attributes)
+            view_cache.count_pass(view, len(indices))
+
+            masses = particle_data.masses.value[view.indices]
+            channels = [
+                masses
+                if name == "masses"
+                else getattr(particle_data, name).value[view.indices] * masses
+                for name in missing
+            ]
+
+            smoothing = not kernels and image_attributes.gaussian_smoothing is not None
+            adaptive = smoothing and image_attributes.adaptive_neighbours is not None
+
+            if adaptive:
+                # The number of particles, to find the widths to smooth with.
+                channels.append(np.ones(len(view.indices)))
+
+            projected_grids = deposit_pixel_grids(
+                view.x,
+                view.y,
+                view.smoothing_lengths,
+                channels,
+                [edge.to(view.units).value for edge in region],
+                image_attributes.resolution,
+                parallel,
+                image_attributes.deposit,
             )
 
-    return image
+            if smoothing:
+                counts = None
+
+                if adaptive:
+                    # Grids are per unit area of the region, not per pixel.
+                    counts = projected_grids.pop() / image_attributes.resolution**2
+
+                projected_grids = smooth_pixel_grids(
+                    projected_grids,
+                    image_attributes.gaussian_smoothing,
+                    counts,
+                    image_attributes.adaptive_neighbours,
+                )
+
+            for name, grid in zip(missing, projected_grids):
+                pixel_grids[name] = grid
+
+                if grid_cache is not None:
+                    grid_cache.put(
+                        grid_keys[name],
+                        grid,
+                        quantity=name,
+                        units=str(getattr(particle_data, name).units),
+                        **grid_inputs,
+                    )
+
+        mass_image = pixel_grids["masses"]
+
+        for index in indices:
+            name = image_attributes_list[index].visualise
+
+            # Special case for mass density projection
+            if name == "projected_density":
+                # Units are more complex here as this is a smoothed density.
+                x_range = region[1] - region[0]
+                y_range = region[3] - region[2]
+                units = 1.0 / (x_range * y_range)
+                # Unfortunately this is required to prevent us from
+                # {over,under}flowing the units...
+                units.convert_to_units(1.0 / (x_range.units * y_range.units))
+                units *= particle_data.masses.units
+
+                images[index] = unyt_array(mass_image, units=units)
+            else:
+                with np.testing.suppress_warnings() as sup:
+                    sup.filter(RuntimeWarning)
+                    images[index] = unyt_array(
+                        pixel_grids[name] / mass_image,
+                        units=getattr(particle_data, name).units,
+                    )
+
+    return images
+
+
+def project(
+    data,
+    image_attributes: ImageAttributes,
+    galaxy_attributes: GalaxyAttributes,
+    parallel: bool = False,
+    grid_cache: Optional[GridCache] = None,
+):
+    """
+    Creates a projection image of `data` given attributes.
+    """
+
+    return project_images(
+        data, [image_attributes], galaxy_attributes, parallel, grid_cache
+    )[0]
 
 
 def fill_image(image: unyt_array, image_attributes=ImageAttributes):
@@ -393,6 +785,178 @@ def decorate_axes(
     return
 
 
+def rasterise_galaxy_image(
+    image: unyt_array,
+    image_attributes: ImageAttributes,
+    galaxy_attributes: GalaxyAttributes,
+):
+    """
+    The same image as `create_plot` and `decorate_axes`, drawn directly
+    with Pillow; the image has one pixel per pixel of the grid, with the
+    colour bar to its right.
+    """
+
+    resolution = image.shape[0]
+    text_size = max(resolution * 10 // 576, 8)
+    text_color = image_attributes.text_color
+
+    if image_attributes.vmin is not None:
+        vmin = image_attributes.vmin.to(image.units).value
+    else:
+        vmin = None
+
+    if image_attributes.vmax is not None:
+        vmax = image_attributes.vmax.to(image.units).value
+    else:
+        vmax = None
+
+    norm = image_attributes.norm(vmin=vmin, vmax=vmax)
+
+    panel = rasterise(
+        image.value,
+        image_attributes.cmap,
+        norm,
+        background=image_attributes.plot_background_color,
+    )
+
+    bar_width = resolution // 20
+    gap = resolution // 64
+    canvas = Image.new(
+        "RGB", (resolution + gap + bar_width + 5 * text_size, resolution), "white"
+    )
+    canvas.paste(panel, (0, 0))
+
+    paste_colour_bar(
+        canvas,
+        (resolution + gap, text_size, bar_width, resolution - 2 * text_size),
+        image_attributes.cmap,
+        norm,
+        text_size,
+    )
+
+    # Radius of the galaxy in pixels, with the galaxy in the middle.
+    radius = resolution / (2.0 * image_attributes.number_of_radii)
+    centre = (resolution / 2, resolution / 2)
+    margin = 0.025 * resolution
+
+    if image_attributes.decorate_radius:
+        paste_dashed_circle(
+            canvas, centre, radius, text_color, max(resolution // 384, 1)
+        )
+        paste_text(
+            canvas,
+            galaxy_attributes.radius_name,
+            (centre[0], centre[1] - 1.025 * radius),
+            text_color,
+            text_size,
+            ha="center",
+            va="bottom",
+        )
+
+    if image_attributes.decorate_position:
+        x, y, z = galaxy_attributes.center.to("Mpc").value
+        position = f"[{x:.3g}, {y:.3g}, {z:.3g}] Mpc"
+        redshift = f"$z={galaxy_attributes.redshift:3.3f}$"
+
+        paste_text(
+            canvas,
+            f"{redshift}\n{position}",
+            (resolution - margin, resolution - margin),
+            text_color,
+            text_size,
+            ha="right",
+            va="bottom",
+        )
+
+    if image_attributes.decorate_scalebar:
+        paste_text(
+            canvas,
+            f"{latex_float(galaxy_attributes.radius)}",
+            (centre[0], centre[1] + 1.025 * radius),
+            text_color,
+            text_size,
+            ha="center",
+            va="top",
+        )
+
+    ptype_title = image_attributes.particle_type.replace("_", " ").title()
+    visualise_title = image_attributes.visualise.replace("_", " ").title()
+
+    if image_attributes.decorate_image_type:
+        paste_text(
+            canvas,
+            f"{ptype_title} {visualise_title}",
+            (margin, margin),
+            text_color,
+            text_size,
+            ha="left",
+            va="top",
+        )
+        paste_text(
+            canvas,
+            (
+                f"Halo {galaxy_attributes.unique_id}\n"
+                f"{image_attributes.projection.replace('on', ' on').title()}"
+            ),
+            (margin, resolution - margin),
+            text_color,
+            text_size,
+            ha="left",
+            va="bottom",
+        )
+
+    if image_attributes.decorate_masses:
+        paste_text(
+            canvas,
+            (
+                f"$M_H$={latex_float(galaxy_attributes.halo_mass.to('Solar_Mass'))}\n"
+                f"$M_*$={latex_float(galaxy_attributes.stellar_mass.to('Solar_Mass'))}"
+            ),
+            (resolution - margin, margin),
+            text_color,
+            text_size,
+            ha="right",
+            va="top",
+        )
+
+    return canvas
+
+
+def save_galaxy_image(
+    image: unyt_array,
+    image_attributes: ImageAttributes,
+    galaxy_attributes: GalaxyAttributes,
+):
+    """
+    Fills, plots, decorates, and saves an image made by `project`.
+    """
+
+    fill_image(image, image_attributes)
+
+    filename = f"{galaxy_attributes.unique_id}_{image_attributes.output_filename}"
+
+    if image_attributes.renderer == "pillow":
+        write_image(
+            rasterise_galaxy_image(image, image_attributes, galaxy_attributes),
+            f"{image_attributes.output_path}/{filename}",
+        )
+
+        return
+
+    fig, ax = create_plot(image, image_attributes, galaxy_attributes)
+
+    decorate_axes(ax, image_attributes, galaxy_attributes)
+
+    # Written under a temporary name first, so that the image only appears
+    # once it is complete when many processes are writing images.
+    with atomic_output(f"{image_attributes.output_path}/{filename}") as temporary:
+        fig.savefig(temporary, format=os.path.splitext(filename)[1][1:] or None)
+
+    plt.close(fig)
+
+    return
+
+
 def render_galaxy_image(
     data, image_attributes: ImageAttributes, galaxy_attributes: GalaxyAttributes
 ):
@@ -403,31 +967,47 @@ def render_galaxy_image(
 
     image = project(data, image_attributes, galaxy_attributes)
 
-    fill_image(image, image_attributes)
+    save_galaxy_image(image, image_attributes, galaxy_attributes)
 
-    fig, ax = create_plot(image, image_attributes, galaxy_attributes)
+    return
 
-    decorate_axes(ax, image_attributes, galaxy_attributes)
 
-    fig.savefig(
-        f"{image_attributes.output_path}/{galaxy_attributes.unique_id}_{image_attributes.output_filename}"
+def render_galaxy_images(
+    data,
+    image_attributes_list,
+    galaxy_attributes: GalaxyAttributes,
+    parallel: bool = False,
+    grid_cache: Optional[GridCache] = None,
+    view_cache: Optional[ViewCache] = None,
+):
+    """
+    The same as `render_galaxy_image`, for many images of the same galaxy.
+    Images that share a projection are made in a single particle pass, from
+    particles that are rotated and clipped once (in `view_cache`, if
+    given), and grids found in `grid_cache` are not projected again.
+    """
+
+    images = project_images(
+        data,
+        image_attributes_list,
+        galaxy_attributes,
+        parallel,
+        grid_cache,
+        view_cache,
     )
 
-    plt.close(fig)
+    for image, image_attributes in zip(images, image_attributes_list):
+        save_galaxy_image(image, image_attributes, galaxy_attributes)
 
     return
 
 
-if __name__ == "__main__":
-    from velociraptor.swift.swift import to_swiftsimio_dataset
-    from velociraptor.particles import load_groups
-    from velociraptor import load
-    import os
-    import sys
-
-    recalculate_stellar_smoothing_lengths = True
+def default_image_styles():
+    """
+    The images that are made of every galaxy in the script mode.
+    """
 
-    image_styles = [
+    return [
         ImageAttributes(
             output_filename="dens.png",
             fill_below=unyt_quantity(1000, units="Solar_Mass / (kpc * kpc)"),
@@ -490,35 +1070,13 @@ if __name__ == "__main__":
         ),
     ]
 
-    snapshot_path = sys.argv[1]
-    velociraptor_base_name = sys.argv[2]
-    output_path = sys.argv[3]
-
-    if not os.path.exists(output_path):
-        os.mkdir(output_path)
-
-    velociraptor_properties = velociraptor_base_name
-    velociraptor_groups = velociraptor_base_name.replace("properties", "catalog_groups")
-
-    filenames = {
-        "parttypes_filename": velociraptor_base_name.replace(
-            "properties", "catalog_parttypes"
-        ),
-        "particles_filename": velociraptor_base_name.replace(
-            "properties", "catalog_particles"
-        ),
-        "unbound_parttypes_filename": velociraptor_base_name.replace(
-            "properties", "catalog_parttypes.unbound"
-        ),
-        "unbound_particles_filename": velociraptor_base_name.replace(
-            "properties", "catalog_particles.unbound"
-        ),
-    }
 
-    catalogue = load(velociraptor_properties)
-    groups = load_groups(velociraptor_groups, catalogue)
+def select_halos(catalogue):
+    """
+    Indices of the central galaxies with a stellar mass above 1e9 Msun.
+    """
 
-    halo_ids = np.arange(len(catalogue.masses.mass_200mean))[
+    return np.arange(len(catalogue.masses.mass_200mean))[
         np.logical_and(
             catalogue.structure_type.structuretype == 10,
             catalogue.apertures.mass_star_30_kpc
@@ -526,66 +1084,470 @@ if __name__ == "__main__":
         )
     ]
 
-    for halo_id in halo_ids:
-        try:
-            particles, _ = groups.extract_halo(halo_id, filenames=filenames)
-        except:
-            # Probably parttypes / partypes mix up
-            filenames = {
-                k: v.replace("parttypes", "partypes") for k, v in filenames.items()
-            }
-            particles, _ = groups.extract_halo(halo_id, filenames=filenames)
-
-        halo_mass = catalogue.masses.mass_200mean[halo_id].to("Solar_Mass")
-        stellar_mass = catalogue.apertures.mass_star_30_kpc[halo_id].to("Solar_Mass")
-
-        lx = catalogue.angular_momentum.lx_star[halo_id].value
-        ly = catalogue.angular_momentum.ly_star[halo_id].value
-        lz = catalogue.angular_momentum.lz_star[halo_id].value
-
-        norm_vector = np.array([lx, ly, lz])
-
-        # This reads particles using the cell metadata that are around our halo
-        data = to_swiftsimio_dataset(
-            particles, snapshot_path, generate_extra_mask=False
-        )
-
-        x = particles.x_mbp / data.metadata.a
-        y = particles.y_mbp / data.metadata.a
-        z = particles.z_mbp / data.metadata.a
-
-        # We have different defaults for COLIBRE/EAGLE
-        subgrid_is_colibre = (
-            data.metadata.subgrid_scheme["Chemistry Model"].decode("utf-8") == "COLIBRE"
-        )
-
-        r_factor = 0.1 if subgrid_is_colibre else 1.0
-        r = r_factor * particles.r_200crit / data.metadata.a
-        radius_name = f"{r_factor if r_factor != 1.0 else ''} $R_{{200, \\rm{{crit}}}}$"
-
-        halo_center = unyt_array([x, y, z])
-
-        galaxy_attributes = GalaxyAttributes(
-            center=halo_center,
-            radius=r,
-            normal_vector=norm_vector,
-            redshift=data.metadata.z,
-            unique_id=halo_id,
-            halo_mass=halo_mass,
-            stellar_mass=stellar_mass,
-            radius_name=radius_name,
-        )
-
-        if recalculate_stellar_smoothing_lengths:
-            data.stars.smoothing_lengths = generate_smoothing_lengths(
-                coordinates=data.stars.coordinates,
-                boxsize=data.metadata.boxsize,
-                kernel_gamma=kernel_gamma,
-                neighbours=57,
-                speedup_fac=1,
-                dimension=3,
+
+def halo_particle_numbers(velociraptor_base_name: str, output_path: str):
+    """
+    Number of (bound and unbound) particles in each halo, from the
+    membership index in `output_path` (which is built if needed), or from
+    the offsets in the VELOCIraptor files if the index can not be written.
+    """
+
+    index = membership_index(velociraptor_base_name, output_path)
+
+    if index is not None:
+        return index.particle_numbers()
+
+    filenames = velociraptor_filenames(velociraptor_base_name)
+    particle_numbers = 0
+
+    with h5py.File(filenames["groups"], "r") as groups:
+        for offset_name, particles_name in [
+            ("Offset", "particles"),
+            ("Offset_unbound", "unbound_particles"),
+        ]:
+            with h5py.File(filenames[particles_name], "r") as handle:
+                total = handle["Particle_IDs"].shape[0]
+
+            particle_numbers = particle_numbers + np.diff(
+                np.append(groups[offset_name][:], total)
             )
 
-        for image_style in image_styles:
-            image_style.output_path = output_path
-            render_galaxy_image(data, image_style, galaxy_attributes)
+    return particle_numbers
+
+
+def catalogue_galaxy_attributes(catalogue, halo_id: int, metadata):
+    """
+    The `GalaxyAttributes` of halo `halo_id` in the catalogue, with the
+    center and radius in comoving units, as in the snapshot (`metadata`).
+    """
+
+    halo_mass = catalogue.masses.mass_200mean[halo_id].to("Solar_Mass")
+    stellar_mass = catalogue.apertures.mass_star_30_kpc[halo_id].to("Solar_Mass")
+
+    lx = catalogue.angular_momentum.lx_star[halo_id].value
+    ly = catalogue.angular_momentum.ly_star[halo_id].value
+    lz = catalogue.angular_momentum.lz_star[halo_id].value
+
+    norm_vector = np.array([lx, ly, lz])
+
+    x = catalogue.positions.xcmbp[halo_id] / metadata.a
+    y = catalogue.positions.ycmbp[halo_id] / metadata.a
+    z = catalogue.positions.zcmbp[halo_id] / metadata.a
+
+    # We have different defaults for COLIBRE/EAGLE
+    subgrid_is_colibre = (
+        metadata.subgrid_scheme["Chemistry Model"].decode("utf-8") == "COLIBRE"
+    )
+
+    r_factor = 0.1 if subgrid_is_colibre else 1.0
+    r = r_factor * catalogue.radii.r_200crit[halo_id] / metadata.a
+    radius_name = f"{r_factor if r_factor != 1.0 else ''} $R_{{200, \\rm{{crit}}}}$"
+
+    halo_center = unyt_array([x, y, z])
+
+    return GalaxyAttributes(
+        center=halo_center,
+        radius=r,
+        normal_vector=norm_vector,
+        redshift=metadata.z,
+        unique_id=halo_id,
+        halo_mass=halo_mass,
+        stellar_mass=stellar_mass,
+        radius_name=radius_name,
+    )
+
+
+class HaloRenderer(object):
+    """
+    Renders the images of halos from one snapshot and catalogue. The
+    catalogue is only loaded once, so each process in the pool has its own,
+    and the particles are read in batches of nearby halos through a cell
+    cache of `cell_cache_bytes` bytes, reading `properties` in bulk.
+    """
+
+    def __init__(
+        self,
+        snapshot_path: str,
+        velociraptor_base_name: str,
+        output_path: str,
+        grid_cache_directory: Optional[str] = None,
+        grid_cache_bytes: int = 1 << 31,
+        cell_cache_bytes: int = 1 << 28,
+        renderer: str = "pillow",
+        mass_assignment: str = "sph",
+        assignment_smoothing: Optional[float] = None,
+        properties: dict = image_properties,
+    ):
+        from velociraptor import load
+
+        self.snapshot_path = snapshot_path
+
+        self.catalogue = load(velociraptor_base_name)
+        self.loader = RegionLoader(snapshot_path, properties, cell_cache_bytes)
+
+        self.image_styles = [
+            attr.evolve(image_style, output_path=output_path, renderer=renderer)
+            for image_style in default_image_styles()
+        ]
+
+        if mass_assignment != "sph":
+            # Quick looks: stars and dark matter without smoothing lengths.
+            self.image_styles = [
+                attr.evolve(
+                    image_style,
+                    deposit=mass_assignment,
+                    gaussian_smoothing=assignment_smoothing,
+                )
+                if image_style.particle_type in ["stars", "dark_matter"]
+                else image_style
+                for image_style in self.image_styles
+            ]
+
+        self.grid_cache = (
+            GridCache(grid_cache_directory, grid_cache_bytes)
+            if grid_cache_directory
+            else None
+        )
+
+        # Particles positioned and deposited, with and without the views.
+        self.view_statistics = np.zeros(4, dtype=np.int64)
+
+        return
+
+    def regions(self, halo_ids):
+        """
+        Centres and half-widths (comoving) of the regions that are read
+        around `halo_ids`; the same as `to_swiftsimio_dataset`.
+        """
+
+        a = self.loader.snapshot.metadata.a
+        positions = self.catalogue.positions
+
+        centres = unyt_array(
+            [
+                positions.xcmbp[halo_ids],
+                positions.ycmbp[halo_ids],
+                positions.zcmbp[halo_ids],
+            ]
+        ).T
+
+        return centres / a, self.catalogue.radii.r_size[halo_ids] / a
+
+    def batches(self, halo_ids, batch_size: int):
+        """
+        Splits `halo_ids` into batches of nearby halos.
+        """
+
+        halo_ids = np.asarray(halo_ids)
+        centres, _ = self.regions(halo_ids)
+
+        return [halo_ids[batch] for batch in self.loader.batches(centres, batch_size)]
+
+    def render(self, halo_id: int, parallel: bool = False, data=None):
+        """
+        Makes all of the images of halo `halo_id`, using threaded projections
+        if `parallel` is True. `data` are the particles around the halo, which
+        are read if not given.
+        """
+
+        if data is None:
+            data = self.loader.load(*self.regions([halo_id]))[0]
+
+        galaxy_attributes = catalogue_galaxy_attributes(
+            self.catalogue, halo_id, data.metadata
+        )
+
+        if recalculate_stellar_smoothing_lengths and any(
+            image_style.particle_type == "stars" and image_style.deposit == "sph"
+            for image_style in self.image_styles
+        ):
+            generate_stellar_smoothing_lengths(data)
+
+        view_cache = ViewCache(data, galaxy_attributes, self.image_styles)
+
+        render_galaxy_images(
+            data,
+            self.image_styles,
+            galaxy_attributes,
+            parallel,
+            self.grid_cache,
+            view_cache,
+        )
+
+        print(f"Halo {halo_id}: {view_cache.report()}")
+
+        self.view_statistics += np.array(
+            [
+                view_cache.positioned,
+                view_cache.positioned_without_views,
+                view_cache.deposited,
+                view_cache.deposited_without_views,
+            ]
+        )
+
+        return
+
+    def render_batch(self, halo_ids, parallel: bool = False):
+        """
+        Makes the images of a batch of nearby halos, reading the particles
+        around all of them at once. Returns the halos that could not be
+        rendered, with the error.
+        """
+
+        failures = []
+
+        try:
+            regions = self.loader.load(*self.regions(halo_ids))
+        except Exception as error:
+            # None of the halos in the batch can be rendered.
+            message = f"{type(error).__name__}: {error}"
+            return [(halo_id, message) for halo_id in halo_ids]
+
+        for halo_id, data in zip(halo_ids, regions):
+            try:
+                self.render(halo_id, parallel=parallel, data=data)
+            except Exception as error:
+                failures.append((halo_id, f"{type(error).__name__}: {error}"))
+
+        return failures
+
+
+# The renderer of each process in the pool.
+_worker_renderer = None
+
+
+def _initialise_worker(*renderer_arguments):
+    global _worker_renderer
+
+    # Each process renders on one core; the pool provides the parallelism.
+    numba.set_num_threads(1)
+
+    _worker_renderer = HaloRenderer(*renderer_arguments)
+
+    return
+
+
+def _render_in_worker(halo_ids):
+    bytes_read = _worker_renderer.loader.bytes_read
+    view_statistics = _worker_renderer.view_statistics.copy()
+    failures = _worker_renderer.render_batch(halo_ids, parallel=False)
+
+    return (
+        failures,
+        _worker_renderer.loader.bytes_read - bytes_read,
+        _worker_renderer.view_statistics - view_statistics,
+    )
+
+
+def render_halos(
+    snapshot_path: str,
+    velociraptor_base_name: str,
+    output_path: str,
+    processes: int = 1,
+    large_halo_particles: int = 1000000,
+    grid_cache_directory: Optional[str] = None,
+    grid_cache_bytes: int = 1 << 31,
+    batch_size: int = 32,
+    cell_cache_bytes: int = 1 << 32,
+    renderer: str = "pillow",
+    mass_assignment: str = "sph",
+    assignment_smoothing: Optional[float] = None,
+):
+    """
+    Renders the images of all the selected halos.
+
+    Halos with fewer than `large_halo_particles` particles are spread over
+    a pool of `processes` processes, each rendering one halo at a time on a
+    single core. The large halos, where a single halo is enough work for all
+    cores, are then rendered one at a time with threaded projections.
+
+    The halos are rendered in batches of `batch_size` nearby halos, so that
+    the particles that they share are only read once; the processes keep
+    the cells that they have read in caches of `cell_cache_bytes` bytes in
+    total, shared equally between them.
+
+    Projected grids are kept in `grid_cache_directory`, if given, so that
+    the images can be re-rendered with other styles without reprojecting;
+    the least recently used grids are removed once they take more than
+    `grid_cache_bytes`.
+    The images are drawn with `renderer` ("pillow" or "matplotlib").
+
+    The star and dark matter images assign the particles to pixels with
+    `mass_assignment` ("ngp", "cic" or "tsc", smoothed with a Gaussian of
+    `assignment_smoothing` pixels if given) rather than with their SPH
+    kernels ("sph"), if given, so that no smoothing lengths are needed.
+    """
+
+    renderer_arguments = (
+        snapshot_path,
+        velociraptor_base_name,
+        output_path,
+        grid_cache_directory,
+        grid_cache_bytes,
+        cell_cache_bytes // max(processes, 1),
+        renderer,
+        mass_assignment,
+        assignment_smoothing,
+    )
+    halo_renderer = HaloRenderer(*renderer_arguments)
+
+    halo_ids = select_halos(halo_renderer.catalogue)
+    particle_numbers = halo_particle_numbers(velociraptor_base_name, output_path)
+
+    if processes > 1:
+        is_large = particle_numbers[halo_ids] > large_halo_particles
+        small_halo_ids = halo_ids[~is_large]
+        large_halo_ids = halo_ids[is_large]
+    else:
+        small_halo_ids = halo_ids[:0]
+        large_halo_ids = halo_ids
+
+    start_time = time.time()
+    failures = []
+    bytes_read = 0
+    view_statistics = np.zeros(4, dtype=np.int64)
+
+    if len(small_halo_ids) > 0:
+        batches = halo_renderer.batches(small_halo_ids, batch_size)
+        # Largest first, so that the pool does not wait for a big batch at the end.
+        batches.sort(key=lambda batch: particle_numbers[batch].sum(), reverse=True)
+
+        with multiprocessing.Pool(
+            processes, initializer=_initialise_worker, initargs=renderer_arguments
+        ) as pool:
+            for (
+                batch_failures,
+                batch_bytes_read,
+                batch_view_statistics,
+            ) in pool.imap_unordered(_render_in_worker, batches, chunksize=1):
+                failures.extend(batch_failures)
+                bytes_read += batch_bytes_read
+                view_statistics += batch_view_statistics
+
+    # The large halos are rendered by this process alone.
+    halo_renderer.loader.cache.maximal_bytes = cell_cache_bytes
+
+    for batch in halo_renderer.batches(large_halo_ids, batch_size):
+        failures.extend(halo_renderer.render_batch(batch, parallel=processes > 1))
+
+    bytes_read += halo_renderer.loader.bytes_read
+    view_statistics += halo_renderer.view_statistics
+
+    for halo_id, error in failures:
+        print(f"Unable to render halo {halo_id}: {error}")
+
+    elapsed = time.time() - start_time
+    print(
+        f"Rendered {len(halo_ids) - len(failures)} halos "
+        f"({len(small_halo_ids)} in a pool of {processes} processes, "
+        f"{len(large_halo_ids)} with threaded projections) in {elapsed:.1f} s, "
+        f"{3600.0 * len(halo_ids) / max(elapsed, 1e-3):.0f} halos per hour"
+    )
+
+    if len(halo_ids) > 0:
+        regions = halo_renderer.loader.union_bytes(*halo_renderer.regions(halo_ids))
+        print(
+            f"Read {bytes_read / 1e9:.2f} GB of particle data, for regions "
+            f"that cover {regions / 1e9:.2f} GB"
+        )
+
+        positioned, positioned_without_views, deposited, deposited_without_views = (
+            view_statistics
+        )
+        print(
+            f"Positioned {positioned} particles instead of "
+            f"{positioned_without_views}, and deposited {deposited} instead of "
+            f"{deposited_without_views}, by sharing rotated and clipped views"
+        )
+
+    return
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Makes face/edge on images of the central galaxies."
+    )
+    parser.add_argument("snapshot_path")
+    parser.add_argument("velociraptor_base_name")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "-n",
+        "--processes",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Number of processes (and threads for the large halos).",
+    )
+    parser.add_argument(
+        "--large-halo-particles",
+        type=int,
+        default=1000000,
+        help="Halos with more particles are rendered with threaded projections.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Number of nearby halos whose particles are read together.",
+    )
+    parser.add_argument(
+        "--cell-cache-mb",
+        type=float,
+        default=4096,
+        help="Total size of the caches of snapshot cells, shared between the "
+        "processes, in MB.",
+    )
+    parser.add_argument(
+        "--renderer",
+        choices=["pillow", "matplotlib"],
+        default="pillow",
+        help="Draw the images directly with Pillow, or with matplotlib figures.",
+    )
+    parser.add_argument(
+        "--mass-assignment",
+        choices=["sph", "ngp", "cic", "tsc"],
+        default="sph",
+        help="Assign star and dark matter particles to pixels, without smoothing "
+        "lengths, for quick looks. Default: sph, with smoothing lengths.",
+    )
+    parser.add_argument(
+        "--assignment-smoothing",
+        type=float,
+        default=1.0,
+        help="Width (in pixels) of the Gaussian that assigned grids are smoothed "
+        "with; 0 for none. Default: 1.",
+    )
+    parser.add_argument(
+        "--grid-cache",
+        default=None,
+        help="Keep the projected grids in this directory (e.g. on scratch), so "
+        "that the images can be re-rendered without projecting. Default: none.",
+    )
+    parser.add_argument(
+        "--grid-cache-mb",
+        type=float,
+        default=2048,
+        help="Size of the projected grid cache, in MB, above which the least "
+        "recently used grids are removed. Default: 2048.",
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_path):
+        os.mkdir(args.output_path)
+
+    render_halos(
+        args.snapshot_path,
+        args.velociraptor_base_name,
+        args.output_path,
+        processes=args.processes,
+        large_halo_particles=args.large_halo_particles,
+        grid_cache_directory=args.grid_cache,
+        grid_cache_bytes=int(args.grid_cache_mb * 1024 * 1024),
+        batch_size=args.batch_size,
+        cell_cache_bytes=int(args.cell_cache_mb * 1024 * 1024),
+        renderer=args.renderer,
+        mass_assignment=args.mass_assignment,
+        assignment_smoothing=args.assignment_smoothing or None,
+    )
@@ -0,0 +1,437 @@
+"""
+Projection of several quantities of the same particles at once.
+
+`project_pixel_grid` from swiftsimio loops over all of the particles (and
+evaluates the kernel at every pixel that they overlap) for every quantity
+that is projected. Here the quantities are stacked into channels and
+deposited in a single loop over the particles, so that the kernel and the
+overlapping pixels are only computed once; each extra channel only costs
+an extra multiply-add per pixel.
+
+The kernel, and the normalisation of the output, are the same as the
+'fast' backend of swiftsimio.
+
+For quick looks at particles without smoothing lengths (stars and dark
+matter), which are expensive to generate, the particles can instead be
+assigned to the nearest pixels (NGP, CIC or TSC), optionally followed by
+a fixed or adaptive Gaussian smoothing of the grids.
+"""
+
+import numba
+import numpy as np
+
+from numba import jit, prange
+
+# Wendland-C2 kernel, as used by swiftsimio.
+kernel_gamma = np.float32(1.897367)
+kernel_constant = np.float32(2.22817109)
+
+
+@jit(nopython=True, fastmath=True)
+def kernel(r: np.float32, H: np.float32) -> np.float32:
+    """
+    Projected Wendland-C2 kernel with compact support ``H``.
+    """
+
+    inverse_H = 1.0 / H
+    ratio = r * inverse_H
+
+    if ratio >= 1.0:
+        return 0.0
+
+    one_minus_ratio = 1.0 - ratio
+    one_minus_ratio_2 = one_minus_ratio * one_minus_ratio
+
+    return (
+        one_minus_ratio_2
+        * one_minus_ratio_2
+        * (1.0 + 4.0 * ratio)
+        * kernel_constant
+        * inverse_H
+        * inverse_H
+    )
+
+
+@jit(nopython=True, fastmath=True)
+def scatter_channels(x, y, weights, h, resolution: int):
+    """
+    Deposits the ``weights`` (number of particles x number of channels)
+    of the particles at ``x`` and ``y`` (in [0, 1]) with smoothing lengths
+    ``h`` (in the same units) on a grid of ``resolution`` x ``resolution``
+    pixels.
+
+    Returns an array of shape (resolution, resolution, number of channels).
+    """
+
+    number_of_channels = weights.shape[1]
+    image = np.zeros((resolution, resolution, number_of_channels), dtype=np.float32)
+
+    maximal_index = resolution - 1
+    float_resolution = np.float32(resolution)
+    pixel_width = np.float32(1.0) / float_resolution
+    inverse_pixel_area = np.float32(resolution * resolution)
+
+    for particle in range(x.size):
+        x_position = x[particle]
+        y_position = y[particle]
+
+        particle_cell_x = np.int32(np.floor(resolution * x_position))
+        particle_cell_y = np.int32(np.floor(resolution * y_position))
+
+        # SWIFT stores the smoothing length, not the kernel support.
+        kernel_width = kernel_gamma * h[particle]
+        cells_spanned = np.int32(1.0 + kernel_width * float_resolution)
+
+        if (
+            particle_cell_x + cells_spanned < 0
+            or particle_cell_x - cells_spanned > maximal_index
+            or particle_cell_y + cells_spanned < 0
+            or particle_cell_y - cells_spanned > maximal_index
+        ):
+            continue
+
+        if cells_spanned <= 1:
+            if (
+                particle_cell_x >= 0
+                and particle_cell_x <= maximal_index
+                and particle_cell_y >= 0
+                and particle_cell_y <= maximal_index
+            ):
+                for channel in range(number_of_channels):
+                    image[particle_cell_x, particle_cell_y, channel] += (
+                        weights[particle, channel] * inverse_pixel_area
+                    )
+
+            continue
+
+        for cell_x in range(
+            max(0, particle_cell_x - cells_spanned),
+            min(particle_cell_x + cells_spanned + 1, maximal_index + 1),
+        ):
+            distance_x = (np.float32(cell_x) + 0.5) * pixel_width - x_position
+            distance_x_2 = distance_x * distance_x
+
+            for cell_y in range(
+                max(0, particle_cell_y - cells_spanned),
+                min(particle_cell_y + cells_spanned + 1, maximal_index + 1),
+            ):
+                distance_y = (np.float32(cell_y) + 0.5) * pixel_width - y_position
+                r = np.sqrt(distance_x_2 + distance_y * distance_y)
+
+                kernel_eval = kernel(np.float32(r), kernel_width)
+
+                if kernel_eval == 0.0:
+                    continue
+
+                for channel in range(number_of_channels):
+                    image[cell_x, cell_y, channel] += (
+                        weights[particle, channel] * kernel_eval
+                    )
+
+    return image
+
+
+@jit(nopython=True, fastmath=True, parallel=True)
+def scatter_channels_parallel(
+    x, y, weights, h, resolution: int, number_of_chunks: int
+):
+    """
+    Parallel version of `scatter_channels`; the particles are split in
+    ``number_of_chunks`` chunks that each get their own image, so this
+    uses ``number_of_chunks`` times more memory.
+    """
+
+    number_of_particles = x.size
+    chunk_size = number_of_particles // number_of_chunks + 1
+
+    images = np.zeros(
+        (number_of_chunks, resolution, resolution, weights.shape[1]),
+        dtype=np.float32,
+    )
+
+    for chunk in prange(number_of_chunks):
+        start = chunk * chunk_size
+        stop = min(start + chunk_size, number_of_particles)
+
+        if start < stop:
+            images[chunk] = scatter_channels(
+                x[start:stop],
+                y[start:stop],
+                weights[start:stop],
+                h[start:stop],
+                resolution,
+            )
+
+    return images.sum(axis=0)
+
+
+# Mass assignment schemes, and the number of pixels along each axis that
+# each particle is assigned to.
+assignment_schemes = {"ngp": 1, "cic": 2, "tsc": 3}
+
+
+def _assignment_weights(position, scheme: str):
+    """
+    Indices of the pixels (along one axis) that the particles at
+    ``position`` (in pixels) are assigned to with ``scheme``, and their
+    weights; both of shape (pixels per particle, number of particles).
+    """
+
+    if scheme == "ngp":
+        return (
+            np.floor(position)[None, :].astype(np.int64),
+            np.ones((1, len(position))),
+        )
+    elif scheme == "cic":
+        # Distances from the centres of the pixels on either side.
+        offset = position - 0.5
+        lower = np.floor(offset)
+        fraction = offset - lower
+
+        return (
+            np.stack([lower, lower + 1]).astype(np.int64),
+            np.stack([1.0 - fraction, fraction]),
+        )
+    elif scheme == "tsc":
+        nearest = np.floor(position)
+        distance = position - nearest - 0.5
+
+        return (
+            np.stack([nearest - 1, nearest, nearest + 1]).astype(np.int64),
+            np.stack(
+                [
+                    0.5 * (0.5 - distance) ** 2,
+                    0.75 - distance**2,
+                    0.5 * (0.5 + distance) ** 2,
+                ]
+            ),
+        )
+
+    raise AttributeError(
+        f"Unknown mass assignment scheme {scheme}; use one of "
+        f"{', '.join(assignment_schemes)}."
+    )
+
+
+def assign_channels(x, y, weights, resolution: int, scheme: str = "cic"):
+    """
+    Assigns the ``weights`` (number of particles x number of channels) of
+    the particles at ``x`` and ``y`` (in [0, 1]) to a grid of ``resolution``
+    x ``resolution`` pixels with the NGP, CIC or TSC ``scheme``, which needs
+    no smoothing lengths. Weight that falls outside of the grid is lost.
+
+    Returns an array of shape (resolution, resolution, number of channels),
+    with the same normalisation as `scatter_channels`.
+    """
+
+    x_pixels, x_weights = _assignment_weights(
+        np.asarray(x, np.float64) * resolution, scheme
+    )
+    y_pixels, y_weights = _assignment_weights(
+        np.asarray(y, np.float64) * resolution, scheme
+    )
+
+    # All of the pixels that each particle is assigned to, flattened.
+    shape = (len(x_pixels), len(y_pixels), len(x))
+    pixels_x = np.broadcast_to(x_pixels[:, None, :], shape)
+    pixels_y = np.broadcast_to(y_pixels[None, :, :], shape)
+    fractions = (x_weights[:, None, :] * y_weights[None, :, :]).reshape(-1, len(x))
+
+    pixels_x = pixels_x.reshape(-1, len(x))
+    pixels_y = pixels_y.reshape(-1, len(x))
+
+    inside = np.logical_and.reduce(
+        [pixels_x >= 0, pixels_x < resolution, pixels_y >= 0, pixels_y < resolution]
+    )
+    flat_pixels = (pixels_x * resolution + pixels_y)[inside]
+
+    image = np.empty((resolution * resolution, weights.shape[1]), dtype=np.float32)
+
+    for channel in range(weights.shape[1]):
+        image[:, channel] = np.bincount(
+            flat_pixels,
+            weights=(fractions * weights[:, channel])[inside],
+            minlength=resolution * resolution,
+        )
+
+    image *= np.float32(resolution * resolution)
+
+    return image.reshape((resolution, resolution, weights.shape[1]))
+
+
+def smooth_pixel_grids(grids, sigma: float, counts=None, neighbours: int = None):
+    """
+    Smooths the ``grids`` (a list of arrays) with a Gaussian of ``sigma``
+    pixels. If the number of particles in each pixel, ``counts``, and a
+    number of ``neighbours`` are given, the smoothing is adaptive: each
+    pixel takes the value of the grids smoothed with the smallest of
+    ``sigma``, ``sigma / 2``, ``sigma / 4``, ... (down to half a pixel)
+    whose Gaussian holds about ``neighbours`` particles, or ``sigma`` if
+    none do; the total of the adaptively smoothed grids is not exactly
+    conserved.
+    """
+
+    from scipy.ndimage import gaussian_filter
+
+    if counts is None or neighbours is None:
+        return [gaussian_filter(grid, sigma, mode="constant") for grid in grids]
+
+    sigmas = [sigma]
+    while sigmas[-1] / 2 >= 0.5:
+        sigmas.append(sigmas[-1] / 2)
+
+    smoothed = [gaussian_filter(grid, sigma, mode="constant") for grid in grids]
+    # Widths chosen so far, from the widest, narrowing where there are enough.
+    for width in sigmas[1:]:
+        enclosed = gaussian_filter(counts, width, mode="constant") * (
+            4.0 * np.pi * width * width
+        )
+        enough = enclosed >= neighbours
+
+        if not np.any(enough):
+            break
+
+        for grid, smoothed_grid in zip(grids, smoothed):
+            smoothed_grid[enough] = gaussian_filter(grid, width, mode="constant")[
+                enough
+            ]
+
+    return smoothed
+
+
+def _channel_weights(data, name):
+    """
+    Values of the channel ``name``: a particle property, an array, or one
+    for every particle if None.
+    """
+
+    if name is None:
+        return np.ones(len(data.coordinates), dtype=np.float32)
+    elif isinstance(name, str):
+        return np.asarray(getattr(data, name), dtype=np.float32)
+    else:
+        return np.asarray(name, dtype=np.float32)
+
+
+def _value(quantity, units):
+    if units is None or not hasattr(quantity, "to"):
+        return np.asarray(quantity)
+
+    return quantity.to(units).value
+
+
+def rotated_positions(
+    coordinates, rotation_matrix=None, rotation_center=None, mask=None
+):
+    """
+    Positions (x, y) in the plane of the projection, in the units of
+    ``coordinates``, of the particles in ``mask``, rotated by
+    ``rotation_matrix`` around ``rotation_center`` if given.
+    """
+
+    units = getattr(coordinates, "units", None)
+
+    if mask is None:
+        mask = np.s_[...]
+
+    if rotation_center is not None:
+        center = _value(rotation_center, units).reshape((3, 1))
+        x, y, _ = (
+            np.matmul(rotation_matrix, np.asarray(coordinates[mask]).T - center)
+            + center
+        )
+    else:
+        x, y, _ = np.asarray(coordinates[mask]).T
+
+    return x, y
+
+
+def deposit_pixel_grids(
+    x,
+    y,
+    smoothing_lengths,
+    weights,
+    region,
+    resolution: int,
+    parallel: bool = False,
+    scheme: str = "sph",
+):
+    """
+    Deposits the ``weights`` (a list of arrays, one per channel) of the
+    particles at ``x`` and ``y`` with ``smoothing_lengths`` on grids that
+    cover ``region`` (all as values in the same units). With a ``scheme``
+    other than "sph" ("ngp", "cic" or "tsc"), the particles are assigned to
+    the nearest pixels instead, and the smoothing lengths are not used.
+
+    Returns a list of (resolution x resolution) arrays, one per channel,
+    with x as the first index.
+    """
+
+    x_min, x_max, y_min, y_max = region
+    x_range = x_max - x_min
+    y_range = y_max - y_min
+
+    x = ((x - x_min) / x_range).astype(np.float32)
+    y = ((y - y_min) / y_range).astype(np.float32)
+
+    weights = np.stack([np.asarray(w, dtype=np.float32) for w in weights], axis=1)
+
+    if scheme != "sph":
+        image = assign_channels(x, y, weights, resolution, scheme)
+
+        return [image[:, :, channel] for channel in range(weights.shape[1])]
+
+    h = (np.asarray(smoothing_lengths) / x_range).astype(np.float32)
+
+    if parallel:
+        image = scatter_channels_parallel(
+            x, y, weights, h, resolution, numba.get_num_threads()
+        )
+    else:
+        image = scatter_channels(x, y, weights, h, resolution)
+
+    return [image[:, :, channel] for channel in range(weights.shape[1])]
+
+
+def project_pixel_grids(
+    data,
+    boxsize,
+    resolution: int,
+    project=("masses",),
+    region=None,
+    mask=None,
+    rotation_matrix=None,
+    rotation_center=None,
+    parallel: bool = False,
+):
+    """
+    The same as swiftsimio's `project_pixel_grid`, but for a list of
+    quantities to ``project``, that are all deposited in the same pass
+    over the particles. Each entry is the name of a particle property, an
+    array with one value per particle, or None to project the number of
+    particles.
+
+    Returns a list of (resolution x resolution) arrays, one per entry in
+    ``project``, with x as the first index.
+    """
+
+    coordinates = data.coordinates
+    units = getattr(coordinates, "units", None)
+
+    if region is None:
+        region = [0.0 * boxsize[0], boxsize[0], 0.0 * boxsize[1], boxsize[1]]
+
+    if mask is None:
+        mask = np.s_[...]
+
+    x, y = rotated_positions(coordinates, rotation_matrix, rotation_center, mask)
+
+    return deposit_pixel_grids(
+        x,
+        y,
+        _value(data.smoothing_lengths, units)[mask],
+        [_channel_weights(data, name)[mask] for name in project],
+        [_value(edge, units) for edge in region],
+        resolution,
+        parallel,
+    )
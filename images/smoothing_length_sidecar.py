@@ -0,0 +1,26 @@
+"""
+Computes the smoothing lengths of all the star and dark matter particles
+in a snapshot (57 neighbours, periodic), and stores them next to it in
+<snapshot>.smoothing_lengths.hdf5. The images then read them from there,
+instead of generating them for every halo.
+
+Takes the snapshot filename as the only argument. Nothing is done if the
+sidecar is already up to date.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.smoothing_lengths import load_sidecar, sidecar_filename, write_sidecar
+
+if __name__ == "__main__":
+    snapshot_filename = sys.argv[1]
+
+    if load_sidecar(snapshot_filename) is None:
+        try:
+            write_sidecar(snapshot_filename)
+        except OSError as error:
+            # Read-only run directory; the images generate them instead.
+            print(f"Unable to write {sidecar_filename(snapshot_filename)}: {error}")
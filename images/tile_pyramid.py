@@ -0,0 +1,253 @@
+"""
+Multi-resolution (DeepZoom) tile pyramids of large pixel grids, and a
+static page to browse them with OpenSeadragon.
+
+A map of the whole box at tens of thousands of pixels a side can not be
+opened as a single image, so it is cut into tiles of 256^2 pixels at
+every level of a pyramid, from the full resolution down to a single
+pixel, and the viewer only loads the tiles in view. Each level is made
+by summing 2x2 blocks of the grids of the level above (the numerator and
+denominator separately for weighted averages), rather than by
+reprojecting or by downsampling the coloured images, and the whole
+pyramid is coloured with the same norm.
+
+The pyramid of ``<name>`` is written as ``<name>.dzi`` and the tiles as
+``<name>_files/<level>/<column>_<row>.png``.
+"""
+
+import os
+
+import numpy as np
+
+from fast_render import autoscale_in_strips, rasterise, write_image
+
+openseadragon_url = (
+    "https://cdn.jsdelivr.net/npm/openseadragon@4.1.0/build/openseadragon"
+)
+
+dzi_template = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  TileSize="{tile_size}" Overlap="{overlap}" Format="png">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+viewer_template = """<html>
+
+<head>
+    <title>{title}</title>
+    <style>
+        body {{
+            margin: 0;
+            font-family: sans-serif;
+        }}
+
+        #viewer {{
+            position: absolute;
+            top: 2.5em;
+            bottom: 0;
+            width: 100%;
+            background: white;
+        }}
+    </style>
+    <script src="{openseadragon_url}/openseadragon.min.js"></script>
+</head>
+
+<body>
+    <div style="padding: 0.5em">
+        <a href="index.html">Back</a>
+        <select id="map">
+{options}
+        </select>
+    </div>
+    <div id="viewer"></div>
+
+    <script type="text/javascript">
+        var select = document.getElementById("map");
+        var viewer = OpenSeadragon({{
+            id: "viewer",
+            prefixUrl: "{openseadragon_url}/images/",
+            tileSources: select.value,
+            showNavigator: true,
+            maxZoomPixelRatio: 4
+        }});
+
+        // Keep the same region in view when switching between maps.
+        var bounds = null;
+
+        select.onchange = function () {{
+            bounds = viewer.viewport.getBounds();
+            viewer.open(select.value);
+        }};
+
+        viewer.addHandler("open", function () {{
+            if (bounds !== null) {{
+                viewer.viewport.fitBounds(bounds, true);
+            }}
+        }});
+    </script>
+</body>
+
+</html>
+"""
+
+
+def _pair_sum(values: np.ndarray, axis: int) -> np.ndarray:
+    """
+    Sums of consecutive pairs of ``values`` along ``axis``, with the last
+    element on its own if there is an odd number of them.
+    """
+
+    if values.shape[axis] % 2 == 1:
+        padding = [(0, 0)] * values.ndim
+        padding[axis] = (0, 1)
+        values = np.pad(values, padding)
+
+    pairs = values.shape[axis] // 2
+    shape = values.shape[:axis] + (pairs, 2) + values.shape[axis + 1 :]
+
+    return values.reshape(shape).sum(axis=axis + 1)
+
+
+def _downsample(values: np.ndarray) -> np.ndarray:
+    """
+    Sums of the 2x2 blocks of ``values``, which is indexed as [x, y]. As
+    images are read from the top, y is paired from the top.
+    """
+
+    return _pair_sum(_pair_sum(values, 0)[:, ::-1], 1)[:, ::-1]
+
+
+def write_pyramid(
+    grid,
+    base_filename: str,
+    cmap,
+    norm,
+    background="black",
+    denominator=None,
+    tile_size: int = 256,
+    overlap: int = 1,
+    preview_filename: str = None,
+    preview_size: int = 2048,
+):
+    """
+    Writes the DeepZoom pyramid of ``grid`` (or of ``grid / denominator``),
+    indexed as [x, y] and possibly memory-mapped, as ``base_filename.dzi``.
+    ``norm`` is autoscaled to the full resolution grid if it has no
+    limits. The first level with at most ``preview_size`` pixels a side is
+    also written to ``preview_filename``, if given.
+
+    Only one strip of ``tile_size`` columns of the full resolution grid is
+    read at a time; the coarser levels (a quarter of its size and smaller)
+    are kept in memory.
+    """
+
+    if tile_size % 2 != 0:
+        raise AttributeError("The tile size must be even.")
+
+    width, height = grid.shape
+    level = int(np.ceil(np.log2(max(width, height, 1))))
+    tile_directory = f"{base_filename}_files"
+
+    autoscale_in_strips(norm, grid, denominator)
+
+    numerator = grid
+    # Number of full resolution pixels in each pixel, for plain averages.
+    counts = None if denominator is not None else [np.ones(width), np.ones(height)]
+
+    while level >= 0:
+        width, height = numerator.shape
+
+        coarse_numerator = np.zeros(((width + 1) // 2, (height + 1) // 2), np.float32)
+        coarse_denominator = (
+            None if denominator is None else np.zeros_like(coarse_numerator)
+        )
+        level_values = [] if max(width, height) <= preview_size else None
+
+        os.makedirs(f"{tile_directory}/{level}", exist_ok=True)
+
+        for column, start in enumerate(range(0, width, tile_size)):
+            stop = min(start + tile_size, width)
+            lower, upper = max(0, start - overlap), min(width, stop + overlap)
+
+            strip = np.asarray(numerator[lower:upper], dtype=np.float32)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                if denominator is not None:
+                    strip_denominator = np.asarray(
+                        denominator[lower:upper], dtype=np.float32
+                    )
+                    values = strip / strip_denominator
+                else:
+                    values = strip / np.outer(counts[0][lower:upper], counts[1])
+
+            for row, top in enumerate(range(0, height, tile_size)):
+                bottom = min(top + tile_size, height)
+
+                # Rows of the image run from the top, y from the bottom.
+                rows = np.s_[
+                    max(0, height - bottom - overlap) : height - max(0, top - overlap)
+                ]
+
+                write_image(
+                    rasterise(values[:, rows], cmap, norm, background),
+                    f"{tile_directory}/{level}/{column}_{row}.png",
+                )
+
+            inner = np.s_[start - lower : stop - lower]
+            coarse = np.s_[start // 2 : (stop + 1) // 2]
+
+            coarse_numerator[coarse] = _downsample(strip[inner])
+
+            if denominator is not None:
+                coarse_denominator[coarse] = _downsample(strip_denominator[inner])
+
+            if level_values is not None:
+                level_values.append(values[inner])
+
+        if level_values is not None and preview_filename is not None:
+            write_image(
+                rasterise(np.concatenate(level_values), cmap, norm, background),
+                preview_filename,
+            )
+            preview_filename = None
+
+        numerator, denominator = coarse_numerator, coarse_denominator
+
+        if counts is not None:
+            counts = [_pair_sum(counts[0], 0), _pair_sum(counts[1][::-1], 0)[::-1]]
+
+        level -= 1
+
+    with open(f"{base_filename}.dzi", "w") as handle:
+        handle.write(
+            dzi_template.format(
+                tile_size=tile_size,
+                overlap=overlap,
+                width=grid.shape[0],
+                height=grid.shape[1],
+            )
+        )
+
+    return
+
+
+def write_viewer(filename: str, pyramids: dict, title: str = "Maps"):
+    """
+    Writes a page at ``filename`` to browse the ``pyramids`` (the names of
+    the maps, and the paths of their .dzi files relative to the page).
+    """
+
+    options = "\n".join(
+        f'            <option value="{path}">{name}</option>'
+        for name, path in pyramids.items()
+    )
+
+    with open(filename, "w") as handle:
+        handle.write(
+            viewer_template.format(
+                title=title, options=options, openseadragon_url=openseadragon_url
+            )
+        )
+
+    return
@@ -0,0 +1,294 @@
+"""
+Follows the text logs of a simulation that is still running
+(timesteps_*.txt, SFR.txt and SNIa.txt) and keeps the star formation
+history, SNIa rate and performance plots up to date.
+
+Each log is read incrementally, so an update only parses the lines that
+were appended since the last poll. A group of plots is only re-rendered
+when one of its logs has new rows, and at most once every
+--min-render-interval seconds, so a fast-stepping run does not spend all
+of its time redrawing figures.
+
+Units (time, SFR, box size) are taken from the snapshot, which is read
+once; the plots that need them are skipped until it exists.
+
+Example:
+
+python3 live/watch_logs.py run_name /path/to/run eagle_0000.hdf5 plots/run_name
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+
+repository_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.append(repository_root)
+sys.path.append(os.path.join(repository_root, "plotting"))
+sys.path.append(os.path.join(repository_root, "performance"))
+
+from helpers.log_following import FollowedTable
+from helpers.snapshot_metadata import load_metadata
+from helpers.timesteps import follow_timesteps, timeline_from_table
+
+from glob import glob
+
+
+class RenderGroup(object):
+    """
+    A set of plots made from the same logs, with the time they were
+    last rendered.
+    """
+
+    def __init__(self, name: str, tables, render, needs_snapshot: bool = True):
+        self.name = name
+        self.tables = tables
+        self.render = render
+        self.needs_snapshot = needs_snapshot
+
+        self.pending = False
+        self.last_render = -np.inf
+
+        return
+
+    def update(self) -> int:
+        """
+        Reads new rows from all of the logs. Returns the number of new rows.
+        """
+
+        new_rows = sum(table.update() for table in self.tables)
+
+        if new_rows > 0:
+            self.pending = True
+
+        return new_rows
+
+    def ready(self, now: float, min_render_interval: float) -> bool:
+        return (
+            self.pending
+            and all(len(table.data) > 1 for table in self.tables)
+            and now - self.last_render >= min_render_interval
+        )
+
+
+class LogWatcher(object):
+    """
+    Follows the logs in a run directory and re-renders the plots made
+    from them.
+    """
+
+    def __init__(
+        self, run_name: str, run_directory: str, snapshot_name: str, output_path: str
+    ):
+        self.run_name = run_name
+        self.run_directory = run_directory
+        self.snapshot_filename = f"{run_directory}/{snapshot_name}"
+        self.output_path = output_path
+
+        self.metadata = None
+        self.groups = []
+        self.observational_data = {}
+
+        return
+
+    def load_snapshot(self) -> bool:
+        """
+        Reads the units from the snapshot header, if it exists yet.
+        """
+
+        if self.metadata is None and os.path.exists(self.snapshot_filename):
+            self.metadata = load_metadata(self.snapshot_filename)
+
+        return self.metadata is not None
+
+    def find_groups(self):
+        """
+        Starts following any logs that have appeared since the last call.
+        """
+
+        names = [group.name for group in self.groups]
+
+        timesteps_files = sorted(glob(f"{self.run_directory}/timesteps_*.txt"))
+
+        if "performance" not in names and len(timesteps_files) > 0:
+            self.groups.append(
+                RenderGroup(
+                    "performance",
+                    [follow_timesteps(timesteps_files[0])],
+                    self.render_performance,
+                )
+            )
+
+        if "star_formation_history" not in names and os.path.exists(
+            f"{self.run_directory}/SFR.txt"
+        ):
+            self.groups.append(
+                RenderGroup(
+                    "star_formation_history",
+                    [FollowedTable(f"{self.run_directory}/SFR.txt")],
+                    self.render_star_formation_history,
+                )
+            )
+
+        if "sn1a_rate" not in names and os.path.exists(
+            f"{self.run_directory}/SNIa.txt"
+        ):
+            self.groups.append(
+                RenderGroup(
+                    "sn1a_rate",
+                    [FollowedTable(f"{self.run_directory}/SNIa.txt")],
+                    self.render_sn1a_rate,
+                    needs_snapshot=False,
+                )
+            )
+
+        return
+
+    def render_performance(self, tables):
+        import number_of_steps_simulation_time
+        import particle_updates_step_cost
+        import wallclock_number_of_steps
+        import wallclock_simulation_time
+
+        timesteps = timeline_from_table(tables[0])
+        time_units = self.metadata.units.time
+
+        number_of_steps_simulation_time.make_plot(
+            timesteps, time_units, self.output_path
+        )
+        wallclock_simulation_time.make_plot(timesteps, time_units, self.output_path)
+        wallclock_number_of_steps.make_plot(timesteps, self.output_path)
+        particle_updates_step_cost.make_plot(timesteps, self.output_path)
+
+        return
+
+    def render_star_formation_history(self, tables):
+        import star_formation_history
+
+        if "star_formation_history" not in self.observational_data:
+            self.observational_data[
+                "star_formation_history"
+            ] = star_formation_history.read_obs_data(
+                os.path.join(repository_root, "plotting/sfr_data")
+            )
+
+        scale_factor, star_formation_rate = star_formation_history.star_formation_rate_density(
+            tables[0].data.T,
+            self.metadata.units.star_formation_rate,
+            self.metadata.box_volume,
+        )
+
+        star_formation_history.make_plot(
+            scale_factor,
+            star_formation_rate,
+            self.observational_data["star_formation_history"],
+            self.output_path,
+        )
+
+        return
+
+    def render_sn1a_rate(self, tables):
+        import sn1a_rate
+
+        if "sn1a_rate" not in self.observational_data:
+            self.observational_data["sn1a_rate"] = sn1a_rate.read_obs_data(
+                os.path.join(repository_root, "plotting/sn1a_data")
+            )
+
+        scale_factor, SNIa_rate = sn1a_rate.SNIa_rate_from_data(tables[0].data.T)
+
+        sn1a_rate.make_plot(
+            scale_factor,
+            SNIa_rate,
+            self.run_name,
+            self.observational_data["sn1a_rate"],
+            self.output_path,
+        )
+
+        return
+
+    def poll(self, min_render_interval: float) -> int:
+        """
+        Reads all new log lines and re-renders the groups that are due.
+        Returns the number of groups rendered.
+        """
+
+        self.find_groups()
+        have_snapshot = self.load_snapshot()
+
+        rendered = 0
+
+        for group in self.groups:
+            group.update()
+            now = time.monotonic()
+
+            if not group.ready(now, min_render_interval):
+                continue
+
+            if group.needs_snapshot and not have_snapshot:
+                continue
+
+            try:
+                group.render(group.tables)
+            except Exception as error:
+                # A half-written or restarted log should not stop the watcher.
+                print(f"Unable to render {group.name}: {error}")
+                continue
+
+            group.pending = False
+            group.last_render = now
+            rendered += 1
+
+        return rendered
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Keeps the log-based plots of a running simulation up to date."
+    )
+
+    parser.add_argument("run_name")
+    parser.add_argument("run_directory")
+    parser.add_argument("snapshot_name")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "--interval", type=float, default=10.0, help="Polling interval in seconds."
+    )
+    parser.add_argument(
+        "--min-render-interval",
+        type=float,
+        default=120.0,
+        help="Minimum time in seconds between re-renders of the same plots.",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Read the logs and render everything once, then exit.",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    os.makedirs(args.output_path, exist_ok=True)
+
+    watcher = LogWatcher(
+        args.run_name, args.run_directory, args.snapshot_name, args.output_path
+    )
+
+    while True:
+        watcher.poll(args.min_render_interval)
+
+        if args.once:
+            break
+
+        time.sleep(args.interval)
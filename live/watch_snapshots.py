@@ -0,0 +1,368 @@
+"""
+Watches a run directory for new snapshots and halo catalogues and runs
+the pipeline stages (plot_run, create_summary_plot and image_run from
+plot.sh and image.sh) on each one as soon as it has been written, rather
+than after the run has finished.
+
+A file is only considered complete once its size and modification time
+have not changed for --settle-time seconds and it can be opened with a
+valid header (the ``Header`` group for snapshots, the group counts for
+catalogues). A snapshot is processed once both ``eagle_XXXX.hdf5`` and
+``halo_XXXX.properties`` are complete.
+
+Snapshots are handed to a fixed number of workers through a bounded
+queue. If the simulation writes outputs faster than they can be
+processed, the queue fills up and new snapshots wait (oldest first)
+until a worker is free, so we never have more than --workers +
+--queue-size snapshots in flight. A stage fails as soon as any of the
+scripts in it fails. Snapshots on which every stage succeeded are
+recorded in the plot directory so that the watcher can be restarted.
+Those on which a stage failed are recorded (with the failed stages) in a
+separate file, and are retried when the watcher is restarted.
+
+The plots for each snapshot go to the same place as in run.sh, i.e.
+$run_directory/plots/snapshot_XXXX/run_name.
+
+Example:
+
+python3 live/watch_snapshots.py MyRun /path/to/runs/MyRun --workers 2
+"""
+
+import argparse
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+
+import h5py
+
+from glob import glob
+
+repository_root = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+
+snapshot_pattern = re.compile(r"eagle_(\d+)\.hdf5$")
+
+# The shell function for each stage, and the script that defines it.
+stage_functions = {
+    "plot": ("plot.sh", "plot_run"),
+    "summary": ("plot.sh", "create_summary_plot"),
+    "image": ("image.sh", "image_run"),
+}
+
+processed_filename = "processed_snapshots.txt"
+failed_filename = "failed_snapshots.txt"
+
+
+def snapshot_header_ok(filename: str) -> bool:
+    try:
+        with h5py.File(filename, "r") as handle:
+            return "Header" in handle and "NumPart_Total" in handle["Header"].attrs
+    except (OSError, KeyError):
+        return False
+
+
+def catalogue_header_ok(filename: str) -> bool:
+    try:
+        with h5py.File(filename, "r") as handle:
+            return "Num_of_groups" in handle or "Total_num_of_groups" in handle
+    except (OSError, KeyError):
+        return False
+
+
+class OutputFile(object):
+    """
+    A file that the simulation is (or was) writing, and whether it has
+    finished.
+    """
+
+    def __init__(self, filename: str, header_ok):
+        self.filename = filename
+        self.header_ok = header_ok
+
+        self.last_stat = None
+        self.stable_since = None
+        self.complete = False
+
+        return
+
+    def check(self, now: float, settle_time: float) -> bool:
+        """
+        Returns whether the file has been completely written.
+        """
+
+        if self.complete:
+            return True
+
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+
+        signature = (stat.st_size, stat.st_mtime)
+
+        if signature != self.last_stat:
+            # Files that were finished before we started watching have
+            # been stable since they were last modified.
+            self.last_stat = signature
+            self.stable_since = min(now, stat.st_mtime)
+
+        if now - self.stable_since < settle_time:
+            return False
+
+        self.complete = self.header_ok(self.filename)
+
+        return self.complete
+
+
+class SnapshotWatcher(object):
+    """
+    Finds complete outputs in the run directory and queues them for the
+    workers.
+    """
+
+    def __init__(self, run_name: str, run_directory: str, args):
+        self.run_name = run_name
+        # The stages run from the repository root.
+        self.run_directory = os.path.abspath(run_directory)
+        self.stages = args.stages
+        self.settle_time = args.settle_time
+        self.plot_root = os.path.abspath(
+            args.plot_directory or f"{self.run_directory}/plots"
+        )
+
+        self.outputs = {}
+        self.queued = set()
+        self.processed = self.read_processed()
+        # Not retried until the watcher is restarted.
+        self.failed = set()
+        self.lock = threading.Lock()
+
+        self.jobs = queue.Queue(maxsize=args.queue_size)
+        self.workers = [
+            threading.Thread(target=self.work, daemon=True)
+            for _ in range(args.workers)
+        ]
+
+        for worker in self.workers:
+            worker.start()
+
+        return
+
+    def read_processed(self) -> set:
+        try:
+            with open(f"{self.plot_root}/{processed_filename}", "r") as handle:
+                return {line.strip() for line in handle if line.strip()}
+        except OSError:
+            return set()
+
+    def mark_processed(self, snapshot_number: str):
+        with self.lock:
+            self.processed.add(snapshot_number)
+
+            os.makedirs(self.plot_root, exist_ok=True)
+
+            with open(f"{self.plot_root}/{processed_filename}", "a") as handle:
+                handle.write(f"{snapshot_number}\n")
+
+        return
+
+    def mark_failed(self, snapshot_number: str, stages: list):
+        with self.lock:
+            self.failed.add(snapshot_number)
+
+            os.makedirs(self.plot_root, exist_ok=True)
+
+            with open(f"{self.plot_root}/{failed_filename}", "a") as handle:
+                handle.write(f"{snapshot_number} {' '.join(stages)}\n")
+
+        return
+
+    def output(self, filename: str, header_ok) -> OutputFile:
+        if filename not in self.outputs:
+            self.outputs[filename] = OutputFile(filename, header_ok)
+
+        return self.outputs[filename]
+
+    def ready_snapshots(self):
+        """
+        Snapshot numbers whose snapshot and catalogue are both complete,
+        oldest first.
+        """
+
+        now = time.time()
+        numbers = []
+
+        for filename in glob(f"{self.run_directory}/eagle_*.hdf5"):
+            match = snapshot_pattern.search(filename)
+
+            if match is None:
+                continue
+
+            number = match.group(1)
+
+            if number in self.processed | self.queued | self.failed:
+                continue
+
+            snapshot = self.output(filename, snapshot_header_ok)
+            catalogue = self.output(
+                f"{self.run_directory}/halo_{number}.properties", catalogue_header_ok
+            )
+
+            # Check both, so that both settle timers are running.
+            snapshot_complete = snapshot.check(now, self.settle_time)
+            catalogue_complete = catalogue.check(now, self.settle_time)
+
+            if snapshot_complete and catalogue_complete:
+                numbers.append(number)
+
+        return sorted(numbers, key=int)
+
+    def poll(self) -> int:
+        """
+        Queues the snapshots that are ready, as long as there is room in
+        the queue. Returns the number queued.
+        """
+
+        number_queued = 0
+
+        for number in self.ready_snapshots():
+            with self.lock:
+                self.queued.add(number)
+
+            try:
+                self.jobs.put_nowait(number)
+            except queue.Full:
+                # Backpressure; the rest is picked up on a later poll.
+                with self.lock:
+                    self.queued.discard(number)
+
+                break
+
+            number_queued += 1
+
+        return number_queued
+
+    def run_stage(self, stage: str, snapshot_number: str) -> bool:
+        script, function = stage_functions[stage]
+
+        plot_directory = f"{self.plot_root}/snapshot_{snapshot_number}"
+        output_path = f"{plot_directory}/{self.run_name}"
+        os.makedirs(output_path, exist_ok=True)
+
+        # The stage functions do not stop at the first failing script, and
+        # return the status of the last one. With errexit set outside of any
+        # && list, it applies in the function body, so any failing script
+        # fails the stage.
+        command = [
+            "bash",
+            "-c",
+            f'set -e; source {script}; {function} "$@"',
+            function,
+            self.run_directory,
+            self.run_name,
+            plot_directory,
+            f"eagle_{snapshot_number}.hdf5",
+            f"halo_{snapshot_number}.properties",
+        ]
+
+        with open(f"{output_path}/watch_{stage}.log", "w") as log:
+            result = subprocess.run(
+                command, cwd=repository_root, stdout=log, stderr=subprocess.STDOUT
+            )
+
+        return result.returncode == 0
+
+    def work(self):
+        while True:
+            snapshot_number = self.jobs.get()
+
+            try:
+                start = time.time()
+                failed = [
+                    stage
+                    for stage in self.stages
+                    if not self.run_stage(stage, snapshot_number)
+                ]
+
+                status = f"failed stages {failed}" if failed else "done"
+                print(
+                    f"Snapshot {snapshot_number}: {status} "
+                    f"in {time.time() - start:.0f} s"
+                )
+
+                if failed:
+                    self.mark_failed(snapshot_number, failed)
+                else:
+                    self.mark_processed(snapshot_number)
+            finally:
+                with self.lock:
+                    self.queued.discard(snapshot_number)
+
+                self.jobs.task_done()
+
+    def finished(self) -> bool:
+        return len(self.queued) == 0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Runs the pipeline on snapshots as a simulation writes them."
+    )
+
+    parser.add_argument("run_name")
+    parser.add_argument("run_directory")
+    parser.add_argument(
+        "--plot-directory",
+        default=None,
+        help="Where to put the plots, defaults to $run_directory/plots.",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(stage_functions.keys()),
+        default=["plot", "summary"],
+        help="Stages to run on each snapshot, in order.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="Snapshots to process at once."
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=2,
+        help="Complete snapshots that may wait for a worker before we stop queueing.",
+    )
+    parser.add_argument(
+        "--settle-time",
+        type=float,
+        default=60.0,
+        help="Seconds a file must be unchanged before it is considered complete.",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=30.0, help="Polling interval in seconds."
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Process the snapshots that are complete now, then exit.",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    watcher = SnapshotWatcher(args.run_name, args.run_directory, args)
+
+    while True:
+        watcher.poll()
+
+        if args.once and watcher.finished() and len(watcher.ready_snapshots()) == 0:
+            break
+
+        time.sleep(args.interval)
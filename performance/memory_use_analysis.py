@@ -0,0 +1,446 @@
+"""
+Analyses the memory use reports that SWIFT writes when configured with
+--enable-memuse-reports (memuse_report-step*.dat, or
+memuse_report-rank*-step*.dat for MPI runs).
+
+Every allocation and free is replayed to track the memory in use per
+allocation label and per rank, both currently and at its peak, as well
+as the total and peak use in each step. Produces:
+
++ memory_use_evolution.png: memory in use at the end of each step, and
+  the peak within each step, per rank
++ memory_use_largest_consumers.png: labels with the largest peak use
++ memory_use_rank_balance.png: peak memory use of each rank
++ memory_use_summary.txt: the above as a table
+
+The logs are read incrementally, and the parsed state is kept in the
+output directory, so re-running this (or running with --follow on a live
+simulation) only parses the reports and lines written since the last time.
+"""
+
+import argparse
+import os
+import pickle
+import re
+import sys
+import time
+
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+
+from collections import defaultdict
+from glob import glob
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.downsample import plot_line
+from helpers.log_following import LogFollower
+from helpers.sidecar_cache import atomic_output, cache_signature, is_valid
+
+try:
+    plt.style.use("mnras.mplstyle")
+except:
+    pass
+
+state_filename = "memory_use_state.pickle"
+# Bump this if the layout of MemoryUseState changes.
+state_version = 1
+
+bytes_per_gb = 1024.0 ** 3
+
+
+def report_sort_key(filename: str):
+    """
+    Sorts reports by step, then by rank.
+    """
+
+    name = os.path.basename(filename)
+    step = re.search(r"step(\d+)", name)
+    rank = re.search(r"rank(\d+)", name)
+
+    return (int(step.group(1)) if step else -1, int(rank.group(1)) if rank else 0)
+
+
+def running_totals(keys, deltas, current: dict, peak: dict):
+    """
+    Applies ``deltas`` (in order) to the running totals of each key in
+    ``current``, updating the peaks in ``peak``. Returns the running total
+    of each line's key after that line has been applied.
+    """
+
+    totals = np.empty(len(deltas))
+
+    for key in np.unique(keys):
+        mask = keys == key
+        key = key.item()
+        running = current[key] + np.cumsum(deltas[mask])
+        totals[mask] = running
+
+        current[key] = running[-1]
+        peak[key] = max(peak[key], running.max())
+
+    return totals
+
+
+def state_signature(run_directory: str) -> str:
+    return cache_signature(state_version, run_directory=run_directory)
+
+
+class MemoryUseState(object):
+    """
+    Aggregated memory use of a run, updated as new report lines appear.
+    """
+
+    def __init__(self, run_directory: str):
+        self.signature = state_signature(run_directory)
+        self.run_directory = run_directory
+        self.followers = {}
+
+        # Live allocations, (rank, address) -> (label, size)
+        self.live = {}
+
+        self.label_current = defaultdict(int)
+        self.label_peak = defaultdict(int)
+        self.label_allocations = defaultdict(int)
+
+        self.rank_current = defaultdict(int)
+        self.rank_peak = defaultdict(int)
+
+        # (rank, step) -> [in use at end of step, peak during step]
+        self.steps = {}
+
+        return
+
+    def needs_restart(self) -> bool:
+        return any(follower.was_replaced() for follower in self.followers.values())
+
+    def update(self) -> int:
+        """
+        Reads any new reports and lines. Returns the number of new lines.
+        """
+
+        filenames = sorted(
+            glob(f"{self.run_directory}/memuse_report*.dat"), key=report_sort_key
+        )
+
+        number_of_lines = 0
+
+        for filename in filenames:
+            if filename not in self.followers:
+                self.followers[filename] = LogFollower(filename)
+
+            number_of_lines += self.add_lines(self.followers[filename].read_new_lines())
+
+        return number_of_lines
+
+    def add_lines(self, lines) -> int:
+        """
+        Replays the allocations and frees in ``lines``.
+        """
+
+        ranks = []
+        steps = []
+        labels = []
+        deltas = []
+
+        for line in lines:
+            if not line or line[0] == "#":
+                continue
+
+            # dtic adr rank step allocated label size
+            fields = line.split()
+
+            if len(fields) < 7:
+                continue
+
+            try:
+                rank = int(fields[2])
+                step = int(fields[3])
+                allocated = int(fields[4])
+                size = int(fields[-1])
+            except ValueError:
+                continue
+
+            label = " ".join(fields[5:-1])
+            key = (rank, fields[1])
+
+            if allocated == 1:
+                previous = self.live.get(key)
+
+                if previous is not None:
+                    # Re-use of an address we never saw freed.
+                    ranks.append(rank)
+                    steps.append(step)
+                    labels.append(previous[0])
+                    deltas.append(-previous[1])
+
+                self.live[key] = (label, size)
+                self.label_allocations[label] += 1
+                delta = size
+            else:
+                previous = self.live.pop(key, None)
+
+                if previous is None:
+                    # Allocated before the reports started.
+                    continue
+
+                label, delta = previous[0], -previous[1]
+
+            ranks.append(rank)
+            steps.append(step)
+            labels.append(label)
+            deltas.append(delta)
+
+        if len(deltas) == 0:
+            return 0
+
+        ranks = np.array(ranks)
+        steps = np.array(steps)
+        labels = np.array(labels)
+        deltas = np.array(deltas, dtype=np.float64)
+
+        running_totals(labels, deltas, self.label_current, self.label_peak)
+        rank_totals = running_totals(ranks, deltas, self.rank_current, self.rank_peak)
+
+        # Reduce the per-rank running totals to each (rank, step).
+        keys = ranks * (1 << 32) + steps
+        unique_keys = np.unique(keys)
+        last = len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+        order = np.argsort(keys, kind="stable")
+        starts = np.searchsorted(keys[order], unique_keys)
+        peaks = np.maximum.reduceat(rank_totals[order], starts)
+
+        for key, end_index, step_peak in zip(unique_keys, last, peaks):
+            rank, step = divmod(int(key), 1 << 32)
+            previous = self.steps.get((rank, step), [0.0, 0.0])
+            self.steps[(rank, step)] = [
+                rank_totals[end_index],
+                max(previous[1], step_peak),
+            ]
+
+        return len(deltas)
+
+
+def load_state(run_directory: str, output_path: str) -> MemoryUseState:
+    """
+    Loads the state from a previous invocation, if there is one that is
+    still valid for this run.
+    """
+
+    try:
+        with open(f"{output_path}/{state_filename}", "rb") as handle:
+            state = pickle.load(handle)
+
+        if (
+            is_valid(getattr(state, "signature", None), state_signature(run_directory))
+            and not state.needs_restart()
+        ):
+            return state
+    except (OSError, pickle.UnpicklingError, AttributeError, EOFError):
+        pass
+
+    return MemoryUseState(run_directory)
+
+
+def save_state(state: MemoryUseState, output_path: str):
+    with atomic_output(f"{output_path}/{state_filename}") as temporary_filename:
+        with open(temporary_filename, "wb") as handle:
+            pickle.dump(state, handle)
+
+    return
+
+
+def plot_evolution(state: MemoryUseState, output_path: str):
+    ranks = sorted({rank for rank, _ in state.steps})
+
+    fig, ax = plt.subplots()
+
+    def step_arrays(rank):
+        steps = sorted(step for r, step in state.steps if r == rank)
+        values = np.array([state.steps[(rank, step)] for step in steps])
+        return np.array(steps), values[:, 0] / bytes_per_gb, values[:, 1] / bytes_per_gb
+
+    if len(ranks) <= 8:
+        for index, rank in enumerate(ranks):
+            steps, in_use, peak = step_arrays(rank)
+            label = f"Rank {rank}" if len(ranks) > 1 else "In use"
+            plot_line(ax, steps, in_use, color=f"C{index}", label=label)
+            plot_line(ax, steps, peak, color=f"C{index}", linestyle="dashed")
+    else:
+        # Too many ranks to show individually; show the most loaded rank
+        # and the mean over ranks.
+        all_steps = np.array(sorted({step for _, step in state.steps}))
+        peak = np.zeros(len(all_steps))
+        total = np.zeros(len(all_steps))
+
+        for rank in ranks:
+            steps, _, rank_peak = step_arrays(rank)
+            indices = np.searchsorted(all_steps, steps)
+            peak[indices] = np.maximum(peak[indices], rank_peak)
+            total[indices] += rank_peak
+
+        plot_line(ax, all_steps, peak, color="C0", label="Maximum over ranks")
+        plot_line(
+            ax, all_steps, total / len(ranks), color="C1", label="Mean over ranks"
+        )
+
+    ax.plot([], [], color="grey", linestyle="dashed", label="Peak in step")
+
+    ax.set_xlabel("Step")
+    ax.set_ylabel("Memory tracked in reports [GB]")
+    ax.set_ylim(0, None)
+    ax.legend()
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/memory_use_evolution.png")
+    plt.close(fig)
+
+    return
+
+
+def plot_largest_consumers(state: MemoryUseState, output_path: str, number=20):
+    labels = sorted(state.label_peak, key=state.label_peak.get, reverse=True)[:number]
+    positions = np.arange(len(labels))
+
+    fig, ax = plt.subplots(figsize=(3.321, 4.0))
+
+    ax.barh(
+        positions,
+        [state.label_peak[label] / bytes_per_gb for label in labels],
+        color="C0",
+        alpha=0.5,
+        label="Peak",
+    )
+    ax.barh(
+        positions,
+        [state.label_current[label] / bytes_per_gb for label in labels],
+        color="C0",
+        label="Current",
+    )
+
+    ax.set_yticks(positions)
+    ax.set_yticklabels(labels, fontsize=5)
+    ax.invert_yaxis()
+    ax.set_xlabel("Memory use (summed over ranks) [GB]")
+    ax.legend(loc="lower right")
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/memory_use_largest_consumers.png")
+    plt.close(fig)
+
+    return
+
+
+def plot_rank_balance(state: MemoryUseState, output_path: str):
+    ranks = sorted(state.rank_peak)
+
+    fig, ax = plt.subplots()
+
+    ax.bar(
+        ranks,
+        [state.rank_peak[rank] / bytes_per_gb for rank in ranks],
+        width=1.0,
+        color="C0",
+        alpha=0.5,
+        label="Peak",
+    )
+    ax.bar(
+        ranks,
+        [state.rank_current[rank] / bytes_per_gb for rank in ranks],
+        width=1.0,
+        color="C0",
+        label="Current",
+    )
+
+    ax.set_xlabel("Rank")
+    ax.set_ylabel("Memory use [GB]")
+    ax.legend()
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/memory_use_rank_balance.png")
+    plt.close(fig)
+
+    return
+
+
+def write_summary(state: MemoryUseState, output_path: str):
+    labels = sorted(state.label_peak, key=state.label_peak.get, reverse=True)
+
+    with open(f"{output_path}/memory_use_summary.txt", "w") as handle:
+        handle.write(f"# Memory use from {len(state.followers)} reports\n")
+        handle.write(f"# {'Rank':>30s} {'Current [GB]':>14s} {'Peak [GB]':>14s}\n")
+
+        for rank in sorted(state.rank_peak):
+            handle.write(
+                f"  {rank:>30d} {state.rank_current[rank] / bytes_per_gb:14.4f} "
+                f"{state.rank_peak[rank] / bytes_per_gb:14.4f}\n"
+            )
+
+        handle.write(
+            f"# {'Label':>30s} {'Current [GB]':>14s} {'Peak [GB]':>14s} "
+            f"{'Allocations':>12s}\n"
+        )
+
+        for label in labels:
+            handle.write(
+                f"  {label:>30s} {state.label_current[label] / bytes_per_gb:14.4f} "
+                f"{state.label_peak[label] / bytes_per_gb:14.4f} "
+                f"{state.label_allocations[label]:12d}\n"
+            )
+
+    return
+
+
+def render(state: MemoryUseState, output_path: str):
+    plot_evolution(state, output_path)
+    plot_largest_consumers(state, output_path)
+    plot_rank_balance(state, output_path)
+    write_summary(state, output_path)
+
+    return
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Analyses SWIFT memuse reports.")
+
+    parser.add_argument("run_name")
+    parser.add_argument("run_directory")
+    parser.add_argument("snapshot_name")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Keep watching the run for new reports, re-rendering as they appear.",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=60.0, help="Polling interval in seconds."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if len(glob(f"{args.run_directory}/memuse_report*.dat")) == 0 and not args.follow:
+        exit(0)
+
+    os.makedirs(args.output_path, exist_ok=True)
+    state = load_state(args.run_directory, args.output_path)
+
+    while True:
+        if state.needs_restart():
+            state = MemoryUseState(args.run_directory)
+
+        if state.update() > 0 or not args.follow:
+            render(state, args.output_path)
+            save_state(state, args.output_path)
+
+        if not args.follow:
+            break
+
+        time.sleep(args.interval)
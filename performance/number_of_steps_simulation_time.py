@@ -7,47 +7,55 @@ import unyt
 import matplotlib.pyplot as plt
 import numpy as np
 
-from swiftsimio import load
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.downsample import plot_line
+from helpers.snapshot_metadata import load_metadata
+from helpers.timesteps import load_run_timesteps
 
 try:
     plt.style.use("mnras.mplstyle")
 except:
     pass
 
-from glob import glob
-import sys
 
-run_name = sys.argv[1]
-run_directory = sys.argv[2]
-snapshot_name = sys.argv[3]
-output_path = sys.argv[4]
+def make_plot(timesteps, time_units, output_path):
+    sim_time = unyt.unyt_array(timesteps.time, units=time_units).to("Gyr")
+    number_of_steps = np.arange(sim_time.size) / 1e6
+
+    fig, ax = plt.subplots()
+
+    # Simulation data plotting
+    plot_line(ax, number_of_steps, sim_time, color="C0")
 
-timesteps_glob = glob(f"{run_directory}/timesteps_*.txt")
-timesteps_filename = timesteps_glob[0]
-snapshot_filename = f"{run_directory}/{snapshot_name}"
+    ax.scatter(number_of_steps[-1], sim_time[-1], color="C0", marker=".", zorder=10)
 
+    ax.set_ylabel("Simulation time [Gyr]")
+    ax.set_xlabel("Number of steps [millions]")
 
-snapshot = load(snapshot_filename)
-data = np.genfromtxt(
-    timesteps_filename, skip_footer=5, loose=True, invalid_raise=False
-).T
+    ax.set_xlim(0, None)
+    ax.set_ylim(0, None)
 
-sim_time = unyt.unyt_array(data[1], units=snapshot.units.time).to("Gyr")
-number_of_steps = np.arange(sim_time.size) / 1e6
+    fig.tight_layout()
 
-fig, ax = plt.subplots()
+    fig.savefig(f"{output_path}/number_of_steps_simulation_time.png")
+    plt.close(fig)
 
-# Simulation data plotting
-ax.plot(number_of_steps, sim_time, color="C0")
+    return
 
-ax.scatter(number_of_steps[-1], sim_time[-1], color="C0", marker=".", zorder=10)
 
-ax.set_ylabel("Simulation time [Gyr]")
-ax.set_xlabel("Number of steps [millions]")
+if __name__ == "__main__":
+    run_name = sys.argv[1]
+    run_directory = sys.argv[2]
+    snapshot_name = sys.argv[3]
+    output_path = sys.argv[4]
 
-ax.set_xlim(0, None)
-ax.set_ylim(0, None)
+    snapshot_filename = f"{run_directory}/{snapshot_name}"
 
-fig.tight_layout()
+    metadata = load_metadata(snapshot_filename)
+    timesteps = load_run_timesteps(run_directory, cache_directory=output_path)
 
-fig.savefig(f"{output_path}/number_of_steps_simulation_time.png")
+    make_plot(timesteps, metadata.units.time, output_path)
@@ -0,0 +1,383 @@
+"""
+Strong and weak scaling analysis over several runs of the same problem
+at different core counts.
+
+All runs are read in a single process from their (cached) timestep logs.
+The number of cores for each run is taken from the snapshot metadata or
+the timesteps file header, and can be overridden on the command line.
+
+For all runs we use the wallclock time needed to reach the latest
+simulation time that every run has reached, so that partially complete
+runs can still be compared. Produces:
+
++ scaling_wallclock.png: wallclock time against number of cores
++ scaling_efficiency.png: parallel efficiency against number of cores
++ scaling_cost_per_update.png: time per particle update per core
++ scaling_step_cost_distribution.png: distribution of per-step costs
++ scaling_table.txt: all of the above as a table
+
+Example:
+
+python3 performance/scaling_analysis.py \
+    -r runs/N1 runs/N2 runs/N4 -n N1 N2 N4 -s eagle_0036.hdf5 -o plots
+"""
+
+import argparse
+import os
+import sys
+
+import h5py
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.timesteps import load_run_timesteps
+
+try:
+    plt.style.use("mnras.mplstyle")
+except:
+    pass
+
+# Groups in the snapshot that may carry the number of threads and ranks.
+metadata_groups = ["Header", "Code", "RuntimePars"]
+
+step_cost_bins = np.logspace(-2, 4, 128)
+
+
+def read_snapshot_core_counts(snapshot_filename: str):
+    """
+    Looks for the number of threads and MPI ranks in the snapshot
+    metadata. Either may be None if they can not be found.
+    """
+
+    threads = None
+    ranks = None
+
+    try:
+        handle = h5py.File(snapshot_filename, "r")
+    except OSError:
+        return threads, ranks
+
+    with handle:
+        for group_name in metadata_groups:
+            if group_name not in handle:
+                continue
+
+            for key, value in handle[group_name].attrs.items():
+                try:
+                    value = int(np.asarray(value).flat[0])
+                except (TypeError, ValueError):
+                    continue
+
+                lower_key = key.lower()
+
+                if "thread" in lower_key and threads is None:
+                    threads = value
+                elif "rank" in lower_key and ranks is None:
+                    ranks = value
+
+    return threads, ranks
+
+
+class ScalingRun(object):
+    """
+    Timeline and core count of a single run in the scaling analysis.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run_directory: str,
+        snapshot_name: str,
+        cores=None,
+        cache_directory=None,
+    ):
+        self.name = name
+        self.run_directory = run_directory
+        self.timesteps = load_run_timesteps(run_directory, cache_directory)
+
+        if cores is None:
+            threads, ranks = read_snapshot_core_counts(
+                f"{run_directory}/{snapshot_name}"
+            )
+
+            threads = threads or self.timesteps.number_of_threads
+            ranks = ranks or self.timesteps.number_of_ranks or 1
+
+            if threads is None:
+                raise RuntimeError(
+                    f"Unable to find the number of threads for {run_directory}, "
+                    "please pass it with --cores."
+                )
+
+            cores = threads * ranks
+
+        self.cores = int(cores)
+
+        return
+
+    def reduce_to_time(self, end_time: float):
+        """
+        Computes the wallclock time (ms) and number of particle updates
+        needed to reach the simulation time ``end_time``.
+        """
+
+        time = self.timesteps.time
+
+        # Restarted runs repeat steps, so the times are not monotonic. Keep
+        # the last step at each time, i.e. the one after the latest restart.
+        order = np.argsort(time, kind="stable")
+        order = order[np.append(np.diff(time[order]) > 0, True)]
+
+        self.wallclock = np.interp(
+            end_time, time[order], self.timesteps.cumulative_wallclock[order]
+        )
+        self.updates = np.interp(
+            end_time, time[order], np.cumsum(self.timesteps.particle_updates)[order]
+        )
+        # Core-microseconds per particle update
+        self.cost_per_update = 1e3 * self.wallclock * self.cores / self.updates
+
+        reached = time <= end_time
+        updates = self.timesteps.particle_updates[reached]
+        has_updates = updates > 0
+        self.step_costs = (
+            1e3
+            * self.timesteps.wallclock[reached][has_updates]
+            * self.cores
+            / updates[has_updates]
+        )
+
+        return
+
+
+def compute_efficiencies(runs, mode: str):
+    """
+    Sets the speedup and parallel efficiency on each run, relative to
+    the run with the fewest cores.
+    """
+
+    reference = min(runs, key=lambda run: run.cores)
+
+    for run in runs:
+        run.speedup = reference.wallclock / run.wallclock
+
+        if mode == "strong":
+            run.efficiency = run.speedup * reference.cores / run.cores
+        else:
+            # Weak scaling; the problem size grows with the core count, so
+            # compare the cost of each particle update per core.
+            run.efficiency = reference.cost_per_update / run.cost_per_update
+
+    return reference
+
+
+def plot_wallclock(runs, reference, mode: str, output_path: str):
+    fig, ax = plt.subplots()
+    ax.loglog()
+
+    cores = np.array([run.cores for run in runs])
+    hours = np.array([run.wallclock for run in runs]) / 3.6e6
+
+    ideal_cores = np.logspace(np.log10(cores.min()), np.log10(cores.max()), 16)
+    reference_hours = reference.wallclock / 3.6e6
+
+    if mode == "strong":
+        ideal = reference_hours * reference.cores / ideal_cores
+    else:
+        ideal = np.ones_like(ideal_cores) * reference_hours
+
+    ax.plot(ideal_cores, ideal, color="grey", linestyle="dashed", label="Ideal")
+    ax.plot(cores, hours, color="C0", marker="o", label=f"{mode.title()} scaling")
+
+    for run, x, y in zip(runs, cores, hours):
+        ax.text(x, y, f" {run.name}", fontsize=5, ha="left", va="bottom")
+
+    ax.set_xlabel("Number of cores")
+    ax.set_ylabel("Wallclock time [Hours]")
+    ax.legend()
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/scaling_wallclock.png")
+    plt.close(fig)
+
+    return
+
+
+def plot_efficiency(runs, mode: str, output_path: str):
+    fig, ax = plt.subplots()
+    ax.semilogx()
+
+    cores = [run.cores for run in runs]
+
+    ax.axhline(1.0, color="grey", linestyle="dashed")
+    ax.plot(cores, [run.efficiency for run in runs], color="C0", marker="o")
+
+    ax.set_xlabel("Number of cores")
+    ax.set_ylabel(f"Parallel efficiency ({mode} scaling)")
+    ax.set_ylim(0, 1.2)
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/scaling_efficiency.png")
+    plt.close(fig)
+
+    return
+
+
+def plot_cost_per_update(runs, output_path: str):
+    fig, ax = plt.subplots()
+    ax.loglog()
+
+    ax.plot(
+        [run.cores for run in runs],
+        [run.cost_per_update for run in runs],
+        color="C0",
+        marker="o",
+    )
+
+    ax.set_xlabel("Number of cores")
+    ax.set_ylabel("Time per particle update per core [$\\mu$s]")
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/scaling_cost_per_update.png")
+    plt.close(fig)
+
+    return
+
+
+def plot_step_cost_distribution(runs, output_path: str):
+    fig, ax = plt.subplots()
+    ax.semilogx()
+
+    centers = np.sqrt(step_cost_bins[1:] * step_cost_bins[:-1])
+
+    for index, run in enumerate(runs):
+        H, _ = np.histogram(run.step_costs, bins=step_cost_bins)
+        ax.plot(
+            centers,
+            H / max(H.sum(), 1),
+            color=f"C{index}",
+            label=f"{run.name} ({run.cores} cores)",
+        )
+
+    ax.set_xlabel("Step cost per particle update per core [$\\mu$s]")
+    ax.set_ylabel("Fraction of steps")
+    ax.legend()
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/scaling_step_cost_distribution.png")
+    plt.close(fig)
+
+    return
+
+
+def write_table(runs, end_time: float, mode: str, output_path: str):
+    header = (
+        f"# {mode.title()} scaling to simulation time {end_time:.6g} (internal units)\n"
+        f"# {'Run':>20s} {'Cores':>8s} {'Wallclock [h]':>14s} {'Updates':>12s} "
+        f"{'Speedup':>8s} {'Efficiency':>10s} {'us/update/core':>14s} "
+        f"{'Step p10':>10s} {'Step p50':>10s} {'Step p90':>10s}\n"
+    )
+
+    with open(f"{output_path}/scaling_table.txt", "w") as handle:
+        handle.write(header)
+
+        for run in runs:
+            if len(run.step_costs) > 0:
+                p10, p50, p90 = np.percentile(run.step_costs, [10, 50, 90])
+            else:
+                p10 = p50 = p90 = np.nan
+
+            handle.write(
+                f"  {run.name:>20s} {run.cores:8d} {run.wallclock / 3.6e6:14.4g} "
+                f"{run.updates:12.4g} {run.speedup:8.3f} {run.efficiency:10.3f} "
+                f"{run.cost_per_update:14.4g} {p10:10.4g} {p50:10.4g} {p90:10.4g}\n"
+            )
+
+    return
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Strong/weak scaling analysis from SWIFT timesteps files."
+    )
+
+    parser.add_argument(
+        "-r", "--run-directories", nargs="+", required=True, help="Run directories."
+    )
+    parser.add_argument(
+        "-n", "--run-names", nargs="+", default=None, help="Names for the runs."
+    )
+    parser.add_argument(
+        "-s",
+        "--snapshot-name",
+        default="",
+        help="Snapshot (within each run directory) to read the core count from.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cores",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Number of cores of each run, overrides the metadata.",
+    )
+    parser.add_argument(
+        "-m", "--mode", choices=["strong", "weak"], default="strong"
+    )
+    parser.add_argument("-o", "--output-path", required=True)
+
+    args = parser.parse_args()
+
+    # zip would silently drop the runs beyond the shortest list.
+    for option, values in [("--run-names", args.run_names), ("--cores", args.cores)]:
+        if values is not None and len(values) != len(args.run_directories):
+            parser.error(
+                f"{option} has {len(values)} values for "
+                f"{len(args.run_directories)} run directories."
+            )
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    names = args.run_names or [
+        os.path.basename(os.path.normpath(x)) for x in args.run_directories
+    ]
+    cores = args.cores or [None] * len(args.run_directories)
+
+    os.makedirs(args.output_path, exist_ok=True)
+
+    runs = [
+        ScalingRun(
+            name,
+            run_directory,
+            args.snapshot_name,
+            cores=core_count,
+            cache_directory=args.output_path,
+        )
+        for name, run_directory, core_count in zip(
+            names, args.run_directories, cores
+        )
+    ]
+    runs.sort(key=lambda run: run.cores)
+
+    end_time = min(run.timesteps.time.max() for run in runs)
+
+    for run in runs:
+        run.reduce_to_time(end_time)
+
+    reference = compute_efficiencies(runs, args.mode)
+
+    plot_wallclock(runs, reference, args.mode, args.output_path)
+    plot_efficiency(runs, args.mode, args.output_path)
+    plot_cost_per_update(runs, args.output_path)
+    plot_step_cost_distribution(runs, args.output_path)
+    write_table(runs, end_time, args.mode, args.output_path)
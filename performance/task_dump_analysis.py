@@ -0,0 +1,662 @@
+"""
+Analyses the SWIFT task dumps (thread_info-step*.dat, written when SWIFT is
+configured with --enable-task-debugging) to show where the time in each
+step goes, and how much of it threads spend idle.
+
+Each dump is streamed in chunks of rows, so memory use does not depend on
+the number of tasks, and all dumps are processed in parallel. Produces:
+
++ task_time_per_type.png: total time spent in each task type/subtype
++ task_thread_utilisation.png: busy fraction of each thread
++ task_idle_fraction.png: idle (dead) fraction of each step against the
+  number of particle updates, to compare with particle_updates_step_cost.png
++ task_timelines/task_timeline_step_*.png: what each thread is doing
+  through a step, coloured by task type
++ task_summary.txt: the per-type times as a table
+
+Takes the same arguments as the other performance scripts, and silently
+exits if the run has no task dumps.
+"""
+
+import argparse
+import itertools
+import os
+import re
+import sys
+
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+
+from glob import glob
+from multiprocessing import Pool
+
+try:
+    plt.style.use("mnras.mplstyle")
+except:
+    pass
+
+# Task types and subtypes, in the order of the enums in SWIFT's task.h.
+# These change between SWIFT versions; pass --task-types/--task-subtypes
+# with one name per line to override them.
+task_types = [
+    "none",
+    "sort",
+    "self",
+    "pair",
+    "sub_self",
+    "sub_pair",
+    "init_grav",
+    "init_grav_out",
+    "ghost_in",
+    "ghost",
+    "ghost_out",
+    "extra_ghost",
+    "drift_part",
+    "drift_spart",
+    "drift_sink",
+    "drift_bpart",
+    "drift_gpart",
+    "drift_gpart_out",
+    "hydro_end_force",
+    "kick1",
+    "kick2",
+    "timestep",
+    "timestep_limiter",
+    "timestep_sync",
+    "send",
+    "recv",
+    "pack",
+    "unpack",
+    "grav_long_range",
+    "grav_mm",
+    "grav_down_in",
+    "grav_down",
+    "grav_end_force",
+    "cooling",
+    "cooling_in",
+    "cooling_out",
+    "star_formation",
+    "star_formation_in",
+    "star_formation_out",
+    "star_formation_sink",
+    "logger",
+    "stars_in",
+    "stars_out",
+    "stars_ghost_in",
+    "stars_ghost",
+    "stars_ghost_out",
+    "stars_sort",
+    "stars_resort",
+    "bh_in",
+    "bh_out",
+    "bh_density_ghost",
+    "bh_swallow_ghost1",
+    "bh_swallow_ghost2",
+    "bh_swallow_ghost3",
+    "fof_self",
+    "fof_pair",
+]
+
+task_subtypes = [
+    "none",
+    "density",
+    "gradient",
+    "force",
+    "limiter",
+    "grav",
+    "external_grav",
+    "tend_part",
+    "tend_gpart",
+    "tend_spart",
+    "tend_sink",
+    "tend_bpart",
+    "xv",
+    "rho",
+    "part_swallow",
+    "bpart_merger",
+    "gpart",
+    "multipole",
+    "spart",
+    "stars_density",
+    "stars_feedback",
+    "sf_count",
+    "bpart_rho",
+    "bpart_swallow",
+    "bpart_feedback",
+    "bh_density",
+    "bh_swallow",
+    "do_gas_swallow",
+    "do_bh_swallow",
+    "bh_feedback",
+]
+
+# Combined (type, subtype) keys are type * max_subtypes + subtype.
+max_types = 256
+max_subtypes = 256
+
+# Column layout of the dumps, following SWIFT's tools/analyse_tasks.py.
+# MPI dumps have 13 columns, and an extra rank column at the front.
+mpi_columns = dict(rank=0, thread=1, type=2, subtype=3, tic=5, toc=6, updates=7)
+non_mpi_columns = dict(rank=None, thread=0, type=1, subtype=2, tic=4, toc=5, updates=6)
+mpi_number_of_columns = 13
+
+default_chunk_size = 1 << 20
+timeline_pixels = 1024
+# Only this many (rank, thread) rows are drawn in the timelines, and
+# task types beyond timeline_types are drawn as the last type.
+max_timeline_rows = 128
+timeline_types = 64
+
+
+class StepSummary(object):
+    """
+    Streaming reduction of a single thread_info-step*.dat dump.
+    """
+
+    def __init__(self, filename: str, step: int):
+        self.filename = filename
+        self.step = step
+
+        self.cpu_clock = None  # CPU ticks per ms
+        self.step_tic = {}  # Per rank
+        self.step_toc = {}
+        self.updates = 0
+
+        self.type_time = np.zeros(max_types * max_subtypes)
+        self.type_count = np.zeros(max_types * max_subtypes, dtype=np.int64)
+
+        # Rows are (rank, thread) pairs, in order of first appearance.
+        self.rows = {}
+        self.row_busy = np.zeros(0)
+        self.row_rank = np.zeros(0, dtype=np.int64)
+        self.timeline = np.zeros((0, timeline_types, timeline_pixels), dtype=np.float32)
+
+        return
+
+    @property
+    def step_length(self):
+        """
+        Step length (in ms) of every rank.
+        """
+        return {
+            rank: (self.step_toc[rank] - tic) / self.cpu_clock
+            for rank, tic in self.step_tic.items()
+        }
+
+    def _row_indices(self, ranks, threads):
+        keys = ranks * (1 << 20) + threads
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+        for key in unique_keys:
+            if int(key) not in self.rows:
+                self.rows[int(key)] = len(self.rows)
+
+        number_of_rows = len(self.rows)
+
+        if number_of_rows > len(self.row_busy):
+            extra = number_of_rows - len(self.row_busy)
+            self.row_busy = np.concatenate([self.row_busy, np.zeros(extra)])
+            self.row_rank = np.concatenate(
+                [self.row_rank, np.zeros(extra, dtype=np.int64)]
+            )
+
+            timeline_rows = min(number_of_rows, max_timeline_rows)
+            if timeline_rows > len(self.timeline):
+                self.timeline = np.concatenate(
+                    [
+                        self.timeline,
+                        np.zeros(
+                            (
+                                timeline_rows - len(self.timeline),
+                                timeline_types,
+                                timeline_pixels,
+                            ),
+                            dtype=np.float32,
+                        ),
+                    ]
+                )
+
+        rows = np.array([self.rows[int(key)] for key in unique_keys])[
+            inverse.reshape(-1)
+        ]
+        self.row_rank[rows] = ranks
+
+        return rows
+
+    def _deposit_timeline(self, rows, types, start, end):
+        """
+        Adds the fraction of each timeline pixel covered by the tasks
+        running from ``start`` to ``end`` (in pixels).
+        """
+
+        keep = rows < max_timeline_rows
+        rows, start, end = rows[keep], start[keep], end[keep]
+        types = np.minimum(types[keep], timeline_types - 1)
+
+        start = np.clip(start, 0, timeline_pixels)
+        end = np.clip(end, 0, timeline_pixels)
+
+        base = (rows * timeline_types + types) * timeline_pixels
+        size = self.timeline.size
+        first_pixel = np.minimum(np.floor(start).astype(np.int64), timeline_pixels - 1)
+        last_pixel = np.minimum(np.floor(end).astype(np.int64), timeline_pixels - 1)
+        single = first_pixel == last_pixel
+
+        coverage = np.zeros(size)
+        coverage += np.bincount(
+            base[single] + first_pixel[single],
+            weights=(end - start)[single],
+            minlength=size,
+        )
+
+        # Partial first and last pixels
+        multi = ~single
+        coverage += np.bincount(
+            base[multi] + first_pixel[multi],
+            weights=(first_pixel + 1 - start)[multi],
+            minlength=size,
+        )
+        coverage += np.bincount(
+            base[multi] + last_pixel[multi],
+            weights=(end - last_pixel)[multi],
+            minlength=size,
+        )
+
+        # Fully covered pixels in between, with a difference array
+        difference = np.bincount(
+            base[multi] + first_pixel[multi] + 1, minlength=size + 1
+        ) - np.bincount(base[multi] + last_pixel[multi], minlength=size + 1)
+        difference = difference[:size].reshape(-1, timeline_pixels)
+
+        self.timeline += (
+            coverage.reshape(self.timeline.shape)
+            + np.cumsum(difference, axis=1).reshape(self.timeline.shape)
+        ).astype(np.float32)
+
+        return
+
+    def add_chunk(self, chunk: np.ndarray, columns: dict):
+        """
+        Adds a chunk of rows from the dump to the summary.
+        """
+
+        types = chunk[:, columns["type"]].astype(np.int64)
+        ranks = (
+            chunk[:, columns["rank"]].astype(np.int64)
+            if columns["rank"] is not None
+            else np.zeros(len(chunk), dtype=np.int64)
+        )
+
+        # The step header rows carry the step times and CPU frequency. In
+        # non-MPI dumps they have type -1, but in MPI dumps (type 0) they are
+        # the first row of each rank, as in SWIFT's analyse_tasks.py.
+        if columns["rank"] is None:
+            header = types < 0
+        else:
+            header = np.zeros(len(chunk), dtype=bool)
+            unique_ranks, first_rows = np.unique(ranks, return_index=True)
+
+            for rank, first_row in zip(unique_ranks, first_rows):
+                if int(rank) not in self.step_tic:
+                    header[first_row] = True
+
+        for row, rank in zip(chunk[header], ranks[header]):
+            self.step_tic[int(rank)] = row[columns["tic"]]
+            self.step_toc[int(rank)] = row[columns["toc"]]
+            self.cpu_clock = float(row[-1]) / 1000.0
+            self.updates += int(row[columns["updates"]])
+
+        tic = chunk[:, columns["tic"]]
+        toc = chunk[:, columns["toc"]]
+        tasks = ~header & (tic > 0) & (toc >= tic)
+
+        if not tasks.any() or self.cpu_clock is None:
+            return
+
+        types = np.clip(types[tasks], 0, max_types - 1)
+        subtypes = np.clip(
+            chunk[tasks, columns["subtype"]].astype(np.int64), 0, max_subtypes - 1
+        )
+        ranks = ranks[tasks]
+        threads = chunk[tasks, columns["thread"]].astype(np.int64)
+        tic, toc = tic[tasks], toc[tasks]
+
+        durations = (toc - tic) / self.cpu_clock
+        keys = types * max_subtypes + subtypes
+
+        self.type_time += np.bincount(keys, weights=durations, minlength=len(self.type_time))
+        self.type_count += np.bincount(keys, minlength=len(self.type_count))
+
+        rows = self._row_indices(ranks, threads)
+        self.row_busy += np.bincount(rows, weights=durations, minlength=len(self.row_busy))
+
+        # Times relative to the start of the step on each rank.
+        rank_tic = np.array([self.step_tic.get(int(r), np.nan) for r in range(ranks.max() + 1)])
+        step_start = rank_tic[ranks]
+        step_start[np.isnan(step_start)] = tic.min()
+
+        lengths = self.step_length
+        longest = max(lengths.values()) if lengths else durations.max()
+        to_pixels = timeline_pixels / (longest * self.cpu_clock)
+
+        self._deposit_timeline(
+            rows, types, (tic - step_start) * to_pixels, (toc - step_start) * to_pixels
+        )
+
+        return
+
+    def finalise(self):
+        """
+        Computes the per-row utilisation and the idle fraction of the step.
+        """
+
+        lengths = self.step_length
+        self.row_length = np.array(
+            [lengths.get(int(rank), np.nan) for rank in self.row_rank]
+        )
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.row_utilisation = self.row_busy / self.row_length
+            self.idle_fraction = 1.0 - self.row_busy.sum() / self.row_length.sum()
+
+        return self
+
+
+def read_step_number(filename: str) -> int:
+    match = re.search(r"step(\d+)", os.path.basename(filename))
+
+    return int(match.group(1)) if match else -1
+
+
+def analyse_dump(filename: str, chunk_size: int = default_chunk_size):
+    """
+    Streams a dump file through a `StepSummary`, ``chunk_size`` rows
+    at a time.
+    """
+
+    summary = StepSummary(filename, read_step_number(filename))
+    columns = None
+
+    with open(filename, "r") as handle:
+        lines = (line for line in handle if line.strip() and line[0] != "#")
+
+        while True:
+            chunk_lines = list(itertools.islice(lines, chunk_size))
+
+            if len(chunk_lines) == 0:
+                break
+
+            chunk = np.loadtxt(chunk_lines, ndmin=2)
+
+            if columns is None:
+                columns = (
+                    mpi_columns
+                    if chunk.shape[1] == mpi_number_of_columns
+                    else non_mpi_columns
+                )
+
+            summary.add_chunk(chunk, columns)
+
+    return summary.finalise()
+
+
+def type_name(key: int, type_names=task_types, subtype_names=task_subtypes) -> str:
+    task_type, subtype = divmod(int(key), max_subtypes)
+
+    name = type_names[task_type] if task_type < len(type_names) else f"type_{task_type}"
+
+    if subtype > 0:
+        name += "/" + (
+            subtype_names[subtype]
+            if subtype < len(subtype_names)
+            else f"subtype_{subtype}"
+        )
+
+    return name
+
+
+def plot_timeline(
+    summary: StepSummary,
+    output_path: str,
+    type_names=task_types,
+    subtype_names=task_subtypes,
+):
+    """
+    Draws the pixel timeline of a step: each row is a (rank, thread) and
+    each pixel is coloured by the task type that occupied it the most.
+    """
+
+    timeline = summary.timeline
+    busy = timeline.sum(axis=1)
+    dominant = np.argmax(timeline, axis=1)
+
+    present = np.unique(dominant[busy > 0.5])
+    cmap = plt.get_cmap("tab20", max(len(present), 1))
+    lookup = np.zeros(timeline_types, dtype=np.int64)
+    lookup[present] = np.arange(len(present))
+
+    image = np.ma.masked_array(lookup[dominant], mask=busy < 0.5)
+
+    fig, ax = plt.subplots(figsize=(6.642, 3.0))
+
+    ax.imshow(
+        image,
+        aspect="auto",
+        interpolation="nearest",
+        cmap=cmap,
+        vmin=-0.5,
+        vmax=len(present) - 0.5,
+        origin="lower",
+        extent=[0, max(summary.step_length.values(), default=1.0), 0, len(timeline)],
+    )
+
+    for index, task_type in enumerate(present):
+        ax.plot(
+            [],
+            [],
+            color=cmap(index),
+            label=type_name(task_type * max_subtypes, type_names, subtype_names),
+        )
+
+    ax.legend(loc="upper left", bbox_to_anchor=(1.0, 1.0), fontsize=4, ncol=2)
+    ax.set_xlabel("Time since start of step [ms]")
+    ax.set_ylabel("Thread")
+    ax.set_title(f"Step {summary.step}")
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/task_timeline_step_{summary.step:07d}.png")
+    plt.close(fig)
+
+    return
+
+
+def analyse_and_plot(arguments):
+    # The task names are passed along, as the processes of the pool do not
+    # see names read in the parent.
+    filename, chunk_size, timeline_path, type_names, subtype_names = arguments
+
+    summary = analyse_dump(filename, chunk_size=chunk_size)
+    plot_timeline(summary, timeline_path, type_names, subtype_names)
+
+    # Drop the timeline before sending the summary back to the parent.
+    summary.timeline = None
+
+    return summary
+
+
+def plot_type_times(
+    summaries,
+    output_path: str,
+    number_to_show: int = 25,
+    type_names=task_types,
+    subtype_names=task_subtypes,
+):
+    type_time = sum(summary.type_time for summary in summaries)
+    order = np.argsort(type_time)[::-1]
+    order = order[type_time[order] > 0][:number_to_show]
+
+    fig, ax = plt.subplots(figsize=(3.321, 4.0))
+
+    ax.barh(np.arange(len(order)), type_time[order] / 1e3, color="C0")
+    ax.set_yticks(np.arange(len(order)))
+    ax.set_yticklabels(
+        [type_name(key, type_names, subtype_names) for key in order], fontsize=5
+    )
+    ax.invert_yaxis()
+    ax.set_xscale("log")
+    ax.set_xlabel("Total time in tasks [s]")
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/task_time_per_type.png")
+    plt.close(fig)
+
+    return type_time
+
+
+def plot_thread_utilisation(summaries, output_path: str):
+    number_of_rows = max(len(summary.row_busy) for summary in summaries)
+
+    busy = np.zeros(number_of_rows)
+    length = np.zeros(number_of_rows)
+
+    for summary in summaries:
+        n = len(summary.row_busy)
+        valid = np.isfinite(summary.row_length)
+        busy[:n][valid] += summary.row_busy[valid]
+        length[:n][valid] += summary.row_length[valid]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        utilisation = busy / length
+
+    fig, ax = plt.subplots()
+
+    ax.bar(np.arange(number_of_rows), utilisation, width=1.0, color="C0")
+    ax.axhline(np.nanmean(utilisation), color="grey", linestyle="dashed")
+
+    ax.set_xlabel("Thread")
+    ax.set_ylabel("Fraction of step time spent in tasks")
+    ax.set_ylim(0, 1)
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/task_thread_utilisation.png")
+    plt.close(fig)
+
+    return
+
+
+def plot_idle_fraction(summaries, output_path: str):
+    updates = np.array([summary.updates for summary in summaries])
+    idle = np.array([summary.idle_fraction for summary in summaries])
+
+    fig, ax = plt.subplots()
+
+    mappable = ax.scatter(
+        updates, idle, c=[summary.step for summary in summaries], s=4
+    )
+    fig.colorbar(mappable, label="Step", pad=0)
+
+    ax.set_xscale("log")
+    ax.set_xlabel("Number of particle updates in step")
+    ax.set_ylabel("Idle fraction of step")
+    ax.set_ylim(0, 1)
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/task_idle_fraction.png")
+    plt.close(fig)
+
+    return
+
+
+def write_summary(
+    summaries,
+    type_time,
+    output_path: str,
+    type_names=task_types,
+    subtype_names=task_subtypes,
+):
+    type_count = sum(summary.type_count for summary in summaries)
+    order = np.argsort(type_time)[::-1]
+    order = order[type_time[order] > 0]
+    total = type_time.sum()
+
+    with open(f"{output_path}/task_summary.txt", "w") as handle:
+        handle.write(f"# Task analysis of {len(summaries)} steps\n")
+        handle.write(
+            f"# {'Type':>30s} {'Count':>12s} {'Time [ms]':>14s} {'Fraction':>9s}\n"
+        )
+
+        for key in order:
+            handle.write(
+                f"  {type_name(key, type_names, subtype_names):>30s} "
+                f"{type_count[key]:12d} "
+                f"{type_time[key]:14.6g} {type_time[key] / total:9.4f}\n"
+            )
+
+    return
+
+
+def read_names(filename: str):
+    with open(filename, "r") as handle:
+        return [line.strip() for line in handle if line.strip()]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Analyses SWIFT task dumps.")
+
+    parser.add_argument("run_name")
+    parser.add_argument("run_directory")
+    parser.add_argument("snapshot_name")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "--processes", type=int, default=None, help="Number of dumps read at once."
+    )
+    parser.add_argument("--chunk-size", type=int, default=default_chunk_size)
+    parser.add_argument("--task-types", default=None)
+    parser.add_argument("--task-subtypes", default=None)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    filenames = sorted(
+        glob(f"{args.run_directory}/thread_info-step*.dat"), key=read_step_number
+    )
+
+    if len(filenames) == 0:
+        sys.exit(0)
+
+    type_names = (
+        task_types if args.task_types is None else read_names(args.task_types)
+    )
+    subtype_names = (
+        task_subtypes if args.task_subtypes is None else read_names(args.task_subtypes)
+    )
+
+    timeline_path = f"{args.output_path}/task_timelines"
+    os.makedirs(timeline_path, exist_ok=True)
+
+    with Pool(args.processes) as pool:
+        summaries = pool.map(
+            analyse_and_plot,
+            [
+                (filename, args.chunk_size, timeline_path, type_names, subtype_names)
+                for filename in filenames
+            ],
+            chunksize=1,
+        )
+
+    type_time = plot_type_times(
+        summaries,
+        args.output_path,
+        type_names=type_names,
+        subtype_names=subtype_names,
+    )
+    plot_thread_utilisation(summaries, args.output_path)
+    plot_idle_fraction(summaries, args.output_path)
+    write_summary(summaries, type_time, args.output_path, type_names, subtype_names)
@@ -7,47 +7,55 @@ import unyt
 import matplotlib.pyplot as plt
 import numpy as np
 
-from swiftsimio import load
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.downsample import plot_line
+from helpers.timesteps import load_run_timesteps
 
 try:
     plt.style.use("mnras.mplstyle")
 except:
     pass
 
-from glob import glob
-import sys
 
-run_name = sys.argv[1]
-run_directory = sys.argv[2]
-snapshot_name = sys.argv[3]
-output_path = sys.argv[4]
+def make_plot(timesteps, output_path):
+    wallclock_time = unyt.unyt_array(timesteps.cumulative_wallclock, units="ms").to(
+        "Hour"
+    )
+    number_of_steps = np.arange(wallclock_time.size) / 1e6
+
+    fig, ax = plt.subplots()
 
-timesteps_glob = glob(f"{run_directory}/timesteps_*.txt")
-timesteps_filename = timesteps_glob[0]
-snapshot_filename = f"{run_directory}/{snapshot_name}"
+    # Simulation data plotting
+    plot_line(ax, wallclock_time, number_of_steps, color="C0")
 
+    ax.scatter(
+        wallclock_time[-1], number_of_steps[-1], color="C0", marker=".", zorder=10
+    )
 
-snapshot = load(snapshot_filename)
-data = np.genfromtxt(
-    timesteps_filename, skip_footer=5, loose=True, invalid_raise=False
-).T
+    ax.set_ylabel("Number of steps [millions]")
+    ax.set_xlabel("Wallclock time [Hours]")
 
-wallclock_time = unyt.unyt_array(np.cumsum(data[-2]), units="ms").to("Hour")
-number_of_steps = np.arange(wallclock_time.size) / 1e6
+    ax.set_xlim(0, None)
+    ax.set_ylim(0, None)
 
-fig, ax = plt.subplots()
+    fig.tight_layout()
 
-# Simulation data plotting
-ax.plot(wallclock_time, number_of_steps, color="C0")
+    fig.savefig(f"{output_path}/wallclock_number_of_steps.png")
+    plt.close(fig)
 
-ax.scatter(wallclock_time[-1], number_of_steps[-1], color="C0", marker=".", zorder=10)
+    return
 
-ax.set_ylabel("Number of steps [millions]")
-ax.set_xlabel("Wallclock time [Hours]")
 
-ax.set_xlim(0, None)
-ax.set_ylim(0, None)
+if __name__ == "__main__":
+    run_name = sys.argv[1]
+    run_directory = sys.argv[2]
+    snapshot_name = sys.argv[3]
+    output_path = sys.argv[4]
 
-fig.tight_layout()
+    timesteps = load_run_timesteps(run_directory, cache_directory=output_path)
 
-fig.savefig(f"{output_path}/wallclock_number_of_steps.png")
+    make_plot(timesteps, output_path)
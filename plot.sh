@@ -26,7 +26,21 @@ plot_run () {
   catalogue_path=$run_directory/$catalogue_name
   output_path=$plot_directory/$run_name
 
-  velociraptor-plot \
+  python3 plotting/halo_aggregates.py \
+    $run_name \
+    $run_directory \
+    $snapshot_name \
+    $output_path \
+    $catalogue_name
+
+  python3 plotting/halo_apertures.py \
+    $run_name \
+    $run_directory \
+    $snapshot_name \
+    $output_path \
+    $catalogue_name
+
+  EXTRA_QUANTITIES_PATH=$output_path velociraptor-plot \
     -c auto_plotter/*.yml \
     -r registration.py \
     -p $catalogue_path \
@@ -47,6 +61,13 @@ plot_run () {
     $snapshot_name \
     $output_path
 
+  python3 plotting/galaxy_star_formation_histories.py \
+    $run_name \
+    $run_directory \
+    $snapshot_name \
+    $output_path \
+    $catalogue_name
+
   python3 plotting/density_temperature.py \
     $run_name \
     $run_directory \
@@ -118,6 +139,18 @@ plot_run () {
     $run_directory \
     $snapshot_name \
     $output_path
+
+  python3 performance/task_dump_analysis.py \
+    $run_name \
+    $run_directory \
+    $snapshot_name \
+    $output_path
+
+  python3 performance/memory_use_analysis.py \
+    $run_name \
+    $run_directory \
+    $snapshot_name \
+    $output_path
 }
 
 # Creates a summary plot based on the above created figures, and converts
@@ -0,0 +1,247 @@
+"""
+Computes the star formation history of every central galaxy above a
+stellar mass cut in a single pass over the star particles.
+
+Star particles are assigned to halos in bulk from the VELOCIraptor
+particle files, and their initial masses (or their current masses, if
+the snapshot has no initial masses) are binned in birth time per galaxy
+with one ``np.bincount``. Produces:
+
++ galaxy_star_formation_histories.hdf5: the (number of galaxies x number
+  of time bins) star formation history matrix, in Msun / yr, with the
+  catalogue index and stellar mass of each galaxy and the time bin edges.
++ galaxy_star_formation_histories.png: the median star formation history
+  in bins of stellar mass.
+
+Takes the usual run name, run directory, snapshot name and output path,
+followed by the name of the halo catalogue (as in plot.sh).
+"""
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import h5py
+import unyt
+
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.halo_particles import read_halo_membership, group_by_halo
+from helpers.snapshot_metadata import load_metadata
+
+try:
+    plt.style.use("mnras.mplstyle")
+except:
+    pass
+
+minimal_stellar_mass = unyt.unyt_quantity(1e9, "Solar_Mass")
+number_of_time_bins = 64
+# Stellar mass bins (30 kpc aperture) for the median histories.
+stellar_mass_bins = unyt.unyt_array(
+    np.append(np.logspace(9.0, 11.0, 5), 1e13), "Solar_Mass"
+)
+# Number of star particles to process at once.
+chunk_size = 1 << 22
+
+output_filename = "galaxy_star_formation_histories"
+
+
+def select_galaxies(catalogue):
+    """
+    Catalogue indices and stellar masses of the central galaxies above
+    the stellar mass cut.
+    """
+
+    stellar_masses = catalogue.apertures.mass_star_30_kpc.to("Solar_Mass")
+
+    selected = np.logical_and(
+        catalogue.structure_type.structuretype == 10,
+        stellar_masses > minimal_stellar_mass,
+    )
+
+    return np.where(selected)[0], stellar_masses[selected]
+
+
+def compute_histories(snapshot_filename, metadata, membership, galaxy_indices):
+    """
+    Returns the star formation history (in Msun / yr) of each galaxy in
+    ``galaxy_indices``, the edges of the time bins (in Gyr), and the name
+    of the star particle masses that were binned.
+    """
+
+    time_bin_edges = np.linspace(
+        0.0, metadata.cosmic_time(metadata.a), number_of_time_bins + 1
+    )
+
+    # Row in the output for each halo in the catalogue, or -1.
+    rows = np.full(membership.number_of_halos, -1, dtype=np.int64)
+    rows[galaxy_indices] = np.arange(len(galaxy_indices))
+
+    stars = membership.select_type(4)
+    mass_formed = np.zeros((len(galaxy_indices), number_of_time_bins))
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        particle_ids = handle["PartType4/ParticleIDs"]
+        birth_scale_factors = handle["PartType4/BirthScaleFactors"]
+
+        # Snapshots without the initial masses only give the mass formed
+        # less the mass lost since.
+        if "PartType4/InitialMasses" in handle:
+            mass_field = "InitialMasses"
+        else:
+            mass_field = "Masses"
+            print(
+                f"No PartType4/InitialMasses in {snapshot_filename}, "
+                "using the current masses of the star particles instead."
+            )
+
+        masses = handle[f"PartType4/{mass_field}"]
+
+        for start in range(0, particle_ids.shape[0], chunk_size):
+            stop = start + chunk_size
+
+            halo_indices = stars.match(particle_ids[start:stop])
+            galaxy_rows = np.where(halo_indices >= 0, rows[halo_indices], -1)
+
+            mass_formed += group_by_halo(
+                galaxy_rows,
+                metadata.cosmic_time(birth_scale_factors[start:stop]),
+                len(galaxy_indices),
+                bins=time_bin_edges,
+                weights=masses[start:stop].astype(np.float64),
+            )
+
+    bin_widths = np.diff(time_bin_edges) * metadata.units.time
+    star_formation_histories = (mass_formed * metadata.units.mass / bin_widths).to(
+        "Solar_Mass / year"
+    )
+
+    return (
+        star_formation_histories,
+        (time_bin_edges * metadata.units.time).to("Gyr"),
+        mass_field,
+    )
+
+
+def write_histories(
+    filename, galaxy_indices, stellar_masses, time_bin_edges, star_formation_histories
+):
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset("halo_indices", data=galaxy_indices)
+
+        datasets = {
+            "stellar_mass_30_kpc": stellar_masses,
+            "time_bin_edges": time_bin_edges,
+            "star_formation_histories": star_formation_histories,
+        }
+
+        for name, values in datasets.items():
+            dataset = handle.create_dataset(
+                name, data=values.value, compression="gzip", shuffle=True
+            )
+            dataset.attrs["units"] = str(values.units)
+
+    return
+
+
+def make_plot(
+    time_bin_edges,
+    star_formation_histories,
+    stellar_masses,
+    output_path,
+    mass_field="InitialMasses",
+):
+    """
+    Plots the median star formation history, and the 16-84th percentile
+    range, of the galaxies in each stellar mass bin. The legend notes if
+    the histories were made from the current masses (``mass_field``).
+    """
+
+    fig, ax = plt.subplots()
+    ax.semilogy()
+
+    time_centers = 0.5 * (time_bin_edges[1:] + time_bin_edges[:-1]).value
+    bin_indices = np.digitize(stellar_masses, stellar_mass_bins) - 1
+
+    for index in range(len(stellar_mass_bins) - 1):
+        histories = star_formation_histories[bin_indices == index].value
+
+        if len(histories) == 0:
+            continue
+
+        low, median, high = np.percentile(histories, [16, 50, 84], axis=0)
+
+        label = (
+            f"$10^{{{np.log10(stellar_mass_bins[index].value):.1f}}}$"
+            f" - $10^{{{np.log10(stellar_mass_bins[index + 1].value):.1f}}}$"
+            f" M$_\\odot$ ({len(histories)})"
+        )
+
+        ax.plot(time_centers, median, color=f"C{index}", label=label)
+        ax.fill_between(time_centers, low, high, color=f"C{index}", alpha=0.2)
+
+    ax.set_xlabel("Cosmic time [Gyr]")
+    ax.set_ylabel("SFR [M$_\\odot$ yr$^{-1}$]")
+    ax.set_xlim(0, time_bin_edges[-1].value)
+    ax.set_ylim(1e-3, None)
+
+    title = "$M_*$ (30 kpc)"
+
+    if mass_field != "InitialMasses":
+        title += "\nfrom current stellar masses"
+
+    ax.legend(loc="upper left", fontsize=4, title=title, title_fontsize=4)
+
+    fig.tight_layout()
+    fig.savefig(f"{output_path}/{output_filename}.png")
+    plt.close(fig)
+
+    return
+
+
+if __name__ == "__main__":
+    from velociraptor import load
+
+    run_name = sys.argv[1]
+    run_directory = sys.argv[2]
+    snapshot_name = sys.argv[3]
+    output_path = sys.argv[4]
+    catalogue_name = sys.argv[5]
+
+    snapshot_filename = f"{run_directory}/{snapshot_name}"
+    catalogue_filename = f"{run_directory}/{catalogue_name}"
+
+    metadata = load_metadata(snapshot_filename)
+
+    if metadata.n_stars == 0:
+        exit(0)
+
+    catalogue = load(catalogue_filename)
+    galaxy_indices, stellar_masses = select_galaxies(catalogue)
+
+    membership = read_halo_membership(catalogue_filename, output_path)
+
+    star_formation_histories, time_bin_edges, mass_field = compute_histories(
+        snapshot_filename, metadata, membership, galaxy_indices
+    )
+
+    write_histories(
+        f"{output_path}/{output_filename}.hdf5",
+        galaxy_indices,
+        stellar_masses,
+        time_bin_edges,
+        star_formation_histories,
+    )
+
+    make_plot(
+        time_bin_edges,
+        star_formation_histories,
+        stellar_masses,
+        output_path,
+        mass_field=mass_field,
+    )
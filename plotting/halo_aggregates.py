@@ -0,0 +1,132 @@
+"""
+Computes extra per-halo quantities (gas phase masses, metal masses, black
+hole accretion rates, ...) directly from the snapshot particles, for all
+halos in the catalogue at once.
+
+The results are written to the output path as
+extra_halo_aggregates.hdf5, which registration.py adds to the catalogue as
+``derived_quantities.<name>`` for use in the auto_plotter/*.yml files. This
+needs to run before velociraptor-plot.
+
+Takes the usual run name, run directory, snapshot name and output path,
+followed by the name of the halo catalogue (as in plot.sh).
+"""
+
+import unyt
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.halo_aggregates import (
+    HaloQuantity,
+    compute_halo_quantities,
+    extra_quantities_filename,
+    write_extra_quantities,
+)
+from helpers.halo_particles import read_halo_membership
+
+stage_name = "halo_aggregates"
+
+cold_gas_temperature = unyt.unyt_quantity(1e5, "K")
+hot_gas_temperature = unyt.unyt_quantity(1e7, "K")
+minimal_star_formation_rate = unyt.unyt_quantity(0.0, "Solar_Mass / year")
+
+quantities = [
+    HaloQuantity(
+        name="gas_mass_cold",
+        particle_type=0,
+        dataset="Masses",
+        selection=("Temperatures", None, cold_gas_temperature),
+        units="Solar_Mass",
+        label="Cold Gas Mass ($T < 10^5$ K)",
+    ),
+    HaloQuantity(
+        name="gas_mass_warm",
+        particle_type=0,
+        dataset="Masses",
+        selection=("Temperatures", cold_gas_temperature, hot_gas_temperature),
+        units="Solar_Mass",
+        label="Warm Gas Mass ($10^5$ K $< T < 10^7$ K)",
+    ),
+    HaloQuantity(
+        name="gas_mass_hot",
+        particle_type=0,
+        dataset="Masses",
+        selection=("Temperatures", hot_gas_temperature, None),
+        units="Solar_Mass",
+        label="Hot Gas Mass ($T > 10^7$ K)",
+    ),
+    HaloQuantity(
+        name="gas_temperature_mass_weighted",
+        particle_type=0,
+        dataset="Temperatures",
+        reduction="mean",
+        weights="Masses",
+        units="K",
+        label="Mass-weighted Gas Temperature",
+    ),
+    HaloQuantity(
+        name="gas_star_forming_mass_fraction",
+        particle_type=0,
+        reduction="fraction",
+        weights="Masses",
+        selection=("StarFormationRates", minimal_star_formation_rate, None),
+        label="Star-forming Gas Mass Fraction",
+    ),
+    HaloQuantity(
+        name="gas_metal_mass",
+        particle_type=0,
+        dataset="MetalMassFractions",
+        weights="Masses",
+        units="Solar_Mass",
+        label="Gas Metal Mass",
+    ),
+    HaloQuantity(
+        name="star_metal_mass",
+        particle_type=4,
+        dataset="MetalMassFractions",
+        weights="Masses",
+        units="Solar_Mass",
+        label="Stellar Metal Mass",
+    ),
+    HaloQuantity(
+        name="black_hole_accretion_rate",
+        particle_type=5,
+        dataset="AccretionRates",
+        units="Solar_Mass / year",
+        label="Total BH Accretion Rate",
+    ),
+    HaloQuantity(
+        name="black_hole_subgrid_mass_max",
+        particle_type=5,
+        dataset="SubgridMasses",
+        reduction="max",
+        units="Solar_Mass",
+        label="Most Massive BH Subgrid Mass",
+    ),
+]
+
+if __name__ == "__main__":
+    run_name = sys.argv[1]
+    run_directory = sys.argv[2]
+    snapshot_name = sys.argv[3]
+    output_path = sys.argv[4]
+    catalogue_name = sys.argv[5]
+
+    snapshot_filename = f"{run_directory}/{snapshot_name}"
+    catalogue_filename = f"{run_directory}/{catalogue_name}"
+
+    os.makedirs(output_path, exist_ok=True)
+
+    membership = read_halo_membership(catalogue_filename, output_path)
+
+    halo_quantities = compute_halo_quantities(
+        snapshot_filename, membership, quantities
+    )
+
+    write_extra_quantities(
+        extra_quantities_filename(output_path, catalogue_filename, stage_name),
+        halo_quantities,
+    )
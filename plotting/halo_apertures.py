@@ -0,0 +1,232 @@
+"""
+Computes stellar masses, star formation rates and metallicities within
+apertures that VELOCIraptor does not output (5, 10 and 50 kpc, both
+spherical and projected along the z-axis), for every galaxy in the
+catalogue, directly from the snapshot particles.
+
+The results are written to the output path as
+extra_halo_apertures.hdf5, which registration.py adds to the catalogue as
+e.g. ``derived_quantities.aperture_mass_star_10_kpc`` and
+``derived_quantities.projected_aperture_sfr_gas_5_kpc``. As with the
+VELOCIraptor apertures, the radii are physical. Unlike them, all of the
+particles within an aperture are included, not only those bound to the
+galaxy, so the values of satellites and of galaxies in dense environments
+are higher than the VELOCIraptor ones would be. This needs to run before
+velociraptor-plot.
+
+Takes the usual run name, run directory, snapshot name and output path,
+followed by the name of the halo catalogue (as in plot.sh).
+"""
+
+import h5py
+import unyt
+
+import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.halo_aggregates import (
+    dataset_units,
+    extra_quantities_filename,
+    write_extra_quantities,
+)
+from helpers.particle_apertures import ParticleTree, aperture_sums
+from helpers.snapshot_metadata import load_metadata
+
+stage_name = "halo_apertures"
+
+aperture_sizes = [5, 10, 50]
+# Particles within this distance in front of and behind the centre are
+# included in the projected apertures.
+projected_depth = unyt.unyt_quantity(50.0, "kpc")
+# Number of galaxies to query the trees for at once.
+batch_size = 4096
+
+# Output name: (aperture sum, or ratio of two aperture sums), units, label.
+aperture_outputs = {
+    "mass_star": ("mass_star", "Solar_Mass", "Stellar Mass"),
+    "sfr_gas": ("sfr_gas", "Solar_Mass / year", "SFR"),
+    "zmet_star": (
+        ("metal_mass_star", "mass_star"),
+        "dimensionless",
+        "Star Metallicity",
+    ),
+    "zmet_gas_sf": (
+        ("metal_mass_gas_sf", "mass_gas_sf"),
+        "dimensionless",
+        "Gas (SF) Metallicity",
+    ),
+}
+
+
+def read_particles(snapshot_filename, particle_type):
+    """
+    Coordinates (in internal, comoving units) of the particles of
+    ``particle_type`` that contribute to the apertures, with the values
+    to sum for each of them (in Msun and Msun / yr).
+
+    Only star-forming gas contributes to the gas apertures, so the other
+    gas particles are left out of the tree.
+    """
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        group_name = f"PartType{particle_type}"
+
+        if group_name not in handle or "Coordinates" not in handle[group_name]:
+            return None, None
+
+        group = handle[group_name]
+
+        def physical(name, units):
+            factor = float(dataset_units(group[name]).to(units).value)
+            return group[name][:].astype(np.float64) * factor
+
+        masses = physical("Masses", "Solar_Mass")
+        metal_mass_fractions = (
+            group["MetalMassFractions"][:].astype(np.float64)
+            if "MetalMassFractions" in group
+            else np.zeros(len(masses))
+        )
+
+        if particle_type == 4:
+            return (
+                group["Coordinates"][:],
+                {
+                    "mass_star": masses,
+                    "metal_mass_star": masses * metal_mass_fractions,
+                },
+            )
+
+        star_formation_rates = physical("StarFormationRates", "Solar_Mass / year")
+        star_forming = star_formation_rates > 0.0
+
+        return (
+            group["Coordinates"][:][star_forming],
+            {
+                "sfr_gas": star_formation_rates[star_forming],
+                "mass_gas_sf": masses[star_forming],
+                "metal_mass_gas_sf": (masses * metal_mass_fractions)[star_forming],
+            },
+        )
+
+
+def galaxy_centres(catalogue, metadata):
+    """
+    Catalogue indices and centres (in internal, comoving units) of the
+    halos that contain stars.
+    """
+
+    galaxy_indices = np.where(catalogue.apertures.mass_star_30_kpc.value > 0.0)[0]
+
+    centres = np.stack(
+        [
+            getattr(catalogue.positions, f"{axis}cminpot")[galaxy_indices]
+            for axis in "xyz"
+        ],
+        axis=1,
+    )
+    centres = (centres / metadata.a / metadata.units.length).to("dimensionless")
+
+    return galaxy_indices, centres.value
+
+
+def compute_apertures(
+    snapshot_filename, metadata, galaxy_indices, centres, number_of_halos
+):
+    """
+    Returns the aperture quantities of all halos in the catalogue (zero for
+    the ones that were not computed) as named unyt arrays.
+    """
+
+    boxsize = (metadata.boxsize / metadata.units.length).to("dimensionless").value
+    # Apertures are physical; the snapshot coordinates comoving.
+    to_internal = 1.0 / (metadata.a * metadata.units.length)
+    radii = unyt.unyt_array(aperture_sizes, "kpc") * to_internal
+    radii = radii.to("dimensionless").value
+    depth = float((projected_depth * to_internal).to("dimensionless"))
+
+    sums = {}
+
+    for particle_type in [4, 0]:
+        coordinates, weights = read_particles(snapshot_filename, particle_type)
+
+        if coordinates is None or len(coordinates) == 0:
+            continue
+
+        tree = ParticleTree(coordinates, boxsize)
+        type_sums = aperture_sums(
+            tree,
+            centres,
+            radii,
+            weights,
+            projected_depth=depth,
+            batch_size=batch_size,
+        )
+
+        for kind, kind_sums in type_sums.items():
+            sums.setdefault(kind, {}).update(kind_sums)
+
+    quantities = {}
+
+    for kind, prefix, label_prefix in [
+        ("3d", "aperture", ""),
+        ("projected", "projected_aperture", "Projected "),
+    ]:
+        kind_sums = sums.get(kind, {})
+
+        for index, aperture_size in enumerate(aperture_sizes):
+            for name, (source, units, label) in aperture_outputs.items():
+                values = np.zeros(number_of_halos)
+
+                if isinstance(source, tuple):
+                    if source[0] in kind_sums:
+                        numerator = kind_sums[source[0]][:, index]
+                        denominator = kind_sums[source[1]][:, index]
+                        with np.errstate(invalid="ignore", divide="ignore"):
+                            values[galaxy_indices] = np.where(
+                                denominator > 0.0, numerator / denominator, 0.0
+                            )
+                elif source in kind_sums:
+                    values[galaxy_indices] = kind_sums[source][:, index]
+
+                quantity = unyt.unyt_array(values, units)
+                quantity.name = f"{label_prefix}{label} ({aperture_size} kpc)"
+
+                quantities[f"{prefix}_{name}_{aperture_size}_kpc"] = quantity
+
+    return quantities
+
+
+if __name__ == "__main__":
+    from velociraptor import load
+
+    run_name = sys.argv[1]
+    run_directory = sys.argv[2]
+    snapshot_name = sys.argv[3]
+    output_path = sys.argv[4]
+    catalogue_name = sys.argv[5]
+
+    snapshot_filename = f"{run_directory}/{snapshot_name}"
+    catalogue_filename = f"{run_directory}/{catalogue_name}"
+
+    metadata = load_metadata(snapshot_filename)
+    catalogue = load(catalogue_filename)
+
+    galaxy_indices, centres = galaxy_centres(catalogue, metadata)
+
+    quantities = compute_apertures(
+        snapshot_filename,
+        metadata,
+        galaxy_indices,
+        centres,
+        len(catalogue.apertures.mass_star_30_kpc),
+    )
+
+    os.makedirs(output_path, exist_ok=True)
+
+    write_extra_quantities(
+        extra_quantities_filename(output_path, catalogue_filename, stage_name),
+        quantities,
+    )
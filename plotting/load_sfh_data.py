@@ -4,6 +4,8 @@ Code from Matthieu Schaller to load observational SFR data.
 
 from numpy import *
 
+from observational_bundle import load_bundle
+
 h = 0.68
 
 
@@ -29,7 +31,16 @@ class ObservationalData(object):
 
 def read_obs_data(path="observational_data"):
     """
-    Reads the observational data
+    Reads the observational data, from the pre-compiled bundle if it is
+    up to date.
+    """
+
+    return load_bundle(path, read_text_data, ObservationalData, "sfr")
+
+
+def read_text_data(path="observational_data"):
+    """
+    Reads the observational data from the text files
     """
 
     output = []
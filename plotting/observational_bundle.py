@@ -0,0 +1,157 @@
+"""
+Pre-compiled bundles of the observational data used by the star formation
+history and SNIa rate plots.
+
+Reading the observational data means parsing a dozen or so text files and
+applying the cosmology and IMF corrections to each of them. This is done
+once and the corrected arrays are stored in a versioned ``.npz`` bundle
+in the data directory. The bundle is rebuilt automatically whenever one of
+the source files, or the reader that applies the corrections, changes, and
+each bundle is only read once per process.
+
+Run this script from the root of the repository to (re-)build all the
+bundles up front:
+
+python3 plotting/observational_bundle.py
+"""
+
+import inspect
+import json
+import os
+import sys
+
+import numpy as np
+
+from glob import glob
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.sidecar_cache import atomic_output, cache_signature, is_valid
+
+bundle_filename = "observational_bundle.npz"
+# Bump this if the layout of the bundle changes.
+bundle_version = 1
+
+# Bundles already read by this process, by absolute data directory.
+_loaded_bundles = {}
+
+
+def source_fingerprint(path: str, read_text_data) -> str:
+    """
+    The signature of the bundle made from the source files in ``path`` by
+    ``read_text_data``, including the source code of its module and of
+    this one.
+    """
+
+    data_filenames = [
+        filename
+        for filename in sorted(glob(f"{path}/*"))
+        if not os.path.basename(filename).startswith(bundle_filename)
+    ]
+    reader_filenames = [inspect.getsourcefile(read_text_data), __file__]
+
+    return cache_signature(bundle_version, data_filenames + reader_filenames)
+
+
+def write_bundle(path: str, observations, value_name: str, fingerprint: str):
+    """
+    Stores the corrected arrays of ``observations`` in the bundle in ``path``.
+    """
+
+    arrays = {}
+    descriptions = []
+
+    for index, observation in enumerate(observations):
+        arrays[f"{index}_scale_factor"] = np.asarray(observation.scale_factor)
+        arrays[f"{index}_values"] = np.asarray(getattr(observation, value_name))
+
+        if observation.error is not None:
+            arrays[f"{index}_error"] = np.asarray(observation.error)
+
+        descriptions.append(observation.description)
+
+    metadata = {
+        "signature": fingerprint,
+        "value_name": value_name,
+        "descriptions": descriptions,
+    }
+
+    # Read-only data directory; the data is re-read from text every time.
+    with atomic_output(f"{path}/{bundle_filename}", ignore_errors=True) as temporary:
+        with open(temporary, "wb") as handle:
+            np.savez(handle, metadata=json.dumps(metadata), **arrays)
+
+    return
+
+
+def read_bundle(path: str, data_class, fingerprint: str):
+    """
+    Reads the bundle in ``path``, returning None if it is missing or out
+    of date.
+    """
+
+    try:
+        with np.load(f"{path}/{bundle_filename}") as bundle:
+            metadata = json.loads(str(bundle["metadata"]))
+
+            if not is_valid(metadata.get("signature"), fingerprint):
+                return None
+
+            observations = []
+
+            for index, description in enumerate(metadata["descriptions"]):
+                error_key = f"{index}_error"
+
+                observations.append(
+                    data_class(
+                        bundle[f"{index}_scale_factor"],
+                        bundle[f"{index}_values"],
+                        bundle[error_key] if error_key in bundle.files else None,
+                        description,
+                    )
+                )
+    except (OSError, KeyError, ValueError):
+        return None
+
+    return observations
+
+
+def load_bundle(path: str, read_text_data, data_class, value_name: str):
+    """
+    Returns the observational data in ``path``, using the bundle if it is
+    up to date and re-building it with ``read_text_data(path)`` if not.
+
+    ``data_class`` is the ObservationalData class of the reader, and
+    ``value_name`` the name of the attribute holding the measured values.
+    """
+
+    key = os.path.abspath(path)
+
+    if key not in _loaded_bundles:
+        fingerprint = source_fingerprint(path, read_text_data)
+        observations = read_bundle(path, data_class, fingerprint)
+
+        if observations is None:
+            observations = read_text_data(path)
+            write_bundle(path, observations, value_name, fingerprint)
+
+        _loaded_bundles[key] = observations
+
+    return _loaded_bundles[key]
+
+
+if __name__ == "__main__":
+    import load_sfh_data
+    import load_sn1a_data
+
+    for reader, path in [
+        (load_sfh_data, "plotting/sfr_data"),
+        (load_sn1a_data, "plotting/sn1a_data"),
+    ]:
+        try:
+            observations = reader.read_obs_data(path)
+        except OSError as error:
+            print(f"Unable to build the bundle in {path}: {error}")
+            continue
+
+        print(f"{path}/{bundle_filename}: {len(observations)} datasets")
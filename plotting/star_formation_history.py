@@ -1,136 +1,274 @@
 """
 Plots the star formation history. Modified version of the script in the
 github.com/swiftsim/swiftsimio-examples repository.
+
+The star formation history is read from SFR.txt, and is also
+reconstructed from the birth scale factors and initial masses of the star
+particles in the snapshot. The latter is shown on its own when SFR.txt is
+missing (e.g. for restarted or post-processed runs), and as a cross-check
+when both are available.
 """
 import matplotlib
 
 matplotlib.use("Agg")
 
+import h5py
 import unyt
 
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import sys
 
-from swiftsimio import load
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from helpers.downsample import plot_line
+from helpers.snapshot_metadata import load_metadata
 
 from load_sfh_data import read_obs_data
 
 sfr_output_units = unyt.msun / (unyt.year * unyt.Mpc ** 3)
 
-plt.style.use("mnras.mplstyle")
+# Scale factor binning and chunk size (in particles) for the
+# reconstruction from the star particles.
+reconstruction_minimum_scale_factor = 0.05
+reconstruction_number_of_bins = 128
+reconstruction_chunk_size = 1 << 22
 
-run_name = sys.argv[1]
-run_directory = sys.argv[2]
-snapshot_name = sys.argv[3]
-output_path = sys.argv[4]
+plt.style.use("mnras.mplstyle")
 
-sfr_filename = f"{run_directory}/SFR.txt"
-snapshot_filename = f"{run_directory}/{snapshot_name}"
 
-data = np.genfromtxt(sfr_filename).T
+def star_formation_rate_density(data, sfr_units, box_volume):
+    """
+    Converts the columns of SFR.txt (transposed) to the scale factor and
+    star formation rate density.
+    """
 
-snapshot = load(snapshot_filename)
-units = snapshot.units
-boxsize = snapshot.metadata.boxsize
-box_volume = boxsize[0] * boxsize[1] * boxsize[2]
+    # a, Redshift, SFR
+    scale_factor = data[2]
+    star_formation_rate = (data[7] * sfr_units / box_volume).to(sfr_output_units)
 
-sfr_units = snapshot.gas.star_formation_rates.units
+    return scale_factor, star_formation_rate
 
-# a, Redshift, SFR
-scale_factor = data[2]
-redshift = data[3]
-star_formation_rate = (data[7] * sfr_units / box_volume).to(sfr_output_units)
 
-observational_data = read_obs_data("plotting/sfr_data")
+def star_formation_rate_density_from_stars(snapshot_filename, metadata):
+    """
+    Reconstructs the star formation rate density from the star particles,
+    by histogramming their birth scale factors weighted by their initial
+    masses. The particles are read in chunks to bound the memory use.
 
-fig, ax = plt.subplots()
+    Returns None if there are no stars, or the run is not cosmological.
+    """
 
-ax.loglog()
+    scale_factor_bins = np.logspace(
+        np.log10(reconstruction_minimum_scale_factor),
+        np.log10(metadata.a),
+        reconstruction_number_of_bins + 1,
+    )
+    mass_formed = np.zeros(reconstruction_number_of_bins)
 
+    with h5py.File(snapshot_filename, "r") as handle:
+        if "PartType4/BirthScaleFactors" not in handle:
+            return None
 
-# High z-order as we always want these to be on top of the observations
-ax.plot(scale_factor, star_formation_rate.value, zorder=10000)[0]
+        birth_scale_factors = handle["PartType4/BirthScaleFactors"]
+        initial_masses = handle[
+            "PartType4/InitialMasses"
+            if "PartType4/InitialMasses" in handle
+            else "PartType4/Masses"
+        ]
 
-# Observational data plotting
+        number_of_stars = birth_scale_factors.shape[0]
 
-observation_lines = []
-observation_labels = []
+        for start in range(0, number_of_stars, reconstruction_chunk_size):
+            stop = start + reconstruction_chunk_size
 
-for index, observation in enumerate(observational_data):
-    if observation.fitting_formula:
-        if observation.description == "EAGLE NoAGN":
-            observation_lines.append(
-                ax.plot(
-                    observation.scale_factor,
-                    observation.sfr,
-                    label=observation.description,
-                    color="aquamarine",
-                    zorder=-10000,
-                    linewidth=1,
-                    alpha=0.5,
-                )[0]
+            H, _ = np.histogram(
+                birth_scale_factors[start:stop],
+                bins=scale_factor_bins,
+                weights=initial_masses[start:stop],
             )
+            mass_formed += H
+
+    try:
+        bin_durations = np.diff(metadata.cosmic_time(scale_factor_bins))
+    except ValueError:
+        return None
+
+    scale_factor = np.sqrt(scale_factor_bins[1:] * scale_factor_bins[:-1])
+    star_formation_rate = (
+        (mass_formed / bin_durations)
+        * metadata.units.star_formation_rate
+        / metadata.box_volume
+    ).to(sfr_output_units)
+
+    return scale_factor, star_formation_rate
+
+
+def make_plot(
+    scale_factor,
+    star_formation_rate,
+    observational_data,
+    output_path,
+    reconstructed=None,
+):
+    """
+    Plots the star formation rate density against the observational data.
+    Either the SFR.txt data (``scale_factor``, ``star_formation_rate``)
+    or the reconstruction from the star particles (``reconstructed``, a
+    tuple of the same) may be None.
+    """
+
+    fig, ax = plt.subplots()
+
+    ax.loglog()
+
+    simulation_lines = []
+    simulation_labels = []
+
+    # High z-order as we always want these to be on top of the observations
+    if scale_factor is not None:
+        simulation_lines.append(
+            plot_line(ax, scale_factor, star_formation_rate.value, zorder=10000)[0]
+        )
+        simulation_labels.append("SFR.txt")
+
+    if reconstructed is not None:
+        simulation_lines.append(
+            ax.plot(
+                reconstructed[0],
+                reconstructed[1].value,
+                color="C0" if scale_factor is None else "C1",
+                linestyle="solid" if scale_factor is None else "dashed",
+                zorder=10001,
+            )[0]
+        )
+        simulation_labels.append("Star particles")
+
+    # Observational data plotting
+
+    observation_lines = []
+    observation_labels = []
+
+    for index, observation in enumerate(observational_data):
+        if observation.fitting_formula:
+            if observation.description == "EAGLE NoAGN":
+                observation_lines.append(
+                    ax.plot(
+                        observation.scale_factor,
+                        observation.sfr,
+                        label=observation.description,
+                        color="aquamarine",
+                        zorder=-10000,
+                        linewidth=1,
+                        alpha=0.5,
+                    )[0]
+                )
+            else:
+                observation_lines.append(
+                    ax.plot(
+                        observation.scale_factor,
+                        observation.sfr,
+                        label=observation.description,
+                        color="grey",
+                        linewidth=1,
+                        zorder=-1000,
+                    )[0]
+                )
         else:
             observation_lines.append(
-                ax.plot(
+                ax.errorbar(
                     observation.scale_factor,
                     observation.sfr,
+                    observation.error,
                     label=observation.description,
-                    color="grey",
-                    linewidth=1,
-                    zorder=-1000,
-                )[0]
+                    linestyle="none",
+                    marker="o",
+                    elinewidth=0.5,
+                    markeredgecolor="none",
+                    markersize=2,
+                    zorder=index,  # Required to have line and blob at same zodrer
+                )
             )
-    else:
-        observation_lines.append(
-            ax.errorbar(
-                observation.scale_factor,
-                observation.sfr,
-                observation.error,
-                label=observation.description,
-                linestyle="none",
-                marker="o",
-                elinewidth=0.5,
-                markeredgecolor="none",
-                markersize=2,
-                zorder=index,  # Required to have line and blob at same zodrer
-            )
-        )
-    observation_labels.append(observation.description)
+        observation_labels.append(observation.description)
+
+
+    ax.set_xlabel("Redshift $z$")
+    ax.set_ylabel(r"SFR Density $\dot{\rho}_*$ [M$_\odot$ yr$^{-1}$ Mpc$^{-3}$]")
+
+
+    redshift_ticks = np.array([0.0, 0.2, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 50.0, 100.0])
+    redshift_labels = [
+        "$0$",
+        "$0.2$",
+        "$0.5$",
+        "$1$",
+        "$2$",
+        "$3$",
+        "$5$",
+        "$10$",
+        "$20$",
+        "$50$",
+        "$100$",
+    ]
+    a_ticks = 1.0 / (redshift_ticks + 1.0)
+
+    ax.set_xticks(a_ticks)
+    ax.set_xticklabels(redshift_labels)
+    ax.tick_params(axis="x", which="minor", bottom=False)
 
+    ax.set_xlim(1.02, 0.07)
+    ax.set_ylim(1.8e-4, 1.7)
 
-ax.set_xlabel("Redshift $z$")
-ax.set_ylabel(r"SFR Density $\dot{\rho}_*$ [M$_\odot$ yr$^{-1}$ Mpc$^{-3}$]")
+    observation_legend = ax.legend(
+        observation_lines, observation_labels, markerfirst=True, loc=3, fontsize=4, ncol=2
+    )
 
+    if len(simulation_lines) > 1:
+        ax.add_artist(observation_legend)
+        ax.legend(simulation_lines, simulation_labels, loc=1, fontsize=4)
 
-redshift_ticks = np.array([0.0, 0.2, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 50.0, 100.0])
-redshift_labels = [
-    "$0$",
-    "$0.2$",
-    "$0.5$",
-    "$1$",
-    "$2$",
-    "$3$",
-    "$5$",
-    "$10$",
-    "$20$",
-    "$50$",
-    "$100$",
-]
-a_ticks = 1.0 / (redshift_ticks + 1.0)
+    fig.tight_layout()
 
-ax.set_xticks(a_ticks)
-ax.set_xticklabels(redshift_labels)
-ax.tick_params(axis="x", which="minor", bottom=False)
+    fig.savefig(f"{output_path}/star_formation_history.png")
+    plt.close(fig)
+
+    return
+
+
+if __name__ == "__main__":
+    run_name = sys.argv[1]
+    run_directory = sys.argv[2]
+    snapshot_name = sys.argv[3]
+    output_path = sys.argv[4]
+
+    sfr_filename = f"{run_directory}/SFR.txt"
+    snapshot_filename = f"{run_directory}/{snapshot_name}"
+
+    metadata = load_metadata(snapshot_filename)
+
+    scale_factor, star_formation_rate = None, None
+
+    if os.path.exists(sfr_filename):
+        data = np.genfromtxt(sfr_filename, ndmin=2).T
+
+        if data.size > 0:
+            scale_factor, star_formation_rate = star_formation_rate_density(
+                data, metadata.units.star_formation_rate, metadata.box_volume
+            )
 
-ax.set_xlim(1.02, 0.07)
-ax.set_ylim(1.8e-4, 1.7)
+    reconstructed = star_formation_rate_density_from_stars(snapshot_filename, metadata)
 
-observation_legend = ax.legend(
-    observation_lines, observation_labels, markerfirst=True, loc=3, fontsize=4, ncol=2
-)
+    if scale_factor is None and reconstructed is None:
+        print(f"No SFR.txt or star particles for {run_name}, skipping.")
+        exit(0)
 
-fig.tight_layout()
+    observational_data = read_obs_data("plotting/sfr_data")
 
-fig.savefig(f"{output_path}/star_formation_history.png")
+    make_plot(
+        scale_factor,
+        star_formation_rate,
+        observational_data,
+        output_path,
+        reconstructed=reconstructed,
+    )
@@ -20,6 +20,13 @@ This file calculates:
         Metallicity in solar units (relative to metal_mass_fraction).
     + stellar_mass_to_halo_mass_{x}_kpc for 30 and 100 kpc
         Stellar Mass / Halo Mass (mass_200crit) for 30 and 100 kpc apertures.
+
+It also registers the per-halo quantities computed from the snapshot
+particles by the pipeline (plotting/halo_aggregates.py and
+plotting/halo_apertures.py), which are
+stored in extra_*.hdf5 files in the directory given by the
+EXTRA_QUANTITIES_PATH environment variable (the output path, set by
+plot.sh), or next to the catalogue if it is not set.
 """
 
 aperture_sizes = [30, 100]
@@ -117,3 +124,26 @@ for aperture_size in aperture_sizes:
     smhm.name = name
 
     setattr(self, f"stellar_mass_to_halo_mass_{aperture_size}_kpc", smhm)
+
+
+# Per-halo quantities computed from the particles, one dataset per quantity
+import h5py
+import os
+
+from glob import glob
+
+extra_path = os.environ.get(
+    "EXTRA_QUANTITIES_PATH", os.path.dirname(os.path.abspath(catalogue.filename))
+)
+extra_filenames = glob(
+    f"{extra_path}/"
+    + os.path.basename(catalogue.filename).replace("properties", "extra_*.hdf5")
+)
+
+for extra_filename in sorted(extra_filenames):
+    with h5py.File(extra_filename, "r") as handle:
+        for quantity_name, dataset in handle.items():
+            quantity = unyt.unyt_array(dataset[:], units=dataset.attrs["units"])
+            quantity.name = dataset.attrs.get("name", quantity_name)
+
+            setattr(self, quantity_name, quantity)
@@ -16,6 +16,10 @@ source env/bin/activate
 # assuming that you have snapshots named eagle_$snap_numbers, 
 # and halo catalogues named halo_$snap_numbers.properties.
 # It makes plots in $run_driectory/plots/snapshot_$snapnum/...
+#
+# To process the snapshots of a run that is still going as they are
+# written, instead of listing them here, use
+#   python3 live/watch_snapshots.py $run_name $run_directory/$run_name
 
 export run_directory=/path/to/runs
 